@@ -2,13 +2,32 @@ from django.urls import path
 from rest_framework.urlpatterns import format_suffix_patterns
 
 from . import api_views as views
+from . import async_views
 
 
 urlpatterns = [
     path('cards/', views.CardAPIList.as_view(), name='card-list'),
     path('cards/<int:pk>/', views.CardAPIDetail.as_view(), name='card-detail'),
     path('dishes/', views.DishAPIList.as_view(), name='dish-detail'),
+    path('dishes/bulk/', views.DishAPIBulk.as_view(), name='dish-bulk'),
     path('dishes/<int:pk>/', views.DishAPIDetail.as_view(), name='dish-detail'),
+    path('public/menu/', views.PublicMenuView.as_view(), name='public-menu'),
+    path('changes/', views.ChangeLogAPIView.as_view(), name='change-list'),
+    path('export/', views.MenuExportAPIView.as_view(), name='menu-export'),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
+
+# async (ASGI) read-only views, without format suffixes
+urlpatterns += [
+    path('async/cards/', async_views.card_list, name='async-card-list'),
+    path(
+        'async/cards/<int:pk>/', async_views.card_detail,
+        name='async-card-detail',
+    ),
+    path('async/dishes/', async_views.dish_list, name='async-dish-list'),
+    path(
+        'async/dishes/<int:pk>/', async_views.dish_detail,
+        name='async-dish-detail',
+    ),
+]
@@ -1,11 +1,276 @@
-from django.db.models import Count
+from hashlib import md5
 
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, Max
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
+from django.views import View
 from django_filters import rest_framework as filters
-from rest_framework import generics, permissions
+from rest_framework import generics, permissions, serializers, status
 from rest_framework.filters import OrderingFilter
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from card.serializers import CardSerializer, DishSerializer
-from card.models import Card, Dish
+from card.cache import (get_menu_cache, get_menu_version, get_object_version,
+        use_primary_if_recent)
+from card.export import EXPORT_FORMATS, iter_rows, parse_since
+from card.public import dumps, get_public_menu
+from card.serializers import LINKS_QUERY_PARAM, CardSerializer, DishSerializer
+from card.models import Card, ChangeLogEntry, Dish
+from card.signals import dishes_bulk_changed, lock_change_log
+from card.snapshots import get_fresh_snapshot, get_snapshot_json
+from emenu.metrics import record_cache_lookup
+
+
+PUBLIC_MENU_KEY = 'emenu:public_menu:{}'
+
+
+def make_etag(*parts):
+    '''
+    Returns quoted (strong) ETag built from given parts
+    '''
+    raw_etag = '|'.join(str(part) for part in parts)
+    return quote_etag(md5(raw_etag.encode('utf-8')).hexdigest())
+
+def get_query_key(request):
+    '''
+    Returns query string of the request with sorted parameters, so the
+    same query gets the same ETag regardless of the order of parameters
+    '''
+    return urlencode(sorted(request.query_params.lists()), doseq=True)
+
+def get_links_mode(request):
+    '''
+    Returns value of the links parameter (see EmenuHyperlinkedModelSerializer),
+    which changes representation of related objects
+    '''
+    return request.query_params.get(LINKS_QUERY_PARAM, '')
+
+def get_last_modified(last_change_date, version):
+    '''
+    Returns timestamp (in seconds) of the last change, based on the
+    last_change_date and cache version (which is a time in nanoseconds
+    and changes also on changes not visible in last_change_date,
+    like deletes or dishes added to a card)
+    '''
+    timestamp = version // 10 ** 9
+    if last_change_date is not None:
+        timestamp = max(timestamp, int(last_change_date.timestamp()))
+    return timestamp
+
+def is_link_of(key, model, object_id):
+    '''
+    Checks if change key (model, object_id, card_id) belongs to a link
+    (dish - card) of given card or dish
+    '''
+    _, dish_id, card_id = key
+    if card_id is None:
+        return False
+    if model == ChangeLogEntry.CARD:
+        return card_id == object_id
+    return dish_id == object_id
+
+def compact_changes(entries):
+    '''
+    Returns list of (seq, model, object_id, card_id, action) tuples with
+    only the last change of every object and link from given entries
+    (ordered by seq): update after create is reported as create, objects
+    created and deleted within the entries are skipped and so are changes
+    of links of deleted objects
+    '''
+    changes = {}
+    for seq, model, object_id, card_id, action in entries:
+        key = (model, object_id, card_id)
+        if action == ChangeLogEntry.DELETE:
+            changes = {
+                change_key: change for change_key, change in changes.items()
+                if not is_link_of(change_key, model, object_id)
+            }
+        previous = changes.get(key)
+        if previous is not None and previous[4] == ChangeLogEntry.CREATE:
+            # created object keeps its place (before changes of its links)
+            if action == ChangeLogEntry.DELETE:
+                del changes[key]
+            continue
+        changes.pop(key, None)
+        changes[key] = (seq, model, object_id, card_id, action)
+    return list(changes.values())
+
+def delete_dishes(using, dish_ids):
+    '''
+    Deletes dishes with a single DELETE statement, without collecting
+    related objects (their links have to be deleted first) and without
+    signals
+    '''
+    if not dish_ids:
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+            connection.ops.quote_name(Dish._meta.db_table),
+            connection.ops.quote_name(Dish._meta.pk.column),
+            ', '.join(['%s'] * len(dish_ids)),
+        ), dish_ids)
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalListMixin():
+    '''
+    Custom mixin for django-rest list views, that answers conditional GET
+    requests (If-None-Match, If-Modified-Since) with 304 Not Modified.
+    Validators are computed without serializing: from MAX(last_change_date)
+    and COUNT of the filtered queryset and the global menu version
+    (see card.cache)
+    '''
+    def get_list_validators(self, request):
+        version = get_menu_version()
+        use_primary_if_recent(version)
+        queryset = self.filter_queryset(self.get_queryset())
+        aggregates = queryset.order_by().aggregate(
+            last_change_date=Max('last_change_date'),
+            count=Count('pk'),
+        )
+        etag = make_etag(
+            request.path,
+            get_query_key(request),
+            get_links_mode(request),
+            request.user.is_authenticated,
+            request.accepted_renderer.format,
+            aggregates['last_change_date'],
+            aggregates['count'],
+            version,
+        )
+        last_modified = get_last_modified(
+            aggregates['last_change_date'], version
+        )
+        return etag, last_modified
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = self.get_list_validators(request)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+
+class ConditionalDetailMixin():
+    '''
+    Custom mixin for django-rest detail views, that answers conditional
+    GET requests with 304 Not Modified and checks If-Match
+    (If-Unmodified-Since) headers of PUT/PATCH/DELETE requests (412
+    Precondition Failed is returned if the object was changed in the
+    meantime). Validators are computed from last_change_date and cache
+    version of the object (see card.cache).
+    '''
+    def get_queryset(self):
+        '''
+        Prefetching is disabled for single object - related objects are
+        fetched by the serializer with the same single query, but only
+        if the response is not 304 Not Modified
+        '''
+        return super().get_queryset().prefetch_related(None)
+
+    def get_object(self):
+        if not hasattr(self, '_object'):
+            model_name = self.get_queryset().model._meta.model_name
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            use_primary_if_recent(
+                get_object_version(model_name, self.kwargs[lookup_url_kwarg])
+            )
+            self._object = super().get_object()
+        return self._object
+
+    def get_detail_validators(self, request, instance):
+        version = get_object_version(instance._meta.model_name, instance.pk)
+        etag = make_etag(
+            instance._meta.label,
+            instance.pk,
+            request.accepted_renderer.format,
+            get_links_mode(request),
+            instance.last_change_date.isoformat(),
+            version,
+        )
+        last_modified = get_last_modified(instance.last_change_date, version)
+        return etag, last_modified
+
+    def get_precondition_response(self, request):
+        etag, last_modified = self.get_detail_validators(
+            request, self.get_object()
+        )
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:
+            set_validators(response, etag, last_modified)
+        return response, etag, last_modified
+
+    def retrieve(self, request, *args, **kwargs):
+        response, etag, last_modified = self.get_precondition_response(
+            request
+        )
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+            set_validators(response, etag, last_modified)
+        return response
+
+    def update(self, request, *args, **kwargs):
+        response = self.get_precondition_response(request)[0]
+        if response is not None:
+            return response
+        response = super().update(request, *args, **kwargs)
+        etag, last_modified = self.get_detail_validators(
+            request, self.get_object()
+        )
+        return set_validators(response, etag, last_modified)
+
+    def destroy(self, request, *args, **kwargs):
+        response = self.get_precondition_response(request)[0]
+        if response is not None:
+            return response
+        return super().destroy(request, *args, **kwargs)
+
+
+class SnapshotDetailMixin():
+    '''
+    Custom mixin for django-rest Card detail view, that serves JSON
+    straight from the snapshot of the card (single primary key lookup,
+    see card.snapshots) while it is fresh; browsable api, format suffixes
+    and '?links=ids' are rendered as usual. Has to be used with
+    ConditionalDetailMixin - validators are the same for both paths.
+    '''
+    def get_snapshot(self, request):
+        if request.accepted_renderer.format != 'json' \
+                or self.format_kwarg is not None \
+                or LINKS_QUERY_PARAM in request.query_params:
+            return None
+        return get_fresh_snapshot(
+            self.kwargs[self.lookup_field], ['json'],
+            public=not request.user.is_authenticated,
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        snapshot = self.get_snapshot(request)
+        if snapshot is None:
+            return super().retrieve(request, *args, **kwargs)
+        card = Card(pk=snapshot.pk, last_change_date=snapshot.last_change_date)
+        etag, last_modified = self.get_detail_validators(request, card)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = HttpResponse(
+                get_snapshot_json(snapshot, request),
+                content_type='application/json',
+            )
+        return set_validators(response, etag, last_modified)
 
 
 class EmenuCardAPIMixin():
@@ -14,6 +279,8 @@ class EmenuCardAPIMixin():
     '''
     serializer_class = CardSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    # session, user, card, dishes (see emenu.query_budget)
+    query_budget = 4
 
     def get_queryset(self):
         '''
@@ -21,51 +288,81 @@ class EmenuCardAPIMixin():
         because if user is not authenticated we have to exclude
         cards with no dishes
         '''
-        queryset = Card.objects.all()\
-                .prefetch_related('dishes')\
-                .annotate(dishes_count=Count('dishes'))
+        queryset = Card.objects.all().prefetch_related('dishes')
         if not self.request.user.is_authenticated:
-            queryset = Card.objects.exclude(dishes__isnull=True)
+            queryset = queryset.exclude_empty()
         return queryset
 
 
-class CardAPIListFilterSet(filters.FilterSet):
+class SearchFilterSet(filters.FilterSet):
+    '''
+    Base filterset with full text search in name and description ('q');
+    results are ordered by rank (OrderingFilter overrides it
+    if 'ordering' is given)
+    '''
+    q = filters.CharFilter(method='filter_search', label='search')
+
+    def filter_search(self, queryset, name, value):
+        return queryset.search(value).order_by('-search_rank')
+
+
+class CardAPIListFilterSet(SearchFilterSet):
     '''
     Filterset for CardList that included DateTimeToRangeFilter 
-    for both Card.creation_date and Card.last_change_date
+    for both Card.creation_date and Card.last_change_date,
+    RangeFilter for Card.dishes_count and search filter ('q')
     '''
     creation_date = filters.DateTimeFromToRangeFilter()
     last_change_date = filters.DateTimeFromToRangeFilter()
+    dishes_count = filters.RangeFilter()
 
     class Meta:
         model = Card
-        fields = ['name', 'creation_date', 'last_change_date']
+        fields = [
+            'q', 'name', 'creation_date', 'last_change_date', 'dishes_count',
+        ]
 
 
-class CardAPIList(EmenuCardAPIMixin, generics.ListCreateAPIView):
+class CardAPIList(ConditionalListMixin, EmenuCardAPIMixin,
+        generics.ListCreateAPIView):
     '''
     Create new card or list all menu cards using django rest api view;
     accepts following get parameters:
+    'q' - equal to Card.objects.search(value), results are ordered by rank
+      unless 'ordering' is given
     'name' - equal to Card.objects.filter(name=value)
     'creation_date_after' - Card.objects.filter(creation_date__gte=value)
     'creation_date_before' - Card.objects.filter(creation_date__gte=value)
     'last_change_date_after' - Card.objects.filter(last_change_date__gte=value)
     'last_change_date_before' - Card.objects.filter(last_change_date__gte=value)
+    'dishes_count_min' - Card.objects.filter(dishes_count__gte=value)
+    'dishes_count_max' - Card.objects.filter(dishes_count__lte=value)
     'ordering': orders the queryset depending on provided value:
       'name' - by name (ascending)
       'name' - by name (descending
       'dishes_count' - by number of dishes (ascending)
       '-dishes_count' - by number of dishes (descending),
+    'cursor' - switches to cursor pagination (empty value for first page),
+      which does not count the results; links to next/previous page
+      are returned in the response
+    Supports conditional GET requests (ETag, Last-Modified)
     '''
     filter_backends = [filters.DjangoFilterBackend, OrderingFilter]
     filterset_class = CardAPIListFilterSet
     ordering_fields = ['name', 'dishes_count']
+    # session, user, validators (ETag), count, cards, prefetched dishes
+    query_budget = 6
 
 
-class CardAPIDetail(EmenuCardAPIMixin, generics.RetrieveUpdateDestroyAPIView):
+class CardAPIDetail(SnapshotDetailMixin, ConditionalDetailMixin,
+        EmenuCardAPIMixin, generics.RetrieveUpdateDestroyAPIView):
     '''
-    View, edit or delete specific card using django rest api view
+    View, edit or delete specific card using django rest api view;
+    supports conditional requests (ETag, Last-Modified, If-Match),
+    fresh cards are served from their snapshots
     '''
+    # session, user, snapshot (if it is not fresh: card, dishes)
+    query_budget = 5
 
 
 class EmenuDishAPIMixin():
@@ -74,19 +371,255 @@ class EmenuDishAPIMixin():
     '''
     serializer_class = DishSerializer
     permission_classes = [permissions.IsAuthenticated]
+    # session, user, dish, cards (see emenu.query_budget)
+    query_budget = 4
 
     def get_queryset(self):
         return Dish.objects.all().prefetch_related('cards')
 
 
-class DishAPIList(EmenuDishAPIMixin, generics.ListCreateAPIView):
+class DishAPIListFilterSet(SearchFilterSet):
+    '''
+    Filterset for DishList with search filter ('q')
+    '''
+
+    class Meta:
+        model = Dish
+        fields = ['q']
+
+
+class DishAPIList(ConditionalListMixin, EmenuDishAPIMixin,
+        generics.ListCreateAPIView):
+    '''
+    Create new dish or list all dishes using django rest api view;
+    accepts following get parameters:
+    'q' - equal to Dish.objects.search(value), results are ordered by rank
+    'cursor' - switches to cursor pagination (empty value for first page)
+    Supports conditional GET requests (ETag, Last-Modified)
+    '''
+    filter_backends = [filters.DjangoFilterBackend]
+    filterset_class = DishAPIListFilterSet
+    # session, user, validators (ETag), count, dishes, prefetched cards
+    query_budget = 6
+
+
+class DishAPIDetail(ConditionalDetailMixin, EmenuDishAPIMixin,
+        generics.RetrieveUpdateDestroyAPIView):
+    '''
+    View, edit or delete specific dish using django rest api view;
+    supports conditional requests (ETag, Last-Modified, If-Match)
+    '''
+
+
+class DishAPIBulk(EmenuDishAPIMixin, generics.GenericAPIView):
+    '''
+    Bulk operations on dishes using django rest api view:
+    POST - list of dish payloads, items with 'id' update existing dishes,
+    other items create new ones; all valid items are written in a single
+    transaction and errors are returned per item (aligned with input),
+    with status 201 if any dish was created.
+    With '?atomic=true' nothing is written if any item is invalid.
+    DELETE - list of ids of dishes to delete
+    Both accept at most max_batch_size items.
+    '''
+    atomic_query_param = 'atomic'
+    max_batch_size = 1000
+    # items are validated one by one (unique name, related urls)
+    query_budget = None
+    query_repeat_limit = None
+
+    def is_atomic(self, request):
+        value = request.query_params.get(self.atomic_query_param, '')
+        return value.lower() in ('1', 'true')
+
+    def get_instances(self, data):
+        if not isinstance(data, list):
+            return []
+        ids = [
+            str(item['id']) for item in data
+            if isinstance(item, dict) and item.get('id') is not None
+        ]
+        ids = [pk for pk in ids if pk.isdigit()]
+        return list(self.get_queryset().filter(pk__in=ids))
+
+    def check_batch_size(self, data):
+        if isinstance(data, list) and len(data) > self.max_batch_size:
+            raise serializers.ValidationError(
+                'Ensure this field has no more than {} elements.'.format(
+                    self.max_batch_size
+                )
+            )
+
+    def post(self, request, *args, **kwargs):
+        self.check_batch_size(request.data)
+        instances = self.get_instances(request.data)
+        serializer = self.get_serializer(
+            instances, data=request.data, many=True,
+        )
+        serializer.is_valid(raise_exception=True)
+        dishes = serializer.save(atomic=self.is_atomic(request))
+        saved = self.get_queryset().in_bulk([d.pk for d in dishes if d])
+        results = [
+            serializer.child.to_representation(saved[dish.pk])
+            if dish else None
+            for dish in dishes
+        ]
+        existing_ids = {instance.pk for instance in instances}
+        created = any(dish and dish.pk not in existing_ids for dish in dishes)
+        return Response(
+            {'results': results, 'errors': serializer.item_errors},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    def delete(self, request, *args, **kwargs):
+        ids_field = serializers.ListField(
+            child=serializers.IntegerField(), max_length=self.max_batch_size,
+        )
+        ids = ids_field.run_validation(request.data)
+        through_model = Dish.cards.through
+        with transaction.atomic():
+            using = router.db_for_write(Dish)
+            lock_change_log(using)
+            # locked dishes cannot get new links (FK check of the through
+            # table) until the end of the transaction
+            dish_ids = list(self.get_queryset()
+                .filter(pk__in=ids)
+                .select_for_update()
+                .order_by('pk')
+                .values_list('pk', flat=True)
+            )
+            rows = through_model.objects.filter(dish_id__in=dish_ids)
+            card_ids = set(rows.values_list('card_id', flat=True))
+            rows.delete()
+            # no cascades nor per-instance signals, deletes are logged
+            # (once) by dishes_bulk_changed receiver
+            delete_dishes(using, dish_ids)
+            dishes_bulk_changed.send(
+                sender=Dish, dish_ids=dish_ids, card_ids=card_ids,
+                deleted_ids=dish_ids,
+            )
+        return Response({'deleted': dish_ids})
+
+
+class MenuExportAPIView(APIView):
     '''
-    Create new dish or list all dishes using django rest api view
+    Streams all cards, dishes and card-dish links; accepts following
+    get parameters:
+    'output' - 'ndjson' (default) or 'csv'
+    'since' - date or datetime, exports only rows changed since then
     '''
+    permission_classes = [permissions.IsAuthenticated]
+    output_query_param = 'output'
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get(self.output_query_param, 'ndjson')
+        if output not in EXPORT_FORMATS:
+            raise serializers.ValidationError(
+                {self.output_query_param: ['Unknown format.']}
+            )
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = parse_since(since)
+            except ValueError as exc:
+                raise serializers.ValidationError({'since': [str(exc)]})
+        iter_lines, content_type = EXPORT_FORMATS[output]
+        response = StreamingHttpResponse(
+            iter_lines(iter_rows(since or None)), content_type=content_type,
+        )
+        response['Content-Disposition'] = (
+            'attachment; filename="menu.{}"'.format(output)
+        )
+        return response
 
 
-class DishAPIDetail(EmenuDishAPIMixin, generics.RetrieveUpdateDestroyAPIView):
+class PublicMenuView(View):
     '''
-    View, edit or delete specific dish using django rest api view
+    Read-only menu for anonymous clients (e.g. widgets embedded on
+    customer sites): all non-empty cards with their dishes, see
+    card.public.get_public_menu. Plain django view - no authentication,
+    permissions, content negotiation nor serializers; answers conditional
+    GET requests by the menu version (no database queries) and serves
+    the encoded menu from the cache, until the version changes.
     '''
+    # cards, card-dish pairs joined with dishes (see emenu.query_budget)
+    query_budget = 2
+
+    def get_content(self, version):
+        cache = get_menu_cache()
+        key = PUBLIC_MENU_KEY.format(version)
+        content = cache.get(key)
+        record_cache_lookup('public_menu', content is not None)
+        if content is None:
+            use_primary_if_recent(version)
+            content = dumps({'results': get_public_menu()})
+            cache.set(
+                key, content,
+                getattr(settings, 'MENU_CACHE_TIMEOUT', 60 * 60),
+            )
+        return content
+
+    def get(self, request, *args, **kwargs):
+        version = get_menu_version()
+        etag = make_etag('public-menu', version)
+        last_modified = get_last_modified(None, version)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = HttpResponse(
+                self.get_content(version), content_type='application/json',
+            )
+        return set_validators(response, etag, last_modified)
+
+
+class ChangeLogAPIView(APIView):
+    '''
+    Incremental feed of changes of cards, dishes and dishes' cards;
+    accepts following get parameters:
+    'since' - seq of the last change seen by the client (0 - from the start)
+    'limit' - max number of log entries read at once
+    Returns compact deltas (see compact_changes) ordered by seq, 'next' -
+    value of 'since' for the next request and 'has_more'
+    '''
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 1000
+    max_limit = 10000
+
+    def get_int_param(self, request, name, default, min_value, max_value):
+        field = serializers.IntegerField(
+            min_value=min_value, max_value=max_value,
+        )
+        try:
+            return field.run_validation(
+                request.query_params.get(name, default)
+            )
+        except serializers.ValidationError as exc:
+            raise serializers.ValidationError({name: exc.detail})
 
+    def get(self, request, *args, **kwargs):
+        since = self.get_int_param(request, 'since', 0, 0, None)
+        limit = self.get_int_param(
+            request, 'limit', self.default_limit, 1, self.max_limit,
+        )
+        entries = list(ChangeLogEntry.objects
+            .filter(seq__gt=since)
+            .order_by('seq')
+            .values_list('seq', 'model', 'object_id', 'card_id', 'action')
+            [:limit + 1]
+        )
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+        results = []
+        for seq, model, object_id, card_id, action in compact_changes(entries):
+            change = {
+                'seq': seq, 'model': model, 'id': object_id, 'action': action,
+            }
+            if card_id is not None:
+                change['card'] = card_id
+            results.append(change)
+        return Response({
+            'results': results,
+            'next': entries[-1][0] if entries else since,
+            'has_more': has_more,
+        })
@@ -0,0 +1,180 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotAllowed
+
+from emenu.query_budget import record_queries
+
+from .models import Card, Dish
+from .public import (PUBLIC_CARD_FIELDS, PUBLIC_DISH_FIELDS, dumps,
+        localize_dates)
+
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+NOT_AUTHENTICATED = 'Authentication credentials were not provided.'
+NOT_FOUND = 'Not found.'
+
+# Django 3.2 has no async ORM (aiterator, afirst, acount came in 4.1), so
+# queries are made by plain functions run with sync_to_async (see
+# in_thread) - views only await them and do not hold a thread while
+# waiting for the client
+
+
+def in_thread(func):
+    '''
+    Returns async function running func (which only reads) in a thread of
+    the executor - not in the single thread of sync_to_async with default
+    thread_sensitive=True, so queries of concurrent requests run in
+    parallel. Connections of the thread are checked (CONN_MAX_AGE, health
+    check) before and after, like at the start and end of a request.
+    '''
+    @record_queries
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+def json_response(data, status=200):
+    return HttpResponse(
+        dumps(data), content_type='application/json', status=status,
+    )
+
+def read_only(view):
+    '''
+    Allows only GET (and HEAD) requests to the async view
+    '''
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+def get_page_params(query_dict):
+    '''
+    Returns tuple of keyset pagination parameters: 'after' - id of the last
+    object of the previous page and 'limit'; ValueError if they are invalid
+    '''
+    try:
+        after = int(query_dict.get('after', 0))
+        limit = int(query_dict.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError('after and limit have to be integers')
+    if after < 0 or not 0 < limit <= MAX_LIMIT:
+        raise ValueError('limit has to be between 1 and {}'.format(MAX_LIMIT))
+    return after, limit
+
+def add_related_ids(rows, key, related_key, name):
+    '''
+    Adds list of ids of related objects (read from Dish.cards through
+    table with single query) to every row under given name
+    '''
+    related = {row['id']: [] for row in rows}
+    if not related:
+        return rows
+    pairs = Dish.cards.through.objects\
+        .filter(**{'{}__in'.format(key): list(related)})\
+        .order_by(related_key)\
+        .values_list(key, related_key)
+    for pk, related_pk in pairs:
+        related[pk].append(related_pk)
+    for row in rows:
+        row[name] = related[row['id']]
+    return rows
+
+def fetch_cards(public, after=0, limit=DEFAULT_LIMIT, pk=None):
+    '''
+    Returns list of cards (ordered by id) with ids of their dishes;
+    public excludes cards with no dishes, pk selects a single card
+    '''
+    queryset = Card.objects.order_by('pk')
+    if public:
+        queryset = queryset.exclude_empty()
+    if pk is not None:
+        queryset = queryset.filter(pk=pk)
+    else:
+        queryset = queryset.filter(pk__gt=after)[:limit + 1]
+    cards = [
+        localize_dates(card)
+        for card in queryset.values(*PUBLIC_CARD_FIELDS)
+    ]
+    return add_related_ids(cards, 'card_id', 'dish_id', 'dishes')
+
+def fetch_dishes(after=0, limit=DEFAULT_LIMIT, pk=None):
+    '''
+    Returns list of dishes (ordered by id) with ids of their cards
+    '''
+    queryset = Dish.objects.order_by('pk')
+    if pk is not None:
+        queryset = queryset.filter(pk=pk)
+    else:
+        queryset = queryset.filter(pk__gt=after)[:limit + 1]
+    dishes = []
+    for dish in queryset.values(*PUBLIC_DISH_FIELDS):
+        dish['price'] = str(dish['price'])
+        dishes.append(localize_dates(dish))
+    return add_related_ids(dishes, 'dish_id', 'card_id', 'cards')
+
+def is_authenticated(request):
+    return request.user.is_authenticated
+
+async def list_response(request, fetch, *args):
+    '''
+    Returns page of objects fetched (see in_thread) by the given
+    function, 'next' is the value of 'after' for the next page
+    '''
+    try:
+        after, limit = get_page_params(request.GET)
+    except ValueError as exc:
+        return json_response({'detail': str(exc)}, status=400)
+    rows = await in_thread(fetch)(*args, after=after, limit=limit)
+    return json_response({
+        'results': rows[:limit],
+        'next': rows[limit - 1]['id'] if len(rows) > limit else None,
+    })
+
+async def detail_response(fetch, *args, pk):
+    rows = await in_thread(fetch)(*args, pk=pk)
+    if not rows:
+        return json_response({'detail': NOT_FOUND}, status=404)
+    return json_response(rows[0])
+
+
+@read_only
+async def card_list(request):
+    '''
+    Async list of menu cards (cards with no dishes are listed only for
+    authenticated users); accepts 'after' (id of the last card of
+    the previous page) and 'limit' get parameters
+    '''
+    public = not await in_thread(is_authenticated)(request)
+    return await list_response(request, fetch_cards, public)
+
+
+@read_only
+async def card_detail(request, pk):
+    public = not await in_thread(is_authenticated)(request)
+    return await detail_response(fetch_cards, public, pk=pk)
+
+
+@read_only
+async def dish_list(request):
+    '''
+    Async list of dishes (only for authenticated users); accepts 'after'
+    and 'limit' get parameters
+    '''
+    if not await in_thread(is_authenticated)(request):
+        return json_response({'detail': NOT_AUTHENTICATED}, status=403)
+    return await list_response(request, fetch_dishes)
+
+
+@read_only
+async def dish_detail(request, pk):
+    if not await in_thread(is_authenticated)(request):
+        return json_response({'detail': NOT_AUTHENTICATED}, status=403)
+    return await detail_response(fetch_dishes, pk=pk)
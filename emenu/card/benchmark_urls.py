@@ -0,0 +1,23 @@
+import asyncio
+
+from django.http import HttpResponse
+from django.urls import path
+
+
+# URLconf of card.benchmarks.run_pipeline_benchmark (not included
+# in emenu.urls)
+
+
+async def sleep_view(request):
+    '''
+    Async view which awaits 'delay' seconds - unlike the slow clients of
+    run_asgi_benchmarks, the await is inside of the request pipeline
+    (between request and response of all middleware)
+    '''
+    await asyncio.sleep(float(request.GET.get('delay', 0)))
+    return HttpResponse()
+
+
+urlpatterns = [
+    path('sleep/', sleep_view, name='benchmark-sleep'),
+]
@@ -0,0 +1,477 @@
+import asyncio
+from datetime import timedelta
+from io import StringIO
+from statistics import median
+import threading
+from time import perf_counter
+import tracemalloc
+from urllib.parse import urlsplit
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail
+from django.core.asgi import get_asgi_application
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.functions import Lower
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from emenu.query_budget import QueryRecorder
+from emenu.startup import ENTRY_POINTS, run_entry_point
+
+from . import api_views, views
+from .cache import get_menu_cache, get_menu_version
+from .models import Card, Dish
+from .serializers import CardSerializer, DishSerializer
+from .snapshots import render_card_html
+
+
+BENCHMARKS = {}
+QUERY_PLANS = {}
+LARGE_CARD_DISHES = 500
+LARGE_CARD_NAME = 'Benchmark card ({} dishes)'
+# name: (sync view path, async view path) - compared by run_asgi_benchmarks
+ASGI_BENCHMARKS = {
+    'card_list': ('/api/cards/', '/api/async/cards/'),
+    'card_detail': ('/api/cards/{card}/', '/api/async/cards/{card}/'),
+    'dish_list': ('/api/dishes/', '/api/async/dishes/'),
+}
+
+
+def benchmark(name):
+    '''
+    Registers function as a benchmark; the function gets BenchmarkContext
+    and is called once per run, it can return number of requests it made
+    (one by default) for requests_per_second
+    '''
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def query_plan(name):
+    '''
+    Registers function returning a queryset, which plan is reported by
+    get_query_plans; evaluation of the queryset is also registered
+    as a benchmark (with 'query_' prefix)
+    '''
+    def decorator(func):
+        QUERY_PLANS[name] = func
+
+        def evaluate(context):
+            list(func())
+
+        benchmark('query_{}'.format(name))(evaluate)
+        return func
+    return decorator
+
+
+class BenchmarkContext():
+    '''
+    Shared state of the benchmarks - request factory and user used for
+    requests (authenticated, so menu pages are not served from the cache)
+    '''
+    def __init__(self, user=None):
+        self.factory = RequestFactory()
+        self.user = user or User.objects.order_by('pk').first()
+        self.large_cards = {}
+
+    def get(self, path, data=None, anonymous=False):
+        request = self.factory.get(path, data=data)
+        request.user = AnonymousUser() if anonymous else self.user
+        return request
+
+    def get_large_card(self, dishes=LARGE_CARD_DISHES):
+        '''
+        Returns card with given number of dishes (or all dishes, if there
+        are less) - one from the dataset or a new one, which is left in
+        the database for the next runs
+        '''
+        if dishes not in self.large_cards:
+            dishes = min(dishes, Dish.objects.count())
+            card = Card.objects.filter(dishes_count=dishes).first()
+            if card is None:
+                card = Card.objects.create(
+                    name=LARGE_CARD_NAME.format(dishes),
+                    description='Benchmark of rendering large cards',
+                )
+                card.dishes.add(*Dish.objects
+                    .order_by('pk')
+                    .values_list('pk', flat=True)[:dishes]
+                )
+            self.large_cards[dishes] = card
+        return self.large_cards[dishes]
+
+    def get_serializer_context(self):
+        return {'request': api_views.APIView().initialize_request(
+            self.get('/api/')
+        )}
+
+
+def measure(func, context):
+    '''
+    Runs the benchmark twice - first for wall time, requests per second,
+    number of queries and database time, then for peak memory allocated
+    by python (tracemalloc slows down allocations, so it would inflate
+    the times); returns dict with the measurements
+    '''
+    recorder = QueryRecorder()
+    started = perf_counter()
+    with recorder.record():
+        requests = func(context) or 1
+    wall_time = perf_counter() - started
+    tracemalloc.start()
+    try:
+        func(context)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'wall_time': wall_time,
+        'requests_per_second': requests / wall_time,
+        'queries': recorder.count,
+        'db_time': recorder.duration,
+        'peak_memory': peak_memory,
+    }
+
+def run_benchmarks(names=None, repeat=3, context=None):
+    '''
+    Runs given (all by default) benchmarks repeat times, returns list
+    of results with median, min and max of every measurement
+    '''
+    context = context or BenchmarkContext()
+    results = []
+    for name in names or BENCHMARKS:
+        runs = [measure(BENCHMARKS[name], context) for _ in range(repeat)]
+        result = {'name': name, 'runs': runs}
+        for key in runs[0]:
+            values = [run[key] for run in runs]
+            result[key] = {
+                'median': median(values), 'min': min(values),
+                'max': max(values),
+            }
+        results.append(result)
+    return results
+
+def get_query_plans(names=None):
+    '''
+    Returns dict of query plans (EXPLAIN ANALYZE on PostgreSQL) of given
+    (all by default) registered querysets - compare plans before and after
+    the indexes of migration 0007 to see which of them are used
+    '''
+    options = {}
+    if connection.vendor == 'postgresql':
+        options = {'analyze': True, 'buffers': True}
+    return {
+        name: QUERY_PLANS[name]().explain(**options).splitlines()
+        for name in names or QUERY_PLANS
+    }
+
+async def asgi_get(application, path, headers, delay):
+    '''
+    Sends GET request to the ASGI application as a slow client - sending
+    the request and reading every part of the response takes delay
+    seconds; returns status code of the response
+    '''
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'query_string': query.encode('utf-8'),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    status = None
+
+    async def receive():
+        await asyncio.sleep(delay)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        else:
+            await asyncio.sleep(delay)
+
+    await application(scope, receive, send)
+    return status
+
+async def run_clients(application, path, headers, clients, requests, delay):
+    '''
+    Sends requests with at most given number of concurrent clients,
+    returns list of (status, latency) and peak number of threads
+    '''
+    semaphore = asyncio.Semaphore(clients)
+    peak_threads = threading.active_count()
+
+    async def client():
+        nonlocal peak_threads
+        async with semaphore:
+            started = perf_counter()
+            status = await asgi_get(application, path, headers, delay)
+            peak_threads = max(peak_threads, threading.active_count())
+            return status, perf_counter() - started
+
+    results = await asyncio.gather(*[client() for _ in range(requests)])
+    return results, peak_threads
+
+def get_benchmark_host():
+    '''
+    Returns host allowed by ALLOWED_HOSTS setting used in ASGI benchmarks
+    '''
+    hosts = [
+        host for host in settings.ALLOWED_HOSTS
+        if host and host != '*' and not host.startswith('.')
+    ]
+    return hosts[0] if hosts else 'localhost'
+
+def run_asgi_benchmarks(names=None, clients=50, requests=200, delay=0.05,
+                        user=None):
+    '''
+    Runs given (all by default) ASGI benchmarks - the same requests are sent
+    to the sync and the async view through the ASGI handler by many slow
+    clients; returns list of results with throughput, latency and peak
+    number of threads of both views
+    '''
+    application = get_asgi_application()
+    user = user or User.objects.order_by('pk').first()
+    headers = [(b'host', get_benchmark_host().encode('utf-8'))]
+    if user is not None:
+        client = Client()
+        client.force_login(user)
+        cookie = '{}={}'.format(
+            settings.SESSION_COOKIE_NAME,
+            client.cookies[settings.SESSION_COOKIE_NAME].value,
+        )
+        headers.append((b'cookie', cookie.encode('utf-8')))
+    card = Card.objects.exclude_empty().order_by('pk').first()
+    results = []
+    for name in names or ASGI_BENCHMARKS:
+        result = {'name': name}
+        for kind, path in zip(['sync', 'async'], ASGI_BENCHMARKS[name]):
+            path = path.format(card=card.pk if card else 0)
+            started = perf_counter()
+            responses, peak_threads = async_to_sync(run_clients)(
+                application, path, headers, clients, requests, delay,
+            )
+            wall_time = perf_counter() - started
+            latencies = sorted(latency for _, latency in responses)
+            result[kind] = {
+                'path': path,
+                'wall_time': wall_time,
+                'requests_per_second': requests / wall_time,
+                'latency': {
+                    'median': median(latencies),
+                    'p95': latencies[int(0.95 * (len(latencies) - 1))],
+                    'max': latencies[-1],
+                },
+                'errors': sum(status != 200 for status, _ in responses),
+                'peak_threads': peak_threads,
+            }
+        results.append(result)
+    return results
+
+def run_pipeline_benchmark(clients=10, delay=0.2):
+    '''
+    Sends concurrent requests (by clients without delay) to an async view
+    awaiting delay seconds through the ASGI handler with all middleware;
+    concurrency is close to the number of clients if the requests run
+    in parallel and 1 if they are serialized (e.g. by sync only middleware,
+    which Django runs in a single thread)
+    '''
+    with override_settings(ROOT_URLCONF='card.benchmark_urls'):
+        application = get_asgi_application()
+        headers = [(b'host', get_benchmark_host().encode('utf-8'))]
+        path = '/sleep/?delay={}'.format(delay)
+        started = perf_counter()
+        responses, peak_threads = async_to_sync(run_clients)(
+            application, path, headers, clients, clients, 0,
+        )
+        wall_time = perf_counter() - started
+    return {
+        'clients': clients,
+        'delay': delay,
+        'wall_time': wall_time,
+        'concurrency': clients * delay / wall_time,
+        'errors': sum(status != 200 for status, _ in responses),
+        'peak_threads': peak_threads,
+    }
+
+def get_dataset_info():
+    return {
+        'cards': Card.objects.count(),
+        'dishes': Dish.objects.count(),
+        'links': Dish.cards.through.objects.count(),
+        'users': User.objects.count(),
+    }
+
+
+@benchmark('card_list_view')
+def card_list_view(context):
+    request = context.get('/card/', {'order_by': '-dishes_count'})
+    views.CardListView.as_view()(request).render()
+
+
+@benchmark('card_list_view_search')
+def card_list_view_search(context):
+    request = context.get('/card/', {'q': 'grilled'})
+    views.CardListView.as_view()(request).render()
+
+
+@benchmark('card_api_list')
+def card_api_list(context):
+    request = context.get('/api/cards/', {'ordering': '-dishes_count'})
+    api_views.CardAPIList.as_view()(request).render()
+
+
+@benchmark('card_api_list_cursor')
+def card_api_list_cursor(context):
+    request = context.get('/api/cards/', {'cursor': ''})
+    api_views.CardAPIList.as_view()(request).render()
+
+
+@benchmark('card_api_list_anonymous')
+def card_api_list_anonymous(context):
+    request = context.get('/api/cards/', anonymous=True)
+    api_views.CardAPIList.as_view()(request).render()
+
+
+@benchmark('card_api_list_anonymous_all')
+def card_api_list_anonymous_all(context):
+    '''
+    All non-empty cards with their dishes read page by page (cursor
+    pagination) - the same payload as public_menu
+    '''
+    path = '/api/cards/?cursor=&ordering=name'
+    requests = 0
+    while path:
+        response = api_views.CardAPIList.as_view()(
+            context.get(path, anonymous=True)
+        )
+        response.render()
+        requests += 1
+        next_url = urlsplit(response.data['next'] or '')
+        path = next_url.query and '{}?{}'.format(
+            next_url.path, next_url.query
+        )
+    return requests
+
+
+@benchmark('public_menu')
+def public_menu(context):
+    '''
+    Builds the whole public menu (compare with card_api_list_anonymous_all)
+    '''
+    get_menu_cache().delete(
+        api_views.PUBLIC_MENU_KEY.format(get_menu_version())
+    )
+    request = context.get('/api/public/menu/', anonymous=True)
+    api_views.PublicMenuView.as_view()(request)
+
+
+@benchmark('public_menu_cached')
+def public_menu_cached(context):
+    request = context.get('/api/public/menu/', anonymous=True)
+    api_views.PublicMenuView.as_view()(request)
+
+
+@benchmark('dish_api_list')
+def dish_api_list(context):
+    request = context.get('/api/dishes/')
+    api_views.DishAPIList.as_view()(request).render()
+
+
+@benchmark('card_serializer')
+def card_serializer(context):
+    cards = Card.objects.order_by('pk').prefetch_related('dishes')[:50]
+    CardSerializer(
+        cards, many=True, context=context.get_serializer_context()
+    ).data
+
+
+@benchmark('dish_serializer')
+def dish_serializer(context):
+    dishes = Dish.objects.order_by('pk').prefetch_related('cards')[:50]
+    DishSerializer(
+        dishes, many=True, context=context.get_serializer_context()
+    ).data
+
+
+@benchmark('email_report')
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'
+)
+def email_report(context):
+    call_command('email_report', '--restart', stdout=StringIO())
+    mail.outbox = []
+
+
+@benchmark('card_detail_large')
+def card_detail_large(context):
+    '''
+    Renders dishes of a card with 500 dishes - all runs but the first
+    assemble rows cached by the previous runs
+    '''
+    render_card_html(context.get_large_card())
+
+
+@benchmark('card_detail_large_uncached')
+def card_detail_large_uncached(context):
+    caches = dict(settings.CACHES, template_fragments={
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    })
+    with override_settings(CACHES=caches):
+        render_card_html(context.get_large_card())
+
+
+def cold_start(entry_point):
+    '''
+    Starts the entry point in a fresh interpreter (see emenu.startup); only
+    wall time is measured, queries and memory are of this process
+    '''
+    def run(context):
+        run_entry_point(entry_point)
+    return run
+
+for entry_point in ENTRY_POINTS:
+    benchmark('cold_start_{}'.format(entry_point))(cold_start(entry_point))
+
+
+@query_plan('card_last_change_date_range')
+def card_last_change_date_range():
+    since = timezone.now() - timedelta(days=7)
+    return Card.objects\
+        .filter(last_change_date__gte=since)\
+        .order_by('last_change_date', 'pk')[:50]
+
+
+@query_plan('card_alph_name_ordering')
+def card_alph_name_ordering():
+    return Card.objects\
+        .annotate(alph_name=Lower('name'))\
+        .order_by('alph_name', 'pk')[:50]
+
+
+@query_plan('card_exclude_empty')
+def card_exclude_empty():
+    return Card.objects.exclude_empty().order_by('pk')[:50]
+
+
+@query_plan('dish_last_change_date_range')
+def dish_last_change_date_range():
+    since = timezone.now() - timedelta(days=1)
+    return Dish.objects\
+        .filter(last_change_date__range=(since, timezone.now()))\
+        .order_by('last_change_date', 'pk')[:50]
@@ -0,0 +1,89 @@
+from hashlib import md5
+from time import time_ns
+
+from django.conf import settings
+from django.core.cache import caches
+
+from emenu.db_router import get_sticky_seconds, use_primary
+
+
+GLOBAL_VERSION_KEY = 'emenu:version'
+OBJECT_VERSION_KEY = 'emenu:version:{}:{}'
+PAGE_KEY = 'emenu:page:{}'
+
+
+def get_menu_cache():
+    return caches[getattr(settings, 'MENU_CACHE_ALIAS', 'default')]
+
+def get_version_key(model_name=None, pk=None):
+    '''
+    Returns cache key of the global menu version (without arguments)
+    or version of a single card/dish
+    '''
+    if model_name is None:
+        return GLOBAL_VERSION_KEY
+    return OBJECT_VERSION_KEY.format(model_name, pk)
+
+def get_versions(keys):
+    '''
+    Returns dict of versions for given version keys. Version is the time
+    (in nanoseconds) of the last change; missing versions (e.g. evicted
+    from the cache) are initialized with the current time, which only
+    invalidates content cached before.
+    '''
+    cache = get_menu_cache()
+    versions = cache.get_many(keys)
+    missing = {key: time_ns() for key in keys if key not in versions}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, timeout=None)
+        versions.update(cache.get_many(list(missing)))
+    return versions
+
+def get_menu_version():
+    return get_versions([GLOBAL_VERSION_KEY])[GLOBAL_VERSION_KEY]
+
+def get_object_version(model_name, pk):
+    key = get_version_key(model_name, pk)
+    return get_versions([key])[key]
+
+def use_primary_if_recent(*versions):
+    '''
+    Sends remaining reads of the request to the primary database if any
+    of given versions was moved forward less than
+    DATABASE_REPLICA_STICKY_SECONDS ago - replicas may not have the change
+    yet and content read from them would be cached (or validated) with
+    the new version
+    '''
+    threshold = time_ns() - get_sticky_seconds() * 10 ** 9
+    if any(version > threshold for version in versions):
+        use_primary()
+
+def bump_versions(card_ids=(), dish_ids=()):
+    '''
+    Moves global menu version and versions of given cards and dishes
+    forward, so all content cached with previous versions is stale.
+    Has to be called after the change is committed (see card.signals),
+    otherwise content rendered from old data could be cached with
+    the new version.
+    '''
+    cache = get_menu_cache()
+    keys = [GLOBAL_VERSION_KEY]
+    keys.extend(get_version_key('card', pk) for pk in set(card_ids))
+    keys.extend(get_version_key('dish', pk) for pk in set(dish_ids))
+    current = cache.get_many(keys)
+    now = time_ns()
+    cache.set_many(
+        {key: max(now, current.get(key, 0) + 1) for key in keys},
+        timeout=None,
+    )
+
+def get_page_cache_key(request, versions):
+    '''
+    Cache key of the rendered page - contains path, get parameters
+    (sorted, so their order does not matter) and versions of the content
+    '''
+    query = sorted(request.GET.lists())
+    raw_key = '{}?{}|{}'.format(request.path, query, versions)
+    digest = md5(raw_key.encode('utf-8')).hexdigest()
+    return PAGE_KEY.format(digest)
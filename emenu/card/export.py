@@ -0,0 +1,97 @@
+import csv
+from datetime import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Card, Dish
+
+
+DEFAULT_CHUNK_SIZE = 2000
+CARD_FIELDS = [
+    'id', 'name', 'description', 'creation_date', 'last_change_date',
+    'dishes_count',
+]
+DISH_FIELDS = [
+    'id', 'name', 'description', 'creation_date', 'last_change_date',
+    'price', 'preparation_time', 'is_vegetarian',
+]
+LINK_FIELDS = ['card_id', 'dish_id']
+EXPORT_FIELDS = ['type'] + list(dict.fromkeys(
+    CARD_FIELDS + DISH_FIELDS + LINK_FIELDS
+))
+
+
+class Echo():
+    '''
+    File-like object that returns written value instead of buffering it,
+    used to stream rows generated by csv.writer
+    '''
+    def write(self, value):
+        return value
+
+
+def parse_since(value):
+    '''
+    Parses date or datetime (ISO 8601) used as lower bound of the
+    last_change_date; naive values are in the current time zone
+    '''
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Invalid date: {}'.format(value))
+        since = datetime(date.year, date.month, date.day)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+def iter_rows(since=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Yields cards, dishes and card-dish links as dicts with 'type' key.
+    Rows are read as values with server-side cursors (iterator), so memory
+    usage does not depend on the size of the catalogue. With since only
+    cards and dishes changed since then are exported, along with all links
+    of those cards and dishes.
+    '''
+    cards = Card.objects.order_by('pk')
+    dishes = Dish.objects.order_by('pk')
+    links = Dish.cards.through.objects.order_by('pk')
+    if since is not None:
+        cards = cards.filter(last_change_date__gte=since)
+        dishes = dishes.filter(last_change_date__gte=since)
+        links = links.filter(
+            Q(card__last_change_date__gte=since)
+            | Q(dish__last_change_date__gte=since)
+        )
+    for row_type, queryset, fields in [('card', cards, CARD_FIELDS),
+                                       ('dish', dishes, DISH_FIELDS),
+                                       ('link', links, LINK_FIELDS)]:
+        for row in queryset.values(*fields).iterator(chunk_size=chunk_size):
+            yield dict(type=row_type, **row)
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+def iter_csv(rows):
+    '''
+    Yields csv lines (with header) - columns of all row types are combined,
+    values that do not apply to the row type are empty
+    '''
+    writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, datetime):
+                row[key] = value.isoformat()
+        yield writer.writerow(row)
+
+
+EXPORT_FORMATS = {
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'csv': (iter_csv, 'text/csv'),
+}
@@ -5,6 +5,7 @@ class CardListForm(forms.Form):
     '''
     Form_class for cardlist using django generic views
     '''
+    q = forms.CharField(required=False, max_length=100, label='search')
     name = forms.CharField(required=False, max_length=50, strip=False)
     creation_date__gte = forms.DateTimeField(
             required=False, label='creation date from')
@@ -20,6 +21,10 @@ class CardListForm(forms.Form):
         ('-alph_name', 'alphabetically by name (descending'),
         ('dishes_count', 'by number of dishes (ascending)'),
         ('-dishes_count', 'by number of dishes (descending)'),
+        ('creation_date', 'by creation date (ascending)'),
+        ('-creation_date', 'by creation date (descending)'),
+        ('last_change_date', 'by date of last change (ascending)'),
+        ('-last_change_date', 'by date of last change (descending)'),
     ]
     order_by = forms.ChoiceField(required=False, choices=order_choices)
 
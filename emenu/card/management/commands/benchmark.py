@@ -0,0 +1,82 @@
+from datetime import datetime
+import json
+import platform
+
+import django
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from card.benchmarks import (ASGI_BENCHMARKS, BENCHMARKS, get_dataset_info,
+        get_query_plans, run_asgi_benchmarks, run_benchmarks,
+        run_pipeline_benchmark)
+
+
+class Command(BaseCommand):
+    help = '''Time key views, serializers and commands against the current '''\
+           '''database (see generate_catalogue) and write results as JSON'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*',
+            help='Benchmarks to run (all by default): {}'.format(
+                ', '.join(BENCHMARKS)
+            ),
+        )
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--output', help='Path of the output file')
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='Include plans of the key queries (see card.benchmarks)',
+        )
+        parser.add_argument(
+            '--clients', type=int, default=0,
+            help='Also compare sync and async views under ASGI with given '
+                 'number of concurrent slow clients and measure concurrency '
+                 'of requests awaiting in an async view: {}'.format(
+                     ', '.join(ASGI_BENCHMARKS)
+                 ),
+        )
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Number of requests sent to every view (with --clients)',
+        )
+        parser.add_argument(
+            '--delay', type=float, default=0.05,
+            help='Time (in seconds) slow client takes to send the request '
+                 'and read every part of the response (with --clients)',
+        )
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(
+                'Unknown benchmarks: {}'.format(', '.join(sorted(unknown)))
+            )
+        report = {
+            'date': datetime.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'dataset': get_dataset_info(),
+            'results': run_benchmarks(
+                options['names'], options['repeat'],
+            ),
+        }
+        if options['explain']:
+            report['plans'] = get_query_plans()
+        if options['clients']:
+            report['asgi'] = run_asgi_benchmarks(
+                clients=options['clients'], requests=options['requests'],
+                delay=options['delay'],
+            )
+            report['asgi_pipeline'] = run_pipeline_benchmark(
+                clients=options['clients'],
+            )
+        data = json.dumps(report, indent=2)
+        if options['output'] is None:
+            self.stdout.write(data)
+            return
+        with open(options['output'], 'w') as output:
+            output.write(data)
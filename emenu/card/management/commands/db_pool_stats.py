@@ -0,0 +1,14 @@
+import json
+
+from django.core.management import BaseCommand
+
+from emenu.db_pool.stats import get_stats
+
+
+class Command(BaseCommand):
+    help = '''Show database connection settings, pool stats of this '''\
+           '''process and connections of all processes (by role and '''\
+           '''state) seen by the database server'''
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(get_stats(server=True), indent=2))
@@ -1,94 +1,90 @@
-from datetime import timedelta, datetime
+from smtplib import SMTPException
+from time import monotonic
 
-from django.contrib.auth.models import User
-from django.core.mail import send_mass_mail
-from django.core.management import BaseCommand
-from django.utils.timezone import now
+from django.core.mail import get_connection
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
 
-from card.models import Dish
-
-
-EMAIL_NO_CHANGES_TEMPLATE = '''
-Good morning!
-
-We would like to report there have been no changes to the dishes in eMenu
-
-Have a nice day,
-eMenu
-'''
-EMAIL_REPORT_TEMPLATE = '''
-Good morning!
-
-Here is the list of dishes changed yesterday: 
-
-{}
-
-Have a nice day,
-eMenu
-'''
-EMAIL_FROM = 'admin@emenu.com'
-
-
-def get_boundry_dates():
-    '''
-    Return two boundry dates, to filter queryset where datetime field
-    contains yesterday date.
-    '''
-    current = now()
-    today_kwargs = {i: getattr(current, i) for i in ['year', 'month', 'day',]}
-    today_kwargs.update({'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0})
-    today = datetime(**today_kwargs)
-    yesterday = today - timedelta(days=1)
-    return yesterday, today
-
-def generate_user_emails(user_qs=None):
-    '''
-    Return generator containing users' emails in str format.
-    '''
-    if user_qs is None:
-        user_qs = User.objects.exclude(email='')
-    return (str(user.email) for user in user_qs)
-
-def get_dish_report_line(dish):
-    '''
-    Return line for specific dish to be included in report
-    '''
-    cards = dish.cards.all()
-    cards_str = ', '.join((str(card) for card in cards))
-    if len(cards) > 1:
-        suffix = 'found on menu cards: {}'.format(cards_str)
-    elif len(cards) == 1:
-        suffix = 'found on menu card: {}'.format(cards_str)
-    else:
-        suffix = 'not currently found on any menu cards'
-    line = '{} {}\nCurrent description: {}\n'
-    return line.format(dish, suffix, dish.description)
+from card.models import EmailReportProgress
+from card.reports import (get_boundry_dates, get_report_message,
+        iter_recipient_batches, send_batch)
+from emenu.db_router import use_replicas
 
 
 class Command(BaseCommand):
     help = '''Send e-mail to all users with a list of dishes '''\
-           '''that were changed or added yesterday'''
+           '''that were changed or added yesterday; interrupted run '''\
+           '''is resumed from the last sent batch'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--retries', type=int, default=3)
+        parser.add_argument(
+            '--retry-delay', type=float, default=1.0,
+            help='Delay (in seconds) before the first retry, doubled '
+                 'before every next one',
+        )
+        parser.add_argument(
+            '--resume-from', type=int,
+            help='Send only to users with primary key greater than given',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore progress of previous run for the same day',
+        )
 
     def handle(self, *args, **options):
-        user_qs = User.objects.exclude(email='')
-        if len(user_qs) == 0:
-            self.stdout.write('No users to send report to')
-            return
+        # report only reads, so it is sent from replicas (if configured)
+        with use_replicas():
+            self.send_report(options)
 
+    def send_report(self, options):
         yesterday, today = get_boundry_dates()
-        dish_qs = Dish.objects\
-            .filter(last_change_date__range=(yesterday, today))\
-            .prefetch_related('cards')
-
-        subject = 'Daily eMenu report'
-        if len(dish_qs) > 0:
-            message = EMAIL_REPORT_TEMPLATE.format(
-                '\n'.join(get_dish_report_line(dish) for dish in dish_qs)
-            )
-        else:
-            message = EMAIL_NO_CHANGES_TEMPLATE
-
-        gen_datatuple = ((subject, message, EMAIL_FROM, [user])
-                         for user in generate_user_emails(user_qs))
-        send_mass_mail(tuple(tuple(i) for i in gen_datatuple))
-        self.stdout.write('Email report send to users')
+        after_pk = options['resume_from']
+        if after_pk is None and not options['restart']:
+            # written by the previous run, replicas may not have it yet
+            after_pk = EmailReportProgress.objects\
+                .using(DEFAULT_DB_ALIAS)\
+                .filter(report_date=yesterday.date())\
+                .values_list('last_user_id', flat=True)\
+                .first()
+
+        message = get_report_message(yesterday, today)
+        batches = iter_recipient_batches(
+            after_pk, options['batch_size'], options['chunk_size'],
+        )
+        sent = 0
+        started = monotonic()
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        try:
+            for batch in batches:
+                try:
+                    sent += send_batch(
+                        connection, batch, message,
+                        options['retries'], options['retry_delay'],
+                    ) or 0
+                except (SMTPException, OSError) as exc:
+                    raise CommandError(
+                        'Sending failed ({}), {} messages sent; run again or '
+                        'use --resume-from {} to continue'.format(
+                            exc, sent, after_pk,
+                        )
+                    )
+                after_pk = batch[-1][0]
+                EmailReportProgress.objects.update_or_create(
+                    report_date=yesterday.date(),
+                    defaults={'last_user_id': after_pk},
+                )
+        finally:
+            connection.close()
+
+        if not sent:
+            self.stdout.write('No users to send report to')
+            return
+        elapsed = monotonic() - started
+        self.stdout.write(
+            'Email report send to {} users in {:.2f}s ({:.1f} messages/s)'\
+            .format(sent, elapsed, sent / elapsed if elapsed else sent)
+        )
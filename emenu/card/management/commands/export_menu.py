@@ -0,0 +1,38 @@
+from django.core.management import BaseCommand, CommandError
+
+from card.export import (DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, iter_rows,
+        parse_since)
+
+
+class Command(BaseCommand):
+    help = '''Stream all cards, dishes and card-dish links as NDJSON '''\
+           '''or CSV (to standard output or a file)'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=sorted(EXPORT_FORMATS), default='ndjson',
+        )
+        parser.add_argument(
+            '--since',
+            help='Export only rows changed since given date or datetime',
+        )
+        parser.add_argument('--output', help='Path of the output file')
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = parse_since(options['since'])
+            except ValueError as exc:
+                raise CommandError(str(exc))
+        iter_lines = EXPORT_FORMATS[options['format']][0]
+        lines = iter_lines(iter_rows(since, options['chunk_size']))
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as output:
+            output.writelines(lines)
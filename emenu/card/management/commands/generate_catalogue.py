@@ -0,0 +1,154 @@
+from decimal import Decimal
+from itertools import islice
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from card.cache import bump_versions
+from card.models import Card, ChangeLogEntry, Dish
+from card.signals import log_changes
+
+
+WORDS = [
+    'grilled', 'roasted', 'spicy', 'sweet', 'smoked', 'fresh', 'crispy',
+    'creamy', 'baked', 'braised', 'chicken', 'salmon', 'beef', 'tofu',
+    'mushroom', 'potato', 'tomato', 'garlic', 'lemon', 'pepper', 'cheese',
+    'soup', 'salad', 'pasta', 'risotto', 'curry', 'burger', 'pierogi',
+    'dumplings', 'pancakes', 'cake', 'sauce', 'with', 'and', 'served',
+]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+def get_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+class Command(BaseCommand):
+    help = '''Bulk generate synthetic catalogue (cards, dishes, links '''\
+           '''between them and users) for benchmarks'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=1000)
+        parser.add_argument('--dishes', type=int, default=50000)
+        parser.add_argument(
+            '--dishes-per-card', type=int, default=50,
+            help='Average number of dishes on a card (fan-out), '
+                 'actual number varies from 0 to twice the average',
+        )
+        parser.add_argument('--users', type=int, default=0)
+        parser.add_argument(
+            '--prefix', default='Synthetic',
+            help='Prefix of generated names, has to be unique for every run',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options['dishes_per_card'] > options['dishes']:
+            raise CommandError('--dishes-per-card cannot exceed --dishes')
+        prefix = options['prefix']
+        if Card.objects.filter(name__startswith=prefix).exists() \
+                or Dish.objects.filter(name__startswith=prefix).exists():
+            raise CommandError(
+                'Catalogue with prefix "{}" already exists'.format(prefix)
+            )
+        rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.timestamp = timezone.now()
+
+        with transaction.atomic():
+            card_ids = self.create_cards(rng, prefix, options['cards'])
+            dish_ids = self.create_dishes(rng, prefix, options['dishes'])
+            links = self.create_links(
+                rng, card_ids, dish_ids, options['dishes_per_card'],
+            )
+            Card.objects.filter(pk__in=card_ids).refresh_dishes_count()
+            self.create_users(prefix, options['users'])
+            transaction.on_commit(bump_versions)
+        self.stdout.write(
+            'Generated {} cards, {} dishes, {} links and {} users'.format(
+                len(card_ids), len(dish_ids), links, options['users'],
+            )
+        )
+
+    def log_changes(self, model, object_ids, card_ids=None):
+        action = ChangeLogEntry.CREATE if card_ids is None \
+            else ChangeLogEntry.ADD
+        log_changes(model, action, object_ids, card_ids, self.timestamp)
+
+    def create_cards(self, rng, prefix, count):
+        card_ids = []
+        for batch in batched(range(count), self.batch_size):
+            cards = Card.objects.bulk_create(
+                Card(
+                    name='{} card {}'.format(prefix, i),
+                    description=get_text(rng, rng.randint(5, 30)),
+                )
+                for i in batch
+            )
+            ids = [card.pk for card in cards]
+            self.log_changes(ChangeLogEntry.CARD, ids)
+            card_ids.extend(ids)
+        return card_ids
+
+    def create_dishes(self, rng, prefix, count):
+        dish_ids = []
+        for batch in batched(range(count), self.batch_size):
+            dishes = Dish.objects.bulk_create(
+                Dish(
+                    name='{} dish {}'.format(prefix, i),
+                    description=get_text(rng, rng.randint(5, 40)),
+                    price=Decimal(rng.randint(100, 20000)) / 100,
+                    preparation_time=rng.randint(1, 120),
+                    is_vegetarian=rng.random() < 0.3,
+                )
+                for i in batch
+            )
+            ids = [dish.pk for dish in dishes]
+            self.log_changes(ChangeLogEntry.DISH, ids)
+            dish_ids.extend(ids)
+        return dish_ids
+
+    def create_links(self, rng, card_ids, dish_ids, dishes_per_card):
+        through_model = Dish.cards.through
+        max_dishes = min(2 * dishes_per_card, len(dish_ids))
+        links = (
+            (dish_id, card_id)
+            for card_id in card_ids
+            for dish_id in rng.sample(dish_ids, rng.randint(0, max_dishes))
+        )
+        count = 0
+        for batch in batched(links, self.batch_size):
+            through_model.objects.bulk_create(
+                through_model(dish_id=dish_id, card_id=card_id)
+                for dish_id, card_id in batch
+            )
+            self.log_changes(
+                ChangeLogEntry.DISH,
+                [dish_id for dish_id, _ in batch],
+                [card_id for _, card_id in batch],
+            )
+            count += len(batch)
+        return count
+
+    def create_users(self, prefix, count):
+        password = make_password(None)
+        for batch in batched(range(count), self.batch_size):
+            User.objects.bulk_create(
+                User(
+                    username='{}_user_{}'.format(prefix.lower(), i),
+                    email='{}_user_{}@example.com'.format(prefix.lower(), i),
+                    password=password,
+                )
+                for i in batch
+            )
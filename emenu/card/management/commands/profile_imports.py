@@ -0,0 +1,44 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+
+from emenu.startup import ENTRY_POINTS, profile_entry_point
+
+
+class Command(BaseCommand):
+    help = '''Start entry points (web, worker, management command) in '''\
+           '''fresh interpreters with python -X importtime and write '''\
+           '''their slowest imports as JSON'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'entry_points', nargs='*',
+            help='Entry points to profile (all by default): {}'.format(
+                ', '.join(ENTRY_POINTS)
+            ),
+        )
+        parser.add_argument(
+            '--limit', type=int, default=20,
+            help='Number of the slowest imports reported',
+        )
+        parser.add_argument('--output', help='Path of the output file')
+
+    def handle(self, *args, **options):
+        unknown = set(options['entry_points']) - set(ENTRY_POINTS)
+        if unknown:
+            raise CommandError(
+                'Unknown entry points: {}'.format(', '.join(sorted(unknown)))
+            )
+        try:
+            report = {
+                name: profile_entry_point(name, options['limit'])
+                for name in options['entry_points'] or ENTRY_POINTS
+            }
+        except RuntimeError as exc:
+            raise CommandError(exc)
+        data = json.dumps(report, indent=2)
+        if options['output'] is None:
+            self.stdout.write(data)
+            return
+        with open(options['output'], 'w') as output:
+            output.write(data)
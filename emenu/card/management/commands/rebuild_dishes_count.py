@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from card.models import Card
+
+
+class Command(BaseCommand):
+    help = '''Recalculate denormalized Card.dishes_count from scratch '''\
+           '''(based on the Dish.cards relation)'''
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = Card.objects.all().refresh_dishes_count()
+        self.stdout.write('Dishes count rebuilt for {} cards'.format(updated))
@@ -0,0 +1,31 @@
+from django.core.management import BaseCommand
+
+from card.models import Card, MenuSnapshot
+from card.snapshots import build_snapshots
+
+
+class Command(BaseCommand):
+    help = '''Rebuild snapshots of given cards, by default of all cards '''\
+           '''with stale or missing snapshot (e.g. after migration)'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('card_ids', nargs='*', type=int)
+        parser.add_argument(
+            '--all', action='store_true', help='Rebuild all snapshots',
+        )
+
+    def handle(self, *args, **options):
+        card_ids = options['card_ids']
+        if not card_ids:
+            cards = Card.objects.all()
+            if not options['all']:
+                cards = cards.exclude(
+                    pk__in=MenuSnapshot.objects
+                        .filter(stale=False)
+                        .values('card_id')
+                )
+            card_ids = list(cards.values_list('pk', flat=True))
+        built = build_snapshots(card_ids)
+        self.stdout.write('Rebuilt {} of {} snapshots'.format(
+            built, len(card_ids),
+        ))
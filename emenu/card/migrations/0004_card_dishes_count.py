@@ -0,0 +1,33 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_dishes_count(apps, schema_editor):
+    Card = apps.get_model('card', 'Card')
+    Dish = apps.get_model('card', 'Dish')
+    count_qs = Dish.cards.through.objects\
+        .filter(card_id=OuterRef('pk'))\
+        .order_by()\
+        .values('card_id')\
+        .annotate(count=Count('pk'))\
+        .values('count')
+    Card.objects.update(dishes_count=Coalesce(Subquery(count_qs), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0003_auto_20210801_1426'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='card',
+            name='dishes_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(populate_dishes_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.5 on 2026-10-18 07:02
+
+from django.db import DatabaseError, migrations, transaction
+
+
+# Expressions match SQL generated by Django for icontains lookups
+# on PostgreSQL (UPPER("field"::text) LIKE UPPER(...)), so both
+# EmenuQuerySet.search and plain name__icontains filters use them
+TRIGRAM_INDEXES = [
+    ('card_card_name_trgm', 'card_card', 'name'),
+    ('card_card_description_trgm', 'card_card', 'description'),
+    ('card_dish_name_trgm', 'card_dish', 'name'),
+    ('card_dish_description_trgm', 'card_dish', 'description'),
+]
+
+
+def install_pg_trgm(schema_editor):
+    '''
+    Returns True if pg_trgm extension is installed in the database or was
+    installed now - it has to be available on the server and the user needs
+    CREATE privilege on the database (and superuser role for untrusted
+    extensions on PostgreSQL < 13)
+    '''
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone() is not None:
+            return True
+        cursor.execute(
+            "SELECT has_database_privilege("
+            "current_user, current_database(), 'CREATE') "
+            "FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        )
+        row = cursor.fetchone()
+        if row is None or not row[0]:
+            return False
+    try:
+        with transaction.atomic(using=connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError:
+        return False
+    return True
+
+def create_trigram_indexes(apps, schema_editor):
+    '''
+    Indexes are created only on PostgreSQL, if pg_trgm extension can be
+    used (search falls back to plain lookups otherwise)
+    '''
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    if not install_pg_trgm(schema_editor):
+        return
+    sql = 'CREATE INDEX IF NOT EXISTS {} ON {} '\
+          'USING gin ((UPPER({}::text)) gin_trgm_ops)'
+    for index_name, table_name, column_name in TRIGRAM_INDEXES:
+        schema_editor.execute(sql.format(index_name, table_name, column_name))
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name, table_name, column_name in TRIGRAM_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(index_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0004_card_dishes_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2.5 on 2026-10-18 09:30
+
+from django.db import migrations, models
+
+
+def populate_change_log(apps, schema_editor):
+    '''
+    Seeds the log with 'create' entries of existing cards and dishes (and
+    'add' entries of their links), so clients syncing from the start get
+    the whole catalogue; entries get last_change_date as timestamp
+    '''
+    Card = apps.get_model('card', 'Card')
+    Dish = apps.get_model('card', 'Dish')
+    ChangeLogEntry = apps.get_model('card', 'ChangeLogEntry')
+    entries = []
+    for model_name, model in [('card', Card), ('dish', Dish)]:
+        rows = model.objects.order_by('last_change_date', 'pk')\
+            .values_list('pk', 'last_change_date')
+        entries.extend(
+            ChangeLogEntry(
+                timestamp=timestamp, model=model_name, object_id=pk,
+                action='create',
+            )
+            for pk, timestamp in rows
+        )
+    links = Dish.cards.through.objects.order_by('pk')\
+        .values_list('dish_id', 'card_id', 'dish__last_change_date')
+    entries.extend(
+        ChangeLogEntry(
+            timestamp=timestamp, model='dish', object_id=dish_id,
+            action='add', card_id=card_id,
+        )
+        for dish_id, card_id, timestamp in links
+    )
+    ChangeLogEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0005_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(db_index=True, editable=False)),
+                ('model', models.CharField(choices=[('card', 'card'), ('dish', 'dish')], max_length=4)),
+                ('object_id', models.PositiveIntegerField()),
+                ('action', models.CharField(choices=[('create', 'create'), ('update', 'update'), ('delete', 'delete'), ('add', 'card added'), ('remove', 'card removed')], max_length=6)),
+                ('card_id', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'change log entries',
+            },
+        ),
+        migrations.RunPython(populate_change_log, migrations.RunPython.noop),
+    ]
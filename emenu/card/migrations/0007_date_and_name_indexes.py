@@ -0,0 +1,53 @@
+# Generated by Django 3.2.5 on 2026-10-18 10:45
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+    # indexes are built without blocking writes to the (large) tables,
+    # which cannot be done inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('card', '0006_changelogentry'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='card',
+            index=models.Index(fields=['creation_date', 'id'], name='card_creation_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='card',
+            index=models.Index(fields=['last_change_date', 'id'], name='card_last_change_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='card',
+            index=models.Index(django.db.models.functions.text.Lower('name'), django.db.models.expressions.F('id'), name='card_lower_name_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='dish',
+            index=models.Index(fields=['creation_date', 'id'], name='dish_creation_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='dish',
+            index=models.Index(fields=['last_change_date', 'id'], name='dish_last_change_date_idx'),
+        ),
+        # Dish.cards through table is created by Django (unique index on
+        # (dish_id, card_id) covers lookups by dish); (card_id, dish_id)
+        # allows index only scans of dishes of a card (Card.dishes,
+        # CardQuerySet.exclude_empty and refresh_dishes_count). Django's
+        # own index of card_id is kept although this one covers it: it is
+        # managed by Django as part of the foreign key (altering the field
+        # drops and recreates it), dropping it here would leave the schema
+        # different from the state of migrations.
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+            'card_dish_cards_card_dish_idx '
+            'ON card_dish_cards (card_id, dish_id)',
+            'DROP INDEX CONCURRENTLY IF EXISTS card_dish_cards_card_dish_idx',
+        ),
+    ]
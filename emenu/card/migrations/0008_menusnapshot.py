@@ -0,0 +1,27 @@
+# Generated by Django 3.2.5 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0007_date_and_name_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MenuSnapshot',
+            fields=[
+                ('card', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='card.card')),
+                ('version', models.PositiveIntegerField(default=0, editable=False)),
+                ('stale', models.BooleanField(default=True)),
+                ('is_empty', models.BooleanField(default=True)),
+                ('last_change_date', models.DateTimeField(blank=True, null=True)),
+                ('json', models.TextField(blank=True)),
+                ('html', models.TextField(blank=True)),
+                ('build_date', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
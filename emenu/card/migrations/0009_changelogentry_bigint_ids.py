@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0008_menusnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelogentry',
+            name='card_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='changelogentry',
+            name='object_id',
+            field=models.BigIntegerField(),
+        ),
+    ]
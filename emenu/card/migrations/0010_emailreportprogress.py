@@ -0,0 +1,24 @@
+# Generated by Django 3.2.5 on 2026-10-18 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('card', '0009_changelogentry_bigint_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailReportProgress',
+            fields=[
+                ('report_date', models.DateField(primary_key=True, serialize=False)),
+                ('last_user_id', models.BigIntegerField()),
+                ('update_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'email report progress',
+            },
+        ),
+    ]
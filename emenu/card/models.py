@@ -2,7 +2,10 @@ from decimal import Decimal
 
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import (Case, Count, Exists, F, IntegerField, OuterRef,
+        Q, Subquery, Value, When)
+from django.db.models.functions import Cast, Coalesce, Greatest, Lower
 from django.urls import reverse
 
 
@@ -24,6 +27,62 @@ def assert_text_field_length(obj, field_name='description'):
         raise ValidationError(message)
 
 
+_trigram_support = {}
+
+def has_trigram_support(using):
+    '''
+    Checks (once per process and database alias) if database can rank
+    search results by trigram similarity (PostgreSQL with pg_trgm extension)
+    '''
+    if using not in _trigram_support:
+        connection = connections[using]
+        supported = False
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+                )
+                supported = cursor.fetchone() is not None
+        _trigram_support[using] = supported
+    return _trigram_support[using]
+
+
+class EmenuQuerySet(models.QuerySet):
+    '''
+    Custom queryset with code shared by Card and Dish querysets
+    '''
+    def search(self, query):
+        '''
+        Returns objects which name or description contains the query
+        (case insensitive), annotated with integer 'search_rank'
+        (0 - 1000, higher is better). On PostgreSQL with pg_trgm the lookups
+        are backed by trigram GIN indexes (see migration 0005) and rank is
+        based on trigram similarity (matches in name weigh twice as much as
+        matches in description); otherwise exact and prefix matches of the
+        name rank highest, followed by other matches in name and description.
+        '''
+        queryset = self.filter(
+            Q(name__icontains=query) | Q(description__icontains=query)
+        )
+        if has_trigram_support(self.db):
+            from django.contrib.postgres.search import TrigramSimilarity
+
+            rank = Greatest(
+                TrigramSimilarity('name', query),
+                TrigramSimilarity('description', query) / Value(2.0),
+            ) * Value(1000.0)
+            rank = Cast(rank, IntegerField())
+        else:
+            rank = Case(
+                When(name__iexact=query, then=Value(1000)),
+                When(name__istartswith=query, then=Value(750)),
+                When(name__icontains=query, then=Value(500)),
+                default=Value(250),
+                output_field=IntegerField(),
+            )
+        return queryset.annotate(search_rank=rank)
+
+
 class EmenuModel(models.Model):
     '''
     Abstract model that contains common code for both Card and Dish models
@@ -36,6 +95,8 @@ class EmenuModel(models.Model):
     creation_date = models.DateTimeField(auto_now_add=True, editable=False)
     last_change_date = models.DateTimeField(auto_now=True, editable=False)
 
+    objects = EmenuQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
@@ -46,15 +107,83 @@ class EmenuModel(models.Model):
         class_name = self.__class__.__name__.lower()
         return reverse('{}-detail'.format(class_name), kwargs={'pk': self.pk})
 
-    def save(self, *args, **kwargs):
+    def assert_valid(self):
+        '''
+        Model-level checks run before every save; called directly by code
+        that writes objects without save() (e.g. bulk_create/bulk_update)
+        '''
         assert_text_field_length(self)
+
+    def save(self, *args, **kwargs):
+        self.assert_valid()
         super().save(*args, **kwargs)
 
 
+class CardQuerySet(EmenuQuerySet):
+    '''
+    Custom queryset for Card model
+    '''
+    def refresh_dishes_count(self):
+        '''
+        Recalculates denormalized dishes_count of cards in the queryset
+        from the Dish.cards through table. Rows of the cards are locked
+        (in order of pk, so concurrent refreshes do not deadlock) before
+        the UPDATE, which then counts links committed by transactions that
+        refreshed the same cards in the meantime - otherwise concurrent
+        changes of the same card could overwrite each other's count.
+        '''
+        through_model = Card.dishes.through
+        count_qs = through_model.objects\
+            .filter(card_id=OuterRef('pk'))\
+            .order_by()\
+            .values('card_id')\
+            .annotate(count=Count('pk'))\
+            .values('count')
+        locked_qs = self.select_for_update().order_by('pk')
+        with transaction.atomic(using=locked_qs.db):
+            list(locked_qs.values_list('pk', flat=True))
+            return self.update(dishes_count=Coalesce(Subquery(count_qs), 0))
+
+    def exclude_empty(self):
+        '''
+        Excludes cards with no dishes; uses EXISTS subquery instead
+        of a join, so rows are not duplicated and no DISTINCT is needed
+        '''
+        through_model = Card.dishes.through
+        return self.filter(Exists(
+            through_model.objects.filter(card_id=OuterRef('pk'))
+        ))
+
+
 class Card(EmenuModel):
     '''
     Model that corresponds to a single menu card.
+    dishes_count is a denormalized number of dishes on the card - it is
+    maintained by signal handlers (see card.signals) whenever Dish.cards
+    changes, so it can be used for ordering and filtering without a join
     '''
+    dishes_count = models.PositiveIntegerField(
+            default=0,
+            db_index=True,
+            editable=False,
+    )
+
+    objects = CardQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # date filters and ordering (primary key is the tie-breaker
+            # of the keyset pagination)
+            models.Index(
+                fields=['creation_date', 'id'], name='card_creation_date_idx',
+            ),
+            models.Index(
+                fields=['last_change_date', 'id'],
+                name='card_last_change_date_idx',
+            ),
+            # 'alph_name' ordering of CardListView
+            models.Index(Lower('name'), 'id', name='card_lower_name_idx'),
+        ]
 
 
 class Dish(EmenuModel):
@@ -82,12 +211,124 @@ class Dish(EmenuModel):
 
     class Meta:
         verbose_name_plural = 'dishes'
+        indexes = [
+            models.Index(
+                fields=['creation_date', 'id'], name='dish_creation_date_idx',
+            ),
+            models.Index(
+                fields=['last_change_date', 'id'],
+                name='dish_last_change_date_idx',
+            ),
+        ]
 
-    def save(self, *args, **kwargs):
+    def assert_valid(self):
         try:
             assert self.price >= Decimal(0)
         except AssertionError:
             msg = 'Price cannot be lower then 0.00'
             raise ValidationError(msg)
-        super().save(*args, **kwargs)
+        super().assert_valid()
+
+
 
+class ChangeLogEntry(models.Model):
+    '''
+    Append-only log of changes of cards, dishes and Dish.cards relation,
+    written by signal handlers (see card.signals). seq is monotonically
+    increasing and entries are committed in seq order (see log_changes in
+    card.signals), so clients can sync incrementally by asking for entries
+    with seq greater than the last one they have seen. For m2m changes
+    object_id is the dish and card_id the card; deleting a card or a dish
+    implicitly removes all its links.
+    '''
+    CARD = 'card'
+    DISH = 'dish'
+    MODEL_CHOICES = [(CARD, 'card'), (DISH, 'dish')]
+
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ADD = 'add'
+    REMOVE = 'remove'
+    ACTION_CHOICES = [
+        (CREATE, 'create'),
+        (UPDATE, 'update'),
+        (DELETE, 'delete'),
+        (ADD, 'card added'),
+        (REMOVE, 'card removed'),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    timestamp = models.DateTimeField(db_index=True, editable=False)
+    model = models.CharField(max_length=4, choices=MODEL_CHOICES)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    card_id = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'change log entries'
+
+    def __str__(self):
+        return '#{} {} {} {}'.format(
+            self.seq, self.action, self.model, self.object_id,
+        )
+
+
+class MenuSnapshotQuerySet(models.QuerySet):
+    def mark_stale(self, card_ids):
+        '''
+        Marks snapshots of given cards stale and moves their version forward,
+        so snapshots being built from older data are not saved as fresh
+        '''
+        return self.filter(card_id__in=card_ids).update(
+            stale=True, version=F('version') + 1,
+        )
+
+
+class MenuSnapshot(models.Model):
+    '''
+    Denormalized, fully rendered card: JSON of the card detail api view
+    (urls start with card.snapshots.SNAPSHOT_URL_PREFIX) and HTML of the
+    card and its dishes. Snapshots are marked stale by signal handlers
+    on every change of the card, its dishes or Dish.cards and rebuilt
+    asynchronously (see card.snapshots); stale snapshots are never served.
+    '''
+    card = models.OneToOneField(
+            Card,
+            on_delete=models.CASCADE,
+            primary_key=True,
+            related_name='snapshot',
+    )
+    version = models.PositiveIntegerField(default=0, editable=False)
+    stale = models.BooleanField(default=True)
+    is_empty = models.BooleanField(default=True)
+    last_change_date = models.DateTimeField(null=True, blank=True)
+    json = models.TextField(blank=True)
+    html = models.TextField(blank=True)
+    build_date = models.DateTimeField(null=True, blank=True)
+
+    objects = MenuSnapshotQuerySet.as_manager()
+
+    def __str__(self):
+        return 'Snapshot of card {} (version {})'.format(
+            self.card_id, self.version,
+        )
+
+
+class EmailReportProgress(models.Model):
+    '''
+    Resume point of the email_report command - primary key of the last user
+    of the last sent batch of the report for given day, so an interrupted
+    run (e.g. the process was killed) continues where it stopped
+    '''
+    report_date = models.DateField(primary_key=True)
+    last_user_id = models.BigIntegerField()
+    update_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'email report progress'
+
+    def __str__(self):
+        return 'Report of {} sent up to user {}'.format(
+            self.report_date, self.last_user_id,
+        )
@@ -0,0 +1,234 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class InvalidCursor(Exception):
+    '''
+    Raised when the cursor provided by the client cannot be decoded
+    or does not match the current ordering
+    '''
+
+
+def cursor_value_default(value):
+    '''
+    JSON "default" function for values of the ordering fields; unlike
+    DjangoJSONEncoder it keeps microseconds, which are needed to point
+    at the exact row
+    '''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('Cannot use {!r} in cursor'.format(value))
+
+def encode_cursor(position, reverse=False):
+    '''
+    Encodes position (list of values of the ordering fields) and direction
+    into an url safe string
+    '''
+    payload = {'p': position, 'r': int(reverse)}
+    data = json.dumps(
+        payload, default=cursor_value_default, separators=(',', ':'),
+    )
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Reverse of encode_cursor, returns tuple of position and direction
+    '''
+    try:
+        data = urlsafe_b64decode(cursor.encode('ascii'))
+        payload = json.loads(data.decode('utf-8'))
+        return list(payload['p']), bool(payload['r'])
+    except (BinasciiError, KeyError, TypeError, UnicodeError, ValueError):
+        raise InvalidCursor('Invalid cursor')
+
+def split_ordering(field):
+    '''
+    Splits single order_by entry into field name and descending flag
+    '''
+    if field.startswith('-'):
+        return field[1:], True
+    return field, False
+
+
+class KeysetPage():
+    '''
+    Single page returned by KeysetPaginator; mimics the parts of
+    django.core.paginator.Page used by templates
+    '''
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator():
+    '''
+    Cursor (keyset) paginator - instead of OFFSET it filters the queryset
+    with "(ordering fields, id) > (values of last row)" condition, so every
+    page costs the same no matter how deep the client is.
+
+    Ordering is taken from the queryset itself (queryset.order_by(...) has
+    to be called before) and primary key is always appended as tie-breaker,
+    so the order is stable even if the ordering field is not unique.
+    Fields used for ordering have to be available as attributes of returned
+    objects (model fields or annotations).
+    '''
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = self.get_ordering(queryset)
+
+    @staticmethod
+    def get_ordering(queryset):
+        ordering = [
+            field for field in queryset.query.order_by
+            if isinstance(field, str)
+        ]
+        if len(ordering) != len(queryset.query.order_by):
+            raise ValueError('Keyset pagination supports only field ordering')
+        field_names = [split_ordering(field)[0] for field in ordering]
+        if not field_names or field_names[-1] not in ('pk', 'id'):
+            descending = split_ordering(ordering[-1])[1] if ordering else False
+            ordering.append('-pk' if descending else 'pk')
+        return ordering
+
+    def get_position(self, obj):
+        return [
+            getattr(obj, split_ordering(field)[0])
+            for field in self.ordering
+        ]
+
+    def get_keyset_filter(self, position, reverse):
+        '''
+        Builds Q object equal to row comparison
+        (f1, f2, ..., pk) > (v1, v2, ..., pk_value)
+        with direction of every comparison taken from the ordering
+        '''
+        keyset_filter = Q()
+        equal_kwargs = {}
+        for field, value in zip(self.ordering, position):
+            name, descending = split_ordering(field)
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition = Q(**equal_kwargs) & Q(**{
+                '{}__{}'.format(name, lookup): value
+            })
+            keyset_filter |= condition
+            equal_kwargs[name] = value
+        return keyset_filter
+
+    def page(self, cursor=None):
+        '''
+        Returns KeysetPage for given cursor (first page if cursor is None),
+        raises InvalidCursor if cursor cannot be used
+        '''
+        position, reverse = None, False
+        if cursor:
+            position, reverse = decode_cursor(cursor)
+            if len(position) != len(self.ordering):
+                raise InvalidCursor('Invalid cursor')
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [
+                name if descending else '-{}'.format(name)
+                for name, descending in map(split_ordering, ordering)
+            ]
+        queryset = self.queryset.order_by(*ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(
+                    self.get_keyset_filter(position, reverse)
+                )
+            except (TypeError, ValueError, ValidationError):
+                raise InvalidCursor('Invalid cursor')
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if reverse:
+            object_list.reverse()
+            has_next, has_previous = position is not None, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        next_cursor = previous_cursor = None
+        if object_list and has_next:
+            next_cursor = encode_cursor(self.get_position(object_list[-1]))
+        if object_list and has_previous:
+            previous_cursor = encode_cursor(
+                self.get_position(object_list[0]), reverse=True
+            )
+        return KeysetPage(object_list, next_cursor, previous_cursor)
+
+
+class EmenuAPIPagination(PageNumberPagination):
+    '''
+    Page number pagination (default for the REST API) with opt-in cursor
+    mode: if 'cursor' get parameter is present (empty value means first page)
+    results are paginated with KeysetPaginator, which skips the COUNT query
+    and OFFSET scans. Ordering set by OrderingFilter is kept and primary key
+    is added to it as tie-breaker.
+    '''
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_page = None
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.display_page_controls = False
+        paginator = KeysetPaginator(queryset, self.get_page_size(request))
+        cursor = request.query_params[self.cursor_query_param]
+        try:
+            self.keyset_page = paginator.page(cursor)
+        except InvalidCursor:
+            raise NotFound(self.invalid_cursor_message)
+        return self.keyset_page.object_list
+
+    def get_cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if self.keyset_page is None:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_cursor_link(self.keyset_page.next_cursor)),
+            ('previous', self.get_cursor_link(
+                self.keyset_page.previous_cursor
+            )),
+            ('results', data),
+        ]))
@@ -0,0 +1,61 @@
+from django.utils import timezone
+import orjson
+
+from .models import Card, Dish
+
+
+PUBLIC_CARD_FIELDS = [
+    'id', 'name', 'description', 'creation_date', 'last_change_date',
+    'dishes_count',
+]
+PUBLIC_DISH_FIELDS = [
+    'id', 'name', 'description', 'creation_date', 'last_change_date',
+    'price', 'preparation_time', 'is_vegetarian',
+]
+DATE_FIELDS = ['creation_date', 'last_change_date']
+# datetimes in the same format as in django-rest ('Z' instead of '+00:00')
+JSON_OPTIONS = orjson.OPT_UTC_Z
+
+
+def localize_dates(row):
+    '''
+    Converts dates of the row to the current time zone (as django-rest does)
+    '''
+    for field in DATE_FIELDS:
+        row[field] = timezone.localtime(row[field])
+    return row
+
+def get_public_menu():
+    '''
+    Returns list of non-empty cards (ordered by name) with their dishes
+    embedded, read with two values queries: cards and all card-dish pairs
+    joined with dishes. Prices are strings and dates are in the current
+    time zone, as in the serializers.
+    '''
+    cards = [
+        localize_dates(card) for card in Card.objects
+            .exclude_empty()
+            .order_by('name', 'pk')
+            .values(*PUBLIC_CARD_FIELDS)
+    ]
+    dishes_of_cards = {card['id']: [] for card in cards}
+    dish_fields = ['dish__{}'.format(field) for field in PUBLIC_DISH_FIELDS]
+    pairs = Dish.cards.through.objects\
+        .order_by('card_id', 'dish__name', 'dish_id')\
+        .values_list('card_id', *dish_fields)
+    dishes = {}
+    for card_id, *values in pairs:
+        if card_id not in dishes_of_cards:
+            continue
+        dish = dishes.get(values[0])
+        if dish is None:
+            dish = localize_dates(dict(zip(PUBLIC_DISH_FIELDS, values)))
+            dish['price'] = str(dish['price'])
+            dishes[dish['id']] = dish
+        dishes_of_cards[card_id].append(dish)
+    for card in cards:
+        card['dishes'] = dishes_of_cards[card['id']]
+    return cards
+
+def dumps(data):
+    return orjson.dumps(data, option=JSON_OPTIONS)
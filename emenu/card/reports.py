@@ -0,0 +1,200 @@
+from datetime import date, datetime, timedelta
+from smtplib import SMTPException
+from time import sleep
+
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage
+from django.utils.timezone import now
+
+from .cache import get_menu_cache
+from .models import ChangeLogEntry, Dish
+
+
+EMAIL_NO_CHANGES_TEMPLATE = '''
+Good morning!
+
+We would like to report there have been no changes to the dishes in eMenu
+
+Have a nice day,
+eMenu
+'''
+EMAIL_REPORT_TEMPLATE = '''
+Good morning!
+
+Here is the list of dishes changed yesterday: 
+
+{}
+
+Have a nice day,
+eMenu
+'''
+EMAIL_FROM = 'admin@emenu.com'
+EMAIL_SUBJECT = 'Daily eMenu report'
+REPORT_KEY = 'emenu:email_report:{}:{}'
+REPORT_TIMEOUT = 2 * 24 * 60 * 60
+# recipient claimed by a delivery, which did not send the message yet
+RECIPIENT_PENDING = 'pending'
+RECIPIENT_SENT = 'sent'
+CLAIM_TIMEOUT = 15 * 60
+
+
+def get_boundry_dates():
+    '''
+    Return two boundry dates, to filter queryset where datetime field
+    contains yesterday date.
+    '''
+    current = now()
+    today_kwargs = {i: getattr(current, i) for i in ['year', 'month', 'day',]}
+    today_kwargs.update({'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0})
+    today = datetime(**today_kwargs)
+    yesterday = today - timedelta(days=1)
+    return yesterday, today
+
+def iter_recipient_batches(after_pk=None, batch_size=100,
+                           chunk_size=2000):
+    '''
+    Yields lists (up to batch_size long) of (pk, email) tuples of users
+    with e-mail, ordered by pk and starting after after_pk; users are
+    read with server-side cursor, so they are never loaded all at once
+    '''
+    user_qs = User.objects.exclude(email='').order_by('pk')
+    if after_pk is not None:
+        user_qs = user_qs.filter(pk__gt=after_pk)
+    batch = []
+    for recipient in user_qs.values_list('pk', 'email')\
+            .iterator(chunk_size=chunk_size):
+        batch.append(recipient)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def get_dish_report_line(dish):
+    '''
+    Return line for specific dish to be included in report
+    '''
+    cards = dish.cards.all()
+    cards_str = ', '.join((str(card) for card in cards))
+    if len(cards) > 1:
+        suffix = 'found on menu cards: {}'.format(cards_str)
+    elif len(cards) == 1:
+        suffix = 'found on menu card: {}'.format(cards_str)
+    else:
+        suffix = 'not currently found on any menu cards'
+    line = '{} {}\nCurrent description: {}\n'
+    return line.format(dish, suffix, dish.description)
+
+
+def get_report_message(yesterday, today):
+    '''
+    Returns body of the report of dishes created or changed (including
+    changes of their cards) in given range, based on the change log
+    '''
+    changed_ids = ChangeLogEntry.objects\
+        .filter(model=ChangeLogEntry.DISH, timestamp__range=(yesterday, today))\
+        .exclude(action=ChangeLogEntry.DELETE)\
+        .values('object_id')
+    dish_qs = Dish.objects\
+        .filter(pk__in=changed_ids)\
+        .order_by('name')\
+        .prefetch_related('cards')
+    lines = [get_dish_report_line(dish) for dish in dish_qs]
+    if lines:
+        return EMAIL_REPORT_TEMPLATE.format('\n'.join(lines))
+    return EMAIL_NO_CHANGES_TEMPLATE
+
+def send_batch(connection, batch, message, retries=3, retry_delay=1.0,
+               on_sent=None):
+    '''
+    Sends the message to every recipient of the batch over the given
+    (open) connection, one by one, and calls on_sent(pk, email) after
+    the message was accepted; on SMTP or network error connection is
+    reopened and the failed message is retried, after the last retry
+    the error is raised. Returns number of sent messages.
+    '''
+    sent = 0
+    for pk, email in batch:
+        email_message = EmailMessage(EMAIL_SUBJECT, message, EMAIL_FROM,
+                                     [email])
+        for attempt in range(retries + 1):
+            try:
+                if attempt:
+                    connection.open()
+                connection.send_messages([email_message])
+                break
+            except (SMTPException, OSError):
+                if attempt == retries:
+                    raise
+                connection.close()
+                sleep(retry_delay * 2 ** attempt)
+        sent += 1
+        if on_sent is not None:
+            on_sent(pk, email)
+    return sent
+
+def get_report_message_cached(report_date):
+    '''
+    Returns body of the report for given day (ISO date), built once and
+    shared by all delivery subtasks through the cache
+    '''
+    cache = get_menu_cache()
+    key = REPORT_KEY.format(report_date, 'message')
+    message = cache.get(key)
+    if message is None:
+        yesterday = datetime.combine(date.fromisoformat(report_date),
+                                     datetime.min.time())
+        message = get_report_message(yesterday, yesterday + timedelta(days=1))
+        cache.add(key, message, timeout=REPORT_TIMEOUT)
+        message = cache.get(key, message)
+    return message
+
+def get_recipient_key(report_date, pk):
+    return REPORT_KEY.format(report_date, 'sent:{}'.format(pk))
+
+def claim_recipients(report_date, batch):
+    '''
+    Returns two lists of recipients of the batch - claimed ones, which did
+    not get the report for given day yet, and ones claimed by another
+    delivery, which did not send them the report yet. cache.add of the
+    idempotency key (report day, user) is atomic, so every recipient can be
+    claimed only once; the claim is pending until mark_recipient_sent and
+    expires after CLAIM_TIMEOUT, so recipients of a worker which died
+    after the claim can be claimed again.
+    '''
+    cache = get_menu_cache()
+    claimed, pending = [], []
+    for pk, email in batch:
+        key = get_recipient_key(report_date, pk)
+        if cache.add(key, RECIPIENT_PENDING, timeout=CLAIM_TIMEOUT):
+            claimed.append((pk, email))
+        elif cache.get(key) != RECIPIENT_SENT:
+            pending.append((pk, email))
+    return claimed, pending
+
+def mark_recipient_sent(report_date, pk):
+    get_menu_cache().set(
+        get_recipient_key(report_date, pk), RECIPIENT_SENT,
+        timeout=REPORT_TIMEOUT,
+    )
+
+def release_recipients(report_date, batch):
+    get_menu_cache().delete_many([
+        get_recipient_key(report_date, pk) for pk, _ in batch
+    ])
+
+def add_report_progress(report_date, **counters):
+    cache = get_menu_cache()
+    for name, value in counters.items():
+        key = REPORT_KEY.format(report_date, name)
+        cache.add(key, 0, timeout=REPORT_TIMEOUT)
+        cache.incr(key, value)
+
+def get_report_progress(report_date):
+    '''
+    Returns counters of the report delivery for given day (ISO date)
+    '''
+    names = ['recipients', 'sent', 'skipped']
+    keys = {REPORT_KEY.format(report_date, name): name for name in names}
+    values = get_menu_cache().get_many(list(keys))
+    return {name: values.get(key, 0) for key, name in keys.items()}
@@ -1,10 +1,228 @@
+from collections.abc import Mapping
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils import timezone
 from rest_framework import serializers
 
 from card.models import Card, Dish
+from card.signals import dishes_bulk_changed, lock_change_log
+
+
+LINKS_QUERY_PARAM = 'links'
+URL_TEMPLATE_PLACEHOLDER = 9876543210123456789
+
+
+class TemplatedURLMixin():
+    '''
+    Builds urls from a template reversed once per request, view name and
+    format instead of calling reverse() for every related object - the
+    lookup value is only put between the prefix and suffix of the template
+    '''
+    def get_url_template(self, view_name, request, format):
+        templates = self.context.setdefault('_url_templates', {})
+        key = (view_name, format)
+        if key not in templates:
+            url = self.reverse(
+                view_name,
+                kwargs={self.lookup_url_kwarg: URL_TEMPLATE_PLACEHOLDER},
+                request=request,
+                format=format,
+            )
+            prefix, _, suffix = url.rpartition(str(URL_TEMPLATE_PLACEHOLDER))
+            templates[key] = (prefix, suffix)
+        return templates[key]
+
+    def get_url(self, obj, view_name, request, format):
+        if hasattr(obj, 'pk') and obj.pk in (None, ''):
+            return None
+        prefix, suffix = self.get_url_template(view_name, request, format)
+        return '{}{}{}'.format(prefix, getattr(obj, self.lookup_field), suffix)
+
+
+class TemplatedHyperlinkedRelatedField(TemplatedURLMixin,
+        serializers.HyperlinkedRelatedField):
+    pass
+
+
+class TemplatedHyperlinkedIdentityField(TemplatedURLMixin,
+        serializers.HyperlinkedIdentityField):
+    pass
+
+
+class EmenuHyperlinkedModelSerializer(serializers.HyperlinkedModelSerializer):
+    '''
+    Hyperlinked serializer with templated urls; with '?links=ids' related
+    objects are represented (and accepted) as plain primary keys
+    '''
+    serializer_related_field = TemplatedHyperlinkedRelatedField
+    serializer_url_field = TemplatedHyperlinkedIdentityField
+
+    def use_id_links(self):
+        request = self.context.get('request')
+        if request is None:
+            return False
+        return request.query_params.get(LINKS_QUERY_PARAM) == 'ids'
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.use_id_links():
+            return fields
+        for name, field in fields.items():
+            relation = getattr(field, 'child_relation', field)
+            if not isinstance(relation, serializers.HyperlinkedRelatedField):
+                continue
+            if isinstance(relation, serializers.HyperlinkedIdentityField):
+                continue
+            kwargs = {'many': relation is not field}
+            if field.read_only:
+                kwargs['read_only'] = True
+            else:
+                kwargs.update(
+                    queryset=relation.queryset,
+                    required=field.required,
+                )
+            fields[name] = serializers.PrimaryKeyRelatedField(**kwargs)
+        return fields
+
+
+class DishBulkListSerializer(serializers.ListSerializer):
+    '''
+    List serializer used for bulk writes of dishes (see DishAPIBulk).
+    Items with 'id' update dishes passed as instance, other items create
+    new dishes. Invalid items do not fail the whole list - their errors are
+    collected in item_errors (aligned with input, empty dict for valid item)
+    and only valid items are saved, unless save is called with atomic=True.
+    Dishes are written with bulk_create/bulk_update and Dish.cards with
+    batched inserts and deletes of the through table, so per-instance
+    checks of Dish.save are run with Dish.assert_valid and signal handlers
+    are replaced by single dishes_bulk_changed signal.
+    '''
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            message = self.error_messages['not_a_list'].format(
+                input_type=type(data).__name__
+            )
+            raise serializers.ValidationError(
+                {'non_field_errors': [message]}, code='not_a_list'
+            )
+        instances = {str(obj.pk): obj for obj in self.instance or []}
+        self.item_errors = []
+        ret = []
+        for item in data:
+            pk = item.get('id') if isinstance(item, Mapping) else None
+            instance = instances.get(str(pk))
+            attrs, errors = None, {}
+            if pk is not None and instance is None:
+                errors = {'id': ['Dish {} does not exist.'.format(pk)]}
+            else:
+                self.child.instance = instance
+                try:
+                    attrs = self.child.run_validation(item)
+                except serializers.ValidationError as exc:
+                    errors = exc.detail
+                finally:
+                    self.child.instance = None
+            ret.append((instance, attrs))
+            self.item_errors.append(errors)
+        return ret
+
+    def get_dishes(self):
+        '''
+        Returns list of (dish, cards) tuples with validated data assigned,
+        None for invalid items; cards is None if not provided
+        '''
+        dishes = []
+        names = set()
+        for index, (instance, attrs) in enumerate(self.validated_data):
+            if self.item_errors[index]:
+                dishes.append(None)
+                continue
+            attrs = dict(attrs)
+            cards = attrs.pop('cards', None)
+            dish = instance or Dish()
+            for attr, value in attrs.items():
+                setattr(dish, attr, value)
+            try:
+                dish.assert_valid()
+            except DjangoValidationError as exc:
+                self.item_errors[index] = {'non_field_errors': exc.messages}
+            if dish.name in names:
+                self.item_errors[index] = {
+                    'name': ['Dish with this name is repeated in the list.']
+                }
+            names.add(dish.name)
+            dishes.append(None if self.item_errors[index] else (dish, cards))
+        return dishes
+
+    def save_cards(self, dishes):
+        '''
+        Replaces Dish.cards of given dishes with batched delete and insert
+        of the through table rows, returns sets of added and removed
+        (dish_id, card_id) rows
+        '''
+        through_model = Dish.cards.through
+        dishes = [(dish, cards) for dish, cards in dishes if cards is not None]
+        existing = set(through_model.objects
+            .filter(dish_id__in=[dish.pk for dish, _ in dishes])
+            .values_list('dish_id', 'card_id')
+        )
+        wanted = {
+            (dish.pk, card.pk) for dish, cards in dishes for card in cards
+        }
+        removed = existing - wanted
+        if removed:
+            condition = Q()
+            for dish_id, card_id in removed:
+                condition |= Q(dish_id=dish_id, card_id=card_id)
+            through_model.objects.filter(condition).delete()
+        added = wanted - existing
+        through_model.objects.bulk_create([
+            through_model(dish_id=dish_id, card_id=card_id)
+            for dish_id, card_id in added
+        ])
+        return added, removed
+
+    def save(self, atomic=False):
+        '''
+        Writes valid items in a single transaction, returns list of saved
+        dishes (None for invalid items). With atomic=True nothing is saved
+        if any item is invalid (ValidationError with item_errors is raised).
+        '''
+        dishes = self.get_dishes()
+        if atomic and any(self.item_errors):
+            raise serializers.ValidationError(self.item_errors)
+        valid = [item for item in dishes if item is not None]
+        created = [dish for dish, _ in valid if dish.pk is None]
+        updated = [dish for dish, _ in valid if dish.pk is not None]
+        fields = {'last_change_date'}
+        for instance, attrs in self.validated_data:
+            if instance is not None and attrs is not None:
+                fields.update(attrs)
+        fields.discard('cards')
+        now = timezone.now()
+        for dish in updated:
+            dish.last_change_date = now
+        with transaction.atomic():
+            lock_change_log(router.db_for_write(Dish))
+            Dish.objects.bulk_create(created)
+            Dish.objects.bulk_update(updated, fields)
+            added, removed = self.save_cards(valid)
+            dishes_bulk_changed.send(
+                sender=Dish,
+                dish_ids=[dish.pk for dish, _ in valid],
+                card_ids={card_id for _, card_id in added | removed},
+                created_ids=[dish.pk for dish in created],
+                added_links=sorted(added),
+                removed_links=sorted(removed),
+            )
+        self.instance = [item and item[0] for item in dishes]
+        return self.instance
 
 
-class DishSerializer(serializers.HyperlinkedModelSerializer):
-    cards = serializers.HyperlinkedRelatedField(
+class DishSerializer(EmenuHyperlinkedModelSerializer):
+    cards = TemplatedHyperlinkedRelatedField(
         queryset=Card.objects.all(),
         many=True,
         view_name='card-detail'
@@ -25,10 +243,11 @@ class DishSerializer(serializers.HyperlinkedModelSerializer):
             'cards'
         ]
         extra_kwargs = {'cards': {'required': False}}
+        list_serializer_class = DishBulkListSerializer
 
 
-class CardSerializer(serializers.HyperlinkedModelSerializer):
-    dishes = serializers.HyperlinkedRelatedField(
+class CardSerializer(EmenuHyperlinkedModelSerializer):
+    dishes = TemplatedHyperlinkedRelatedField(
         queryset=Dish.objects.all(),
         many=True,
         view_name='dish-detail',
@@ -0,0 +1,214 @@
+from django.db import connections, router, transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+        pre_delete, pre_save)
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from .cache import bump_versions
+from .models import Card, ChangeLogEntry, Dish, MenuSnapshot
+from .snapshots import schedule_snapshot_rebuild
+
+
+# Sent (inside the transaction) after dishes were written or deleted in bulk,
+# bypassing save()/delete() signals; arguments: dish_ids - ids of affected
+# dishes, card_ids - ids of cards whose Dish.cards rows were added or removed,
+# created_ids and deleted_ids - ids of created and deleted dishes, added_links
+# and removed_links - lists of (dish_id, card_id) tuples of Dish.cards rows;
+# senders take lock_change_log before the writes
+dishes_bulk_changed = Signal()
+
+# key of the advisory lock serializing writes to the change log
+CHANGE_LOG_LOCK_ID = 4711
+
+
+def get_m2m_change_ids(instance, action, reverse, pk_set):
+    '''
+    Returns tuple of card ids and dish ids affected by the m2m change
+    of Dish.cards (or Card.dishes if reverse is True); on pre_clear
+    related ids are stored on the instance, to be returned on post_clear
+    '''
+    if action == 'pre_clear':
+        related_manager = instance.dishes if reverse else instance.cards
+        instance._cleared_ids = list(
+                related_manager.values_list('pk', flat=True)
+        )
+    if action in ('pre_clear', 'post_clear'):
+        pk_set = getattr(instance, '_cleared_ids', [])
+    pk_list = list(pk_set or [])
+    if reverse:
+        return [instance.pk], pk_list
+    return pk_list, [instance.pk]
+
+def lock_change_log(using):
+    '''
+    Takes the advisory lock serializing writers of the change log (on
+    PostgreSQL, inside of a transaction), held until the end of the
+    transaction. Writers take it before any row locks (rows they save or
+    delete, cards locked by refresh_dishes_count), so all transactions
+    take the locks in the same order and cannot deadlock.
+    '''
+    connection = connections[using]
+    if connection.vendor != 'postgresql' or not connection.in_atomic_block:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CHANGE_LOG_LOCK_ID])
+
+def log_changes(model, action, object_ids, card_ids=None, timestamp=None):
+    '''
+    Appends entries to the change log (see ChangeLogEntry), card_ids
+    (aligned with object_ids) are given only for m2m changes; timestamp
+    defaults to now. On PostgreSQL writers of the log are serialized by
+    an advisory lock held until the end of the transaction, so entries are
+    committed in seq order and clients reading entries after the last seen
+    seq cannot miss any (see lock_change_log).
+    '''
+    if not object_ids:
+        return
+    timestamp = timestamp or timezone.now()
+    card_ids = card_ids or [None] * len(object_ids)
+    using = router.db_for_write(ChangeLogEntry)
+    with transaction.atomic(using=using):
+        lock_change_log(using)
+        ChangeLogEntry.objects.using(using).bulk_create([
+            ChangeLogEntry(
+                timestamp=timestamp, model=model, action=action,
+                object_id=object_id, card_id=card_id,
+            )
+            for object_id, card_id in zip(object_ids, card_ids)
+        ])
+
+def bump_versions_on_commit(card_ids=(), dish_ids=()):
+    '''
+    Marks snapshots of given cards stale and schedules bump of the cache
+    versions (see card.cache) and rebuild of the snapshots (see
+    card.snapshots) after the current transaction is committed
+    '''
+    card_ids, dish_ids = list(card_ids), list(dish_ids)
+    transaction.on_commit(lambda: bump_versions(card_ids, dish_ids))
+    if card_ids:
+        MenuSnapshot.objects.mark_stale(card_ids)
+        transaction.on_commit(lambda: schedule_snapshot_rebuild(card_ids))
+
+
+@receiver(pre_save, sender=Card)
+@receiver(pre_save, sender=Dish)
+@receiver(pre_delete, sender=Card)
+@receiver(pre_delete, sender=Dish)
+def lock_change_log_before_write(sender, using, **kwargs):
+    lock_change_log(using)
+
+
+@receiver(m2m_changed, sender=Dish.cards.through)
+def update_dishes_count_on_m2m_change(sender, instance, action, reverse,
+                                      pk_set, using, **kwargs):
+    '''
+    Keeps Card.dishes_count in sync when Dish.cards (or Card.dishes)
+    changes and bumps cache versions of affected cards and dishes;
+    runs inside the transaction of the m2m change
+    '''
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        lock_change_log(using)
+    card_ids, dish_ids = get_m2m_change_ids(instance, action, reverse, pk_set)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if card_ids and dish_ids:
+        links = [(dish, card) for dish in dish_ids for card in card_ids]
+        log_changes(
+            ChangeLogEntry.DISH,
+            ChangeLogEntry.ADD if action == 'post_add'
+            else ChangeLogEntry.REMOVE,
+            [dish for dish, _ in links],
+            [card for _, card in links],
+        )
+        Card.objects.filter(pk__in=card_ids).refresh_dishes_count()
+        bump_versions_on_commit(card_ids, dish_ids)
+
+
+@receiver(post_save, sender=Card)
+def bump_versions_on_card_save(sender, instance, created, **kwargs):
+    bump_versions_on_commit(card_ids=[instance.pk])
+    log_changes(
+        ChangeLogEntry.CARD,
+        ChangeLogEntry.CREATE if created else ChangeLogEntry.UPDATE,
+        [instance.pk],
+    )
+
+
+@receiver(pre_delete, sender=Card)
+def remember_card_dishes(sender, instance, **kwargs):
+    instance._deleted_dish_ids = list(
+            instance.dishes.values_list('pk', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Card)
+def bump_versions_on_card_delete(sender, instance, **kwargs):
+    bump_versions_on_commit(
+            card_ids=[instance.pk],
+            dish_ids=getattr(instance, '_deleted_dish_ids', []),
+    )
+    log_changes(ChangeLogEntry.CARD, ChangeLogEntry.DELETE, [instance.pk])
+
+
+@receiver(post_save, sender=Dish)
+def bump_versions_on_dish_save(sender, instance, created, **kwargs):
+    card_ids = []
+    if not created:
+        card_ids = instance.cards.values_list('pk', flat=True)
+    bump_versions_on_commit(card_ids=card_ids, dish_ids=[instance.pk])
+    log_changes(
+        ChangeLogEntry.DISH,
+        ChangeLogEntry.CREATE if created else ChangeLogEntry.UPDATE,
+        [instance.pk],
+    )
+
+
+@receiver(pre_delete, sender=Dish)
+def remember_dish_cards(sender, instance, **kwargs):
+    '''
+    Rows of the through table are removed by cascade (without m2m_changed
+    signal), so cards of deleted dish are stored to be refreshed later
+    '''
+    instance._deleted_card_ids = list(
+            instance.cards.values_list('pk', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Dish)
+def update_dishes_count_on_dish_delete(sender, instance, **kwargs):
+    card_ids = getattr(instance, '_deleted_card_ids', [])
+    log_changes(ChangeLogEntry.DISH, ChangeLogEntry.DELETE, [instance.pk])
+    if card_ids:
+        Card.objects.filter(pk__in=card_ids).refresh_dishes_count()
+    bump_versions_on_commit(card_ids=card_ids, dish_ids=[instance.pk])
+
+
+@receiver(dishes_bulk_changed, sender=Dish)
+def update_dishes_count_on_bulk_change(sender, dish_ids, card_ids,
+                                       created_ids=(), deleted_ids=(),
+                                       added_links=(), removed_links=(),
+                                       **kwargs):
+    '''
+    Refreshes dishes_count of cards whose dishes were added or removed,
+    bumps cache versions of changed dishes and all their cards and
+    records the changes in the change log
+    '''
+    skipped_ids = set(created_ids) | set(deleted_ids)
+    updated_ids = [pk for pk in dish_ids if pk not in skipped_ids]
+    log_changes(ChangeLogEntry.DISH, ChangeLogEntry.CREATE, list(created_ids))
+    log_changes(ChangeLogEntry.DISH, ChangeLogEntry.UPDATE, updated_ids)
+    log_changes(ChangeLogEntry.DISH, ChangeLogEntry.DELETE, list(deleted_ids))
+    for action, links in [(ChangeLogEntry.ADD, added_links),
+                          (ChangeLogEntry.REMOVE, removed_links)]:
+        log_changes(
+            ChangeLogEntry.DISH, action,
+            [dish for dish, _ in links], [card for _, card in links],
+        )
+    card_ids = set(card_ids)
+    if card_ids:
+        Card.objects.filter(pk__in=card_ids).refresh_dishes_count()
+    card_ids.update(Dish.cards.through.objects
+            .filter(dish_id__in=dish_ids)
+            .values_list('card_id', flat=True)
+    )
+    bump_versions_on_commit(card_ids, dish_ids)
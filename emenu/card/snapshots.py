@@ -0,0 +1,144 @@
+import logging
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.template.loader import render_to_string
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.views import APIView
+
+from emenu.metrics import record_cache_lookup
+
+from .cache import (get_menu_cache, get_object_version,
+        use_primary_if_recent)
+from .models import Card, MenuSnapshot
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_HOST = 'menu-snapshot.invalid'
+SNAPSHOT_URL_PREFIX = 'http://{}/'.format(SNAPSHOT_HOST)
+PENDING_KEY = 'emenu:snapshot:pending:{}'
+# rebuild is scheduled again if the task did not start within this time
+PENDING_TIMEOUT = 5 * 60
+BATCH_SIZE = 100
+SNAPSHOT_TEMPLATE = 'card_detail_content.html'
+
+
+class SnapshotRequest(HttpRequest):
+    '''
+    Request used to render snapshots outside of a request (e.g. by
+    a worker) - absolute urls start with SNAPSHOT_URL_PREFIX, which
+    is replaced with the url of the actual request when served
+    '''
+    def get_host(self):
+        return SNAPSHOT_HOST
+
+
+def get_snapshot_context():
+    return {'request': APIView().initialize_request(SnapshotRequest())}
+
+def render_card_json(card, context):
+    # serializers import card.signals, which import this module
+    from .serializers import CardSerializer
+
+    data = CardSerializer(card, context=context).data
+    return JSONRenderer().render(data).decode('utf-8')
+
+def render_card_html(card):
+    return render_to_string(SNAPSHOT_TEMPLATE, {'object': card})
+
+def build_snapshots(card_ids, batch_size=BATCH_SIZE):
+    '''
+    Renders snapshots of given cards (in batches), returns number of
+    snapshots saved. Version of every snapshot is read before the card,
+    so if the card changes during the build (version moves forward)
+    the snapshot is not saved and stays stale until the next build.
+    '''
+    card_ids = sorted(set(card_ids))
+    get_menu_cache().delete_many([PENDING_KEY.format(pk) for pk in card_ids])
+    context = get_snapshot_context()
+    built = 0
+    for start in range(0, len(card_ids), batch_size):
+        batch = card_ids[start:start + batch_size]
+        existing = Card.objects\
+            .filter(pk__in=batch)\
+            .values_list('pk', flat=True)
+        MenuSnapshot.objects.bulk_create(
+            [MenuSnapshot(card_id=pk) for pk in existing],
+            ignore_conflicts=True,
+        )
+        versions = dict(MenuSnapshot.objects
+            .filter(card_id__in=batch)
+            .values_list('card_id', 'version')
+        )
+        cards = Card.objects.filter(pk__in=batch).prefetch_related('dishes')
+        for card in cards:
+            built += MenuSnapshot.objects\
+                .filter(card_id=card.pk, version=versions[card.pk])\
+                .update(
+                    stale=False,
+                    is_empty=not card.dishes.all(),
+                    last_change_date=card.last_change_date,
+                    json=render_card_json(card, context),
+                    html=render_card_html(card),
+                    build_date=timezone.now(),
+                )
+    return built
+
+def schedule_snapshot_rebuild(card_ids):
+    '''
+    Schedules rebuild of snapshots of given cards after MENU_SNAPSHOT_DELAY
+    seconds. Cards already waiting for a rebuild are skipped, so a burst
+    of edits is rebuilt by a single task. Failure to reach the broker
+    is only logged - the snapshots stay stale (and are not served).
+    '''
+    from kombu.exceptions import OperationalError
+    from emenu.tasks import rebuild_menu_snapshots
+
+    cache = get_menu_cache()
+    pending = [
+        pk for pk in sorted(set(card_ids))
+        if cache.add(PENDING_KEY.format(pk), True, timeout=PENDING_TIMEOUT)
+    ]
+    if not pending:
+        return
+    try:
+        rebuild_menu_snapshots.apply_async(
+            (pending,),
+            countdown=getattr(settings, 'MENU_SNAPSHOT_DELAY', 5),
+            retry=False,
+        )
+    except OperationalError as exc:
+        logger.warning(
+            'Could not schedule rebuild of menu snapshots: {}'.format(exc)
+        )
+
+def get_fresh_snapshot(card_id, fields, public=False):
+    '''
+    Returns snapshot of the card with given fields loaded (single primary
+    key lookup) or None if there is no fresh snapshot (rebuild of stale
+    one is scheduled); with public=True snapshots of empty cards are
+    not returned either. Snapshots of recently changed cards are read from
+    the primary database (see use_primary_if_recent).
+    '''
+    use_primary_if_recent(get_object_version('card', card_id))
+    snapshot = MenuSnapshot.objects\
+        .only('stale', 'is_empty', 'last_change_date', *fields)\
+        .filter(pk=card_id)\
+        .first()
+    if snapshot is not None and snapshot.stale:
+        schedule_snapshot_rebuild([card_id])
+        snapshot = None
+    record_cache_lookup('snapshot', snapshot is not None)
+    if snapshot is None or public and snapshot.is_empty:
+        return None
+    return snapshot
+
+def get_snapshot_json(snapshot, request):
+    '''
+    Returns JSON of the snapshot with absolute urls of the request
+    '''
+    return snapshot.json.replace(
+        SNAPSHOT_URL_PREFIX, request.build_absolute_uri('/'),
+    )
@@ -1,24 +1,89 @@
+import base64
 from copy import copy
 from datetime import datetime, timedelta
 from decimal import Decimal
+import gzip
+from importlib import import_module
+from io import StringIO
 from itertools import chain
 import json
+import os
+from pathlib import Path
 from pytz import timezone
+from smtplib import SMTPServerDisconnected
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import time_ns
+import tracemalloc
 from unittest import mock
 
+from asgiref.sync import sync_to_async
+import brotli
+from celery.exceptions import Retry
 from django.conf import settings
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import mail
+from django.core.management import CommandError, call_command
 from django.core.exceptions import ValidationError
-from django.db.models import Count
+from django.db import ProgrammingError, connection, connections, transaction
 from django.db.utils import DataError, IntegrityError
-from django.test import TestCase, RequestFactory
+from django.template import engines
+from django.template.loaders.cached import Loader as CachedLoader
+from django.templatetags.static import static
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from kombu.exceptions import OperationalError as KombuOperationalError
+from prometheus_client import REGISTRY
+from psycopg2 import extensions as psycopg2_extensions
+from rest_framework.reverse import reverse as drf_reverse
 
-from .models import Card, Dish
+from .benchmarks import (BenchmarkContext, measure, run_asgi_benchmarks,
+        run_pipeline_benchmark)
+from .cache import (bump_versions, get_menu_cache, get_menu_version,
+        get_object_version, get_version_key)
+from .models import (Card, ChangeLogEntry, Dish, EmailReportProgress,
+        MenuSnapshot, has_trigram_support)
+from .pagination import EmenuAPIPagination
+from .reports import (CLAIM_TIMEOUT, claim_recipients, get_boundry_dates,
+        get_report_message, get_report_progress, release_recipients)
+from .signals import CHANGE_LOG_LOCK_ID
+from .snapshots import (SNAPSHOT_URL_PREFIX, build_snapshots,
+        render_card_html, schedule_snapshot_rebuild)
 from card import views, api_views
+from emenu import tasks
+from emenu.celery import app as celery_app
+from emenu.db_pool import ConnectionPool, PoolTimeout, get_pool_stats
+from emenu.db_pool import pool as db_pool_module
+from emenu.db_pool.base import DatabaseWrapper as PooledDatabaseWrapper
+from emenu.db_router import STICKY_COOKIE_NAME, ReplicaRouter, use_replicas
+from emenu.metrics import get_registry as get_metrics_registry
+from emenu.metrics import start_worker_server
+from emenu.query_budget import (QueryBudgetExceeded, assert_query_budget,
+        get_query_shape)
+from emenu.startup import (get_package_times, parse_import_times,
+        run_entry_point)
+from emenu.storage import StaticFilesStorage
 
 
 TIME_ZONE = getattr(settings, 'TIME_ZONE', 'Europe/Warsaw')
+# tasks scheduled by tests (e.g. rebuild of snapshots) are sent to
+# in-memory broker, tests which run them switch to eager mode
+CELERY_TEST_SETTINGS = {
+    'CELERY_BROKER_URL': 'memory://',
+    'CELERY_RESULT_BACKEND': 'cache+memory://',
+}
+_celery_settings = {}
+# collectstatic is not run for tests outside of the image, so static files
+# are served by their original names without the manifest (and without
+# errors of emenu.storage, see StaticFilesTest)
+_static_files_settings = override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                        'StaticFilesStorage',
+)
 
 base_user_kwargs = {
     'username': 'test_user_{}',
@@ -43,6 +108,17 @@ base_dish_kwargs = {
     'last_change_date': None,
 }
 
+def setUpModule():
+    _celery_settings.update(
+        (name, celery_app.conf[name]) for name in CELERY_TEST_SETTINGS
+    )
+    celery_app.conf.update(CELERY_TEST_SETTINGS)
+    _static_files_settings.enable()
+
+def tearDownModule():
+    celery_app.conf.update(_celery_settings)
+    _static_files_settings.disable()
+
 def get_current_datetime():
     return datetime.now(timezone(TIME_ZONE))
 
@@ -368,6 +444,7 @@ class CardAPIDetailTest(TestCase):
 
 class CardListTest(TestCase):
     def setUp(self):
+        get_menu_cache().clear()
         get_init_data(dishes=False, cards=False)
         self.factory = RequestFactory()
         self.logged_user = User.objects.get(username='test_user_1')
@@ -391,7 +468,7 @@ class CardListTest(TestCase):
         object_list = response.context_data.get(
                 'object_list', Card.objects.none
         )
-        name_list = object_list.values_list('name', flat=True)
+        name_list = [obj.name for obj in object_list]
         for name in name_list:
             self.assertNotEqual(name.lower().find('menu 1'), -1)
 
@@ -438,7 +515,7 @@ class CardListTest(TestCase):
         object_list = response.context_data.get(
                 'object_list', Card.objects.none
         )
-        name_list = list(object_list.values_list('name', flat=True))
+        name_list = [obj.name for obj in object_list]
         self.assertEqual(name_list, sorted(name_list))
 
     def test_list_ordering_name_desc(self):
@@ -448,7 +525,7 @@ class CardListTest(TestCase):
         object_list = response.context_data.get(
                 'object_list', Card.objects.none
         )
-        name_list = list(object_list.values_list('name', flat=True))
+        name_list = [obj.name for obj in object_list]
         self.assertEqual(name_list, sorted(name_list, reverse=True))
 
     def test_list_ordering_dishes_count_asc(self):
@@ -458,10 +535,7 @@ class CardListTest(TestCase):
         object_list = response.context_data.get(
                 'object_list', Card.objects.none
         )
-        dishes_count_list = list(object_list\
-                .annotate(dishes_count=Count('dishes'))\
-                .values_list('dishes_count', flat=True)
-        )
+        dishes_count_list = [obj.dishes_count for obj in object_list]
         self.assertEqual(dishes_count_list, sorted(dishes_count_list))
 
     def test_list_ordering_dishes_count_desc(self):
@@ -471,12 +545,2282 @@ class CardListTest(TestCase):
         object_list = response.context_data.get(
                 'object_list', Card.objects.none
         )
-        dishes_count_list = list(object_list\
-                .annotate(dishes_count=Count('dishes'))\
-                .values_list('dishes_count', flat=True)
-        )
+        dishes_count_list = [obj.dishes_count for obj in object_list]
         self.assertEqual(
                 dishes_count_list,
                 sorted(dishes_count_list, reverse=True)
         )
 
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+
+    def get_response(self, view, url, user=None):
+        request = self.factory.get(url)
+        request.user = user or self.logged_user
+        request._messages = CookieStorage(request)
+        return view(request)
+
+    def walk_pages(self, view, url, key):
+        results, pages = [], 0
+        query = url.split('?', 1)[1] if '?' in url else ''
+        while query is not None:
+            response = self.get_response(view, '/?{}'.format(query))
+            object_list = response.context_data['object_list']
+            results.extend(key(obj) for obj in object_list)
+            query = response.context_data.get('next_page_query', None)
+            pages += 1
+        return results, pages
+
+    def test_card_list_pages_cover_all_orderings(self):
+        view = views.CardListView.as_view(paginate_by=3)
+        order_choices = [i[0] for i in views.CardListForm.order_choices]
+        for order_by in order_choices:
+            url = '/card/?order_by={}'.format(order_by)
+            walked, pages = self.walk_pages(view, url, lambda obj: obj.pk)
+            full_view = views.CardListView.as_view(paginate_by=1000)
+            response = self.get_response(full_view, url)
+            expected = [obj.pk for obj in response.context_data['object_list']]
+            self.assertEqual(walked, expected, order_by)
+            self.assertEqual(len(set(walked)), Card.objects.count())
+            self.assertEqual(pages, -(-len(expected) // 3))
+
+    def test_card_list_previous_page(self):
+        view = views.CardListView.as_view(paginate_by=4)
+        first = self.get_response(view, '/card/?order_by=-dishes_count')
+        second = self.get_response(
+                view, '/card/?{}'.format(first.context_data['next_page_query'])
+        )
+        previous = self.get_response(
+                view,
+                '/card/?{}'.format(second.context_data['previous_page_query'])
+        )
+        self.assertEqual(
+                list(first.context_data['object_list']),
+                list(previous.context_data['object_list'])
+        )
+        self.assertNotIn('previous_page_query', previous.context_data)
+
+    def test_card_list_invalid_cursor_returns_first_page(self):
+        view = views.CardListView.as_view(paginate_by=4)
+        first = self.get_response(view, '/card/')
+        response = self.get_response(view, '/card/?cursor=not-a-cursor')
+        self.assertEqual(
+                list(first.context_data['object_list']),
+                list(response.context_data['object_list'])
+        )
+
+    def test_card_list_anonymous_pages_exclude_empty_cards(self):
+        view = views.CardListView.as_view(paginate_by=5)
+        url = '/card/?order_by=alph_name'
+        query, walked = url.split('?', 1)[1], []
+        while query is not None:
+            response = self.get_response(
+                    view, '/card/?{}'.format(query), AnonymousUser()
+            )
+            walked.extend(response.context_data['object_list'])
+            query = response.context_data.get('next_page_query', None)
+        expected = Card.objects.filter(dishes__isnull=False).distinct()
+        self.assertEqual(len(walked), expected.count())
+        self.assertEqual(
+                [card.name.lower() for card in walked],
+                sorted(card.name.lower() for card in walked)
+        )
+
+    def test_dish_list_pages(self):
+        view = views.DishListView.as_view(paginate_by=6)
+        walked, pages = self.walk_pages(
+                view, '/card/dish', lambda obj: obj.name
+        )
+        name_list = Dish.objects.order_by('name').values_list('name', flat=True)
+        self.assertEqual(walked, list(name_list))
+        self.assertEqual(pages, -(-Dish.objects.count() // 6))
+
+
+class APICursorPaginationTest(TestCase):
+    def setUp(self):
+        get_init_data(cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+
+    def walk_pages(self, view, url, user=None):
+        results = []
+        while url is not None:
+            request = self.factory.get(url)
+            request.user = user or self.logged_user
+            response = view(request)
+            self.assertEqual(response.status_code, 200)
+            content_json = json.loads(response.rendered_content)
+            self.assertNotIn('count', content_json)
+            results.extend(content_json['results'])
+            url = content_json['next']
+        return results
+
+    @mock.patch.object(EmenuAPIPagination, 'page_size', 4)
+    def test_card_list_cursor_keeps_ordering(self):
+        view = api_views.CardAPIList.as_view()
+        for ordering in ['name', '-name', 'dishes_count', '-dishes_count']:
+            url = '/api/cards/?cursor=&ordering={}'.format(ordering)
+            results = self.walk_pages(view, url)
+            tie_breaker = '-pk' if ordering.startswith('-') else 'pk'
+            expected = Card.objects\
+                    .order_by(ordering, tie_breaker)\
+                    .values_list('pk', flat=True)
+            self.assertEqual([i['id'] for i in results], list(expected))
+
+    @mock.patch.object(EmenuAPIPagination, 'page_size', 3)
+    def test_card_list_cursor_with_filter(self):
+        view = api_views.CardAPIList.as_view()
+        url = '/api/cards/?cursor=&name=Menu+5&ordering=-dishes_count'
+        results = self.walk_pages(view, url)
+        self.assertEqual([i['name'] for i in results], ['Menu 5'])
+
+    @mock.patch.object(EmenuAPIPagination, 'page_size', 5)
+    def test_dish_list_cursor_pages(self):
+        results = self.walk_pages(
+                api_views.DishAPIList.as_view(), '/api/dishes/?cursor='
+        )
+        self.assertEqual(
+                [i['id'] for i in results],
+                list(Dish.objects.order_by('pk').values_list('pk', flat=True))
+        )
+
+    def test_cursor_mode_skips_count_query(self):
+        request = self.factory.get('/api/dishes/?cursor=')
+        request.user = self.logged_user
+        with CaptureQueriesContext(connection) as queries:
+            api_views.DishAPIList.as_view()(request).render()
+        sql_list = [query['sql'] for query in queries.captured_queries]
+        self.assertFalse([sql for sql in sql_list if 'COUNT(*)' in sql])
+
+    def test_invalid_cursor(self):
+        request = self.factory.get('/api/dishes/?cursor=not-a-cursor')
+        request.user = self.logged_user
+        response = api_views.DishAPIList.as_view()(request)
+        self.assertEqual(response.status_code, 404)
+
+
+class CardDishesCountTest(TestCase):
+    def setUp(self):
+        get_init_data(users=False)
+        self.card_1 = Card.objects.get(name='test menu 1')
+        self.card_2 = Card.objects.get(name='test menu 2')
+        self.dish = Dish.objects.get(name='test dish 1')
+
+    def assertDishesCount(self, card, expected):
+        card.refresh_from_db()
+        self.assertEqual(card.dishes_count, expected)
+        self.assertEqual(card.dishes_count, card.dishes.count())
+
+    def test_dishes_count_populated_by_migration(self):
+        for card in Card.objects.filter(name__startswith='Menu'):
+            self.assertEqual(card.dishes_count, card.dishes.count())
+
+    def test_dishes_count_add_remove(self):
+        count_1 = self.card_1.dishes.count()
+        count_2 = self.card_2.dishes.count()
+        self.dish.cards.add(self.card_1, self.card_2)
+        self.assertDishesCount(self.card_1, count_1 + 1)
+        self.assertDishesCount(self.card_2, count_2 + 1)
+        self.dish.cards.remove(self.card_1)
+        self.assertDishesCount(self.card_1, count_1)
+        self.assertDishesCount(self.card_2, count_2 + 1)
+
+    def test_dishes_count_reverse_add_remove(self):
+        count = self.card_1.dishes.count()
+        self.card_1.dishes.add(self.dish)
+        self.assertDishesCount(self.card_1, count + 1)
+        self.card_1.dishes.remove(self.dish)
+        self.assertDishesCount(self.card_1, count)
+
+    def test_dishes_count_clear_and_set(self):
+        self.dish.cards.set([self.card_1, self.card_2])
+        self.dish.cards.clear()
+        self.assertDishesCount(self.card_1, self.card_1.dishes.count())
+        self.card_2.dishes.set([self.dish])
+        self.assertDishesCount(self.card_2, 1)
+        self.card_2.dishes.clear()
+        self.assertDishesCount(self.card_2, 0)
+
+    def test_dishes_count_dish_delete(self):
+        self.dish.cards.add(self.card_1)
+        count = self.card_1.dishes.count()
+        self.dish.delete()
+        self.assertDishesCount(self.card_1, count - 1)
+
+    def test_refresh_locks_cards_before_counting(self):
+        with CaptureQueriesContext(connection) as queries:
+            Card.objects.filter(pk=self.card_1.pk).refresh_dishes_count()
+        sql = [query['sql'] for query in queries.captured_queries
+               if 'SAVEPOINT' not in query['sql']]
+        self.assertTrue(sql[0].endswith('FOR UPDATE'))
+        self.assertTrue(sql[1].startswith('UPDATE'))
+        self.assertDishesCount(self.card_1, self.card_1.dishes.count())
+
+    def test_rebuild_dishes_count_command(self):
+        Card.objects.update(dishes_count=100)
+        call_command('rebuild_dishes_count', stdout=mock.Mock())
+        for card in Card.objects.all():
+            self.assertEqual(card.dishes_count, card.dishes.count())
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        Dish.objects.filter(name='Dish 3').update(
+                description='Spicy tomato soup'
+        )
+
+    def test_search_name_and_description(self):
+        name_list = list(Card.objects.search('menu 1').values_list(
+                'name', flat=True
+        ))
+        self.assertEqual(len(name_list), 11)
+        for name in name_list:
+            self.assertTrue(name.startswith('Menu 1'))
+        dish_qs = Dish.objects.search('TOMATO')
+        self.assertEqual([dish.name for dish in dish_qs], ['Dish 3'])
+
+    def test_search_rank_prefers_best_match(self):
+        queryset = Card.objects.search('menu 1').order_by('-search_rank')
+        first = queryset.first()
+        self.assertEqual(first.name, 'Menu 1')
+        ranks = list(queryset.values_list('search_rank', flat=True))
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_search_uses_trigram_index(self):
+        if not has_trigram_support('default'):
+            self.skipTest('pg_trgm extension is not available')
+        queryset = Dish.objects.search('tomato')
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+            plan = queryset.explain()
+            cursor.execute('SET enable_seqscan = on')
+        self.assertIn('card_dish_name_trgm', plan)
+        self.assertIn('card_dish_description_trgm', plan)
+
+    def test_trigram_migration_without_privileges(self):
+        if not has_trigram_support('default'):
+            self.skipTest('pg_trgm extension is not available')
+        migration = import_module('card.migrations.0005_search_trigram_indexes')
+        index_query = "SELECT indexname FROM pg_indexes " \
+            "WHERE indexname LIKE '%_trgm'"
+        with connection.cursor() as cursor:
+            cursor.execute('DROP EXTENSION pg_trgm CASCADE')
+            # e.g. superuser is needed for the extension on PostgreSQL < 13
+            with connection.schema_editor(atomic=False) as schema_editor, \
+                    mock.patch.object(schema_editor, 'execute',
+                        side_effect=ProgrammingError('permission denied')):
+                migration.create_trigram_indexes(None, schema_editor)
+            # indexes are skipped instead of failing the migration
+            cursor.execute(index_query)
+            self.assertEqual(cursor.fetchall(), [])
+            with connection.schema_editor(atomic=False) as schema_editor:
+                migration.create_trigram_indexes(None, schema_editor)
+            cursor.execute(index_query)
+            self.assertEqual(len(cursor.fetchall()), 4)
+
+    def test_card_list_view_search(self):
+        results = []
+        for user in [self.logged_user, AnonymousUser()]:
+            request = self.factory.get('/card/?q=menu+2')
+            request.user = user
+            response = views.CardListView.as_view()(request)
+            object_list = response.context_data['object_list']
+            results.append([obj.name for obj in object_list])
+        self.assertEqual(results[0], ['Menu 2', 'Menu 20'])
+        self.assertEqual(results[1], ['Menu 20'])
+
+    def test_dish_list_view_search(self):
+        request = self.factory.get('/card/dish?q=soup')
+        request.user = self.logged_user
+        response = views.DishListView.as_view()(request)
+        name_list = [obj.name for obj in response.context_data['object_list']]
+        self.assertEqual(name_list, ['Dish 3'])
+
+    def test_api_search(self):
+        for view, url, expected in [
+                (api_views.CardAPIList, '/api/cards/?q=menu+2', 'Menu 2'),
+                (api_views.DishAPIList, '/api/dishes/?q=soup', 'Dish 3'),
+                (api_views.DishAPIList, '/api/dishes/?cursor=&q=dish+1',
+                    'Dish 1'),
+        ]:
+            request = self.factory.get(url)
+            request.user = self.logged_user
+            response = view.as_view()(request)
+            content_json = json.loads(response.rendered_content)
+            name_list = get_values_from_json(content_json, 'name')
+            self.assertEqual(name_list[0], expected)
+
+
+class CardQueryCountTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+
+    def get_api_results(self, url, user):
+        request = self.factory.get(url)
+        request.user = user
+        response = api_views.CardAPIList.as_view()(request)
+        return json.loads(response.rendered_content)['results']
+
+    def test_api_list_query_count(self):
+        for user in [self.logged_user, AnonymousUser()]:
+            # validators (ETag), count, cards, prefetched dishes
+            with self.assertNumQueries(4):
+                self.get_api_results('/api/cards/', user)
+            with self.assertNumQueries(4):
+                self.get_api_results(
+                        '/api/cards/?ordering=-dishes_count', user
+                )
+            # validators (ETag), cards, prefetched dishes
+            with self.assertNumQueries(3):
+                self.get_api_results('/api/cards/?cursor=', user)
+
+    def test_api_list_anonymous_exclude_empty_cards(self):
+        results = self.get_api_results(
+                '/api/cards/?ordering=-dishes_count', AnonymousUser()
+        )
+        id_list = [i['id'] for i in results]
+        expected = Card.objects\
+                .filter(dishes_count__gt=0)\
+                .order_by('-dishes_count')\
+                .values_list('dishes_count', flat=True)
+        self.assertEqual(len(id_list), len(set(id_list)))
+        self.assertEqual([i['dishes_count'] for i in results], list(expected))
+        for card in results:
+            self.assertEqual(len(card['dishes']), card['dishes_count'])
+
+    def test_api_detail_anonymous_query_count(self):
+        card = Card.objects.filter(dishes_count__gt=0).first()
+        request = self.factory.get('/api/cards/{}/'.format(card.pk))
+        request.user = AnonymousUser()
+        # snapshot (missing), card, dishes
+        with self.assertNumQueries(3):
+            response = api_views.CardAPIDetail.as_view()(request, pk=card.pk)
+            response.render()
+        self.assertEqual(response.status_code, 200)
+        build_snapshots([card.pk])
+        with self.assertNumQueries(1):
+            response = api_views.CardAPIDetail.as_view()(request, pk=card.pk)
+        self.assertEqual(response.status_code, 200)
+
+    def test_html_list_query_count(self):
+        for user in [self.logged_user, AnonymousUser()]:
+            request = self.factory.get('/card/?order_by=alph_name')
+            request.user = user
+            # cards, prefetched dishes
+            with self.assertNumQueries(2):
+                views.CardListView.as_view()(request).render()
+
+
+class MenuCacheTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+        self.dish = self.card.dishes.first()
+
+    def get_content(self, view, url, user=None, **kwargs):
+        request = self.factory.get(url)
+        request.user = user or AnonymousUser()
+        response = view.as_view()(request, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8')
+
+    def test_anonymous_list_is_cached(self):
+        content = self.get_content(views.CardListView, '/card/?q=menu&name=1')
+        with self.assertNumQueries(0):
+            cached = self.get_content(
+                    views.CardListView, '/card/?name=1&q=menu'
+            )
+        self.assertEqual(content, cached)
+        with self.assertNumQueries(2):
+            self.get_content(views.CardListView, '/card/?name=2')
+
+    def test_authenticated_list_is_not_cached(self):
+        self.get_content(views.CardListView, '/card/', self.logged_user)
+        with self.assertNumQueries(2):
+            self.get_content(views.CardListView, '/card/', self.logged_user)
+
+    def test_dish_change_invalidates_list_and_detail(self):
+        detail_url = '/card/{}/'.format(self.card.pk)
+        self.get_content(views.CardListView, '/card/')
+        self.get_content(views.CardDetailView, detail_url, pk=self.card.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dish.name = 'Renamed dish'
+            self.dish.save()
+        content = self.get_content(views.CardListView, '/card/')
+        self.assertIn('Renamed dish', content)
+        content = self.get_content(
+                views.CardDetailView, detail_url, pk=self.card.pk
+        )
+        self.assertIn('Renamed dish', content)
+
+    def test_m2m_change_bumps_versions(self):
+        other_card = Card.objects.get(name='Menu 1')
+        versions = [
+            get_menu_version(),
+            get_object_version('card', other_card.pk),
+            get_object_version('dish', self.dish.pk),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            other_card.dishes.add(self.dish)
+        new_versions = [
+            get_menu_version(),
+            get_object_version('card', other_card.pk),
+            get_object_version('dish', self.dish.pk),
+        ]
+        for version, new_version in zip(versions, new_versions):
+            self.assertGreater(new_version, version)
+
+    def test_versions_not_bumped_before_commit(self):
+        version = get_object_version('card', self.card.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.card.save()
+            self.assertEqual(
+                    get_object_version('card', self.card.pk), version
+            )
+        # bump of the versions and rebuild of the snapshot
+        self.assertEqual(len(callbacks), 2)
+
+    def test_page_with_messages_is_not_cached(self):
+        url = '/card/?creation_date__gte=wrong'
+        for i in range(2):
+            request = self.factory.get(url)
+            request.user = AnonymousUser()
+            request._messages = CookieStorage(request)
+            with self.assertNumQueries(2):
+                views.CardListView.as_view()(request).render()
+
+
+class ConditionalRequestTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+        self.card_url = '/api/cards/{}/'.format(self.card.pk)
+
+    def get_response(self, view, url, user=None, method='get', data=None,
+                     headers=None, **kwargs):
+        request_method = getattr(self.factory, method)
+        request = request_method(
+                url, data=data, content_type='application/json',
+                **(headers or {})
+        )
+        request.user = user or self.logged_user
+        request._dont_enforce_csrf_checks = True
+        response = view.as_view()(request, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def test_detail_not_modified(self):
+        view = api_views.CardAPIDetail
+        response = self.get_response(view, self.card_url, pk=self.card.pk)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        headers = {'HTTP_IF_NONE_MATCH': etag}
+        # validators of the snapshot are the same
+        build_snapshots([self.card.pk])
+        with self.assertNumQueries(1):
+            response = self.get_response(
+                    view, self.card_url, headers=headers, pk=self.card.pk
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        headers = {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}
+        response = self.get_response(
+                view, self.card_url, headers=headers, pk=self.card.pk
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_detail_etag_changes_on_m2m_change(self):
+        view = api_views.CardAPIDetail
+        response = self.get_response(view, self.card_url, pk=self.card.pk)
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.card.dishes.add(Dish.objects.get(name='Dish 19'))
+        headers = {'HTTP_IF_NONE_MATCH': etag}
+        response = self.get_response(
+                view, self.card_url, headers=headers, pk=self.card.pk
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_match_on_update_and_delete(self):
+        view = api_views.CardAPIDetail
+        etag = self.get_response(
+                view, self.card_url, pk=self.card.pk
+        )['ETag']
+        data = json.dumps({'name': 'Menu 5', 'description': 'changed'})
+        response = self.get_response(
+                view, self.card_url, method='patch', data=data,
+                headers={'HTTP_IF_MATCH': '"outdated"'}, pk=self.card.pk
+        )
+        self.assertEqual(response.status_code, 412)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.get_response(
+                    view, self.card_url, method='patch', data=data,
+                    headers={'HTTP_IF_MATCH': etag}, pk=self.card.pk
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.get_response(
+                view, self.card_url, method='delete',
+                headers={'HTTP_IF_MATCH': etag}, pk=self.card.pk
+        )
+        self.assertEqual(response.status_code, 412)
+        self.assertTrue(Card.objects.filter(pk=self.card.pk).exists())
+
+    def test_etag_depends_on_links_mode(self):
+        view = api_views.CardAPIDetail
+        etag = self.get_response(view, self.card_url, pk=self.card.pk)['ETag']
+        response = self.get_response(
+                view, self.card_url + '?links=ids',
+                headers={'HTTP_IF_NONE_MATCH': etag}, pk=self.card.pk
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        view = api_views.CardAPIList
+        etag = self.get_response(view, '/api/cards/')['ETag']
+        response = self.get_response(
+                view, '/api/cards/?links=ids',
+                headers={'HTTP_IF_NONE_MATCH': etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_etag_ignores_order_of_parameters(self):
+        view = api_views.CardAPIList
+        etag = self.get_response(
+                view, '/api/cards/?ordering=name&links=ids'
+        )['ETag']
+        response = self.get_response(
+                view, '/api/cards/?links=ids&ordering=name',
+                headers={'HTTP_IF_NONE_MATCH': etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_list_not_modified_until_change(self):
+        for view, url in [(api_views.CardAPIList, '/api/cards/?ordering=name'),
+                          (api_views.DishAPIList, '/api/dishes/')]:
+            etag = self.get_response(view, url)['ETag']
+            headers = {'HTTP_IF_NONE_MATCH': etag}
+            with self.assertNumQueries(1):
+                response = self.get_response(view, url, headers=headers)
+            self.assertEqual(response.status_code, 304)
+            with self.captureOnCommitCallbacks(execute=True):
+                Dish.objects.get(name='Dish 3').cards.remove(self.card)
+            response = self.get_response(view, url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+
+class SerializerLinksTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+
+    def get_results(self, view, url):
+        request = self.factory.get(url)
+        request.user = self.logged_user
+        response = view.as_view()(request)
+        return json.loads(response.rendered_content)['results']
+
+    def test_templated_urls_equal_reversed_urls(self):
+        request = self.factory.get('/api/cards/')
+        results = self.get_results(api_views.CardAPIList, '/api/cards/')
+        for card in results:
+            obj = Card.objects.get(pk=card['id'])
+            self.assertEqual(card['url'], request.build_absolute_uri(
+                    reverse('card-detail', kwargs={'pk': obj.pk})
+            ))
+            expected = [
+                request.build_absolute_uri(
+                    reverse('dish-detail', kwargs={'pk': pk})
+                )
+                for pk in obj.dishes.values_list('pk', flat=True)
+            ]
+            self.assertEqual(sorted(card['dishes']), sorted(expected))
+
+    def test_urls_reversed_once_per_view_name(self):
+        with mock.patch('rest_framework.relations.reverse',
+                        wraps=drf_reverse) as reverse_mock:
+            results = self.get_results(api_views.CardAPIList, '/api/cards/')
+        self.assertTrue(any(card['dishes'] for card in results))
+        # card-detail for "url", dish-detail for "dishes"
+        self.assertEqual(reverse_mock.call_count, 2)
+
+    def test_links_ids(self):
+        for view, url, field, model in [
+                (api_views.CardAPIList, '/api/cards/', 'dishes', Card),
+                (api_views.DishAPIList, '/api/dishes/', 'cards', Dish)]:
+            results = self.get_results(view, url + '?links=ids')
+            for item in results:
+                related = getattr(model.objects.get(pk=item['id']), field)
+                self.assertEqual(
+                        sorted(item[field]),
+                        sorted(related.values_list('pk', flat=True)),
+                )
+                self.assertTrue(item['url'].startswith('http'))
+
+
+class DishBulkAPITest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+
+    def get_response(self, data, method='post', url='/api/dishes/bulk/'):
+        request_method = getattr(self.factory, method)
+        request = request_method(
+                url, data=json.dumps(data), content_type='application/json'
+        )
+        request.user = self.logged_user
+        request._dont_enforce_csrf_checks = True
+        with self.captureOnCommitCallbacks(execute=True):
+            response = api_views.DishAPIBulk.as_view()(request)
+        response.render()
+        return response
+
+    def get_payload(self, name, cards=()):
+        return {
+            'name': name,
+            'description': 'Bulk dish',
+            'price': '10.00',
+            'preparation_time': 5,
+            'cards': [
+                'http://testserver/api/cards/{}/'.format(card.pk)
+                for card in cards
+            ],
+        }
+
+    def test_bulk_create(self):
+        count = self.card.dishes_count
+        data = [self.get_payload('Bulk {}'.format(i), [self.card])
+                for i in range(5)]
+        response = self.get_response(data)
+        self.assertEqual(response.status_code, 201)
+        content = json.loads(response.rendered_content)
+        self.assertEqual(content['errors'], [{}] * 5)
+        self.assertEqual(
+                [item['name'] for item in content['results']],
+                ['Bulk {}'.format(i) for i in range(5)],
+        )
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.dishes_count, count + 5)
+        self.assertEqual(
+                Dish.objects.filter(name__startswith='Bulk ').count(), 5
+        )
+
+    def test_write_query_count_does_not_depend_on_batch_size(self):
+        query_counts = []
+        for size in [2, 20]:
+            data = [self.get_payload('Size {} {}'.format(size, i), [self.card])
+                    for i in range(size)]
+            with CaptureQueriesContext(connection) as context:
+                self.get_response(data)
+            # validation (unique name, related urls) still runs per item
+            write_queries = [
+                query for query in context.captured_queries
+                if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+            ]
+            query_counts.append(len(write_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_bulk_update_and_partial_errors(self):
+        dish = Dish.objects.get(name='Dish 3')
+        version = get_object_version('card', self.card.pk)
+        payload = self.get_payload('Dish 3 updated', [self.card])
+        payload['id'] = dish.pk
+        data = [
+            payload,
+            self.get_payload('Dish 4'),
+            self.get_payload('Repeated'),
+            self.get_payload('Repeated'),
+            dict(self.get_payload('Missing'), id=0),
+            dict(self.get_payload('Negative'), price='-1.00'),
+        ]
+        response = self.get_response(data)
+        self.assertEqual(response.status_code, 201)
+        content = json.loads(response.rendered_content)
+        errors = content['errors']
+        self.assertEqual(errors[0], {})
+        self.assertIn('name', errors[1])
+        self.assertEqual(errors[2], {})
+        self.assertIn('name', errors[3])
+        self.assertIn('id', errors[4])
+        self.assertIn('price', errors[5])
+        self.assertEqual(content['results'][0]['id'], dish.pk)
+        self.assertIsNone(content['results'][1])
+        dish.refresh_from_db()
+        self.assertEqual(dish.name, 'Dish 3 updated')
+        self.assertEqual(list(dish.cards.all()), [self.card])
+        self.assertTrue(Dish.objects.filter(name='Repeated').exists())
+        self.assertGreater(get_object_version('card', self.card.pk), version)
+        for card in Card.objects.all():
+            self.assertEqual(card.dishes_count, card.dishes.count())
+        # nothing created
+        response = self.get_response([payload, self.get_payload('Dish 4')])
+        self.assertEqual(response.status_code, 200)
+
+    def test_model_checks_are_enforced(self):
+        def assert_valid(dish):
+            if dish.name == 'Invalid':
+                raise ValidationError('Invalid dish')
+        with mock.patch.object(Dish, 'assert_valid', autospec=True,
+                               side_effect=assert_valid):
+            response = self.get_response([
+                self.get_payload('Valid'), self.get_payload('Invalid'),
+            ])
+        errors = json.loads(response.rendered_content)['errors']
+        self.assertEqual(errors[1], {'non_field_errors': ['Invalid dish']})
+        self.assertTrue(Dish.objects.filter(name='Valid').exists())
+        self.assertFalse(Dish.objects.filter(name='Invalid').exists())
+
+    def test_atomic(self):
+        data = [self.get_payload('Atomic'), self.get_payload('Dish 4')]
+        response = self.get_response(data, url='/api/dishes/bulk/?atomic=true')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Dish.objects.filter(name='Atomic').exists())
+
+    def test_bulk_delete(self):
+        dishes = list(self.card.dishes.all()[:2])
+        count = self.card.dishes_count
+        since = ChangeLogEntry.objects.latest('seq').seq
+        with CaptureQueriesContext(connection) as context:
+            response = self.get_response(
+                    [dish.pk for dish in dishes], method='delete'
+            )
+        self.assertEqual(response.status_code, 200)
+        delete_queries = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('DELETE')
+        ]
+        self.assertEqual(len(delete_queries), 2)
+        # dishes are locked before their links are read
+        self.assertTrue(any(
+                'FOR UPDATE' in query['sql']
+                for query in context.captured_queries
+        ))
+        self.assertEqual(
+                sorted(ChangeLogEntry.objects
+                        .filter(seq__gt=since, action=ChangeLogEntry.DELETE)
+                        .values_list('object_id', flat=True)
+                ),
+                sorted(dish.pk for dish in dishes),
+        )
+        self.assertEqual(
+                json.loads(response.rendered_content)['deleted'],
+                sorted(dish.pk for dish in dishes),
+        )
+        self.assertFalse(
+                Dish.objects.filter(pk__in=[d.pk for d in dishes]).exists()
+        )
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.dishes_count, count - 2)
+        response = self.get_response({'ids': 1}, method='delete')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_size_is_limited(self):
+        with mock.patch.object(api_views.DishAPIBulk, 'max_batch_size', 2):
+            dish_ids = list(Dish.objects.values_list('pk', flat=True)[:3])
+            response = self.get_response(dish_ids, method='delete')
+            self.assertEqual(response.status_code, 400)
+            data = [self.get_payload('Batch {}'.format(i)) for i in range(3)]
+            response = self.get_response(data)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Dish.objects.filter(pk__in=dish_ids).count(), 3)
+        self.assertFalse(Dish.objects.filter(name='Batch 0').exists())
+
+
+class MenuExportTest(TestCase):
+    def setUp(self):
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+
+    def get_response(self, url, user=None):
+        request = self.factory.get(url)
+        request.user = user or self.logged_user
+        return api_views.MenuExportAPIView.as_view()(request)
+
+    def get_lines(self, response):
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        return content.splitlines()
+
+    def test_ndjson_export(self):
+        response = self.get_response('/api/export/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in self.get_lines(response)]
+        types = [row['type'] for row in rows]
+        self.assertEqual(types.count('card'), Card.objects.count())
+        self.assertEqual(types.count('dish'), Dish.objects.count())
+        self.assertEqual(
+                types.count('link'), Dish.cards.through.objects.count()
+        )
+        card = Card.objects.get(name='Menu 5')
+        card_row = next(row for row in rows if row['type'] == 'card'
+                        and row['id'] == card.pk)
+        self.assertEqual(card_row['dishes_count'], card.dishes_count)
+
+    def test_csv_export(self):
+        response = self.get_response('/api/export/?output=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = self.get_lines(response)
+        self.assertTrue(lines[0].startswith('type,id,name'))
+        self.assertEqual(
+                len(lines) - 1,
+                Card.objects.count() + Dish.objects.count()
+                + Dish.cards.through.objects.count(),
+        )
+
+    def test_export_since(self):
+        since = get_current_datetime() + timedelta(days=1)
+        Dish.objects.filter(name='Dish 3').update(
+                last_change_date=since + timedelta(hours=1)
+        )
+        response = self.get_response(
+                '/api/export/?since={}'.format(datetime_to_get_param(since))
+        )
+        rows = [json.loads(line) for line in self.get_lines(response)]
+        dish = Dish.objects.get(name='Dish 3')
+        self.assertEqual(
+                [row['id'] for row in rows if row['type'] != 'link'],
+                [dish.pk],
+        )
+        self.assertEqual(
+                sorted(row['card_id'] for row in rows if row['type'] == 'link'),
+                sorted(dish.cards.values_list('pk', flat=True)),
+        )
+
+    def test_export_errors(self):
+        for url in ['/api/export/?output=xml', '/api/export/?since=never']:
+            self.assertEqual(self.get_response(url).status_code, 400)
+        response = self.get_response('/api/export/', AnonymousUser())
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command('export_menu', '--format=csv', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(
+                len(lines) - 1,
+                Card.objects.count() + Dish.objects.count()
+                + Dish.cards.through.objects.count(),
+        )
+        out = StringIO()
+        since = datetime_to_get_param(
+                get_current_datetime() + timedelta(days=1)
+        )
+        call_command('export_menu', '--since', since, stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+
+class EmailReportTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.emails = list(User.objects
+                .exclude(email='')
+                .order_by('pk')
+                .values_list('email', flat=True)
+        )
+        self.send_messages = mail.get_connection().__class__.send_messages
+
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('email_report', '--retry-delay=0', *args, stdout=out)
+        return out.getvalue()
+
+    def get_recipients(self):
+        return [message.to[0] for message in mail.outbox]
+
+    def test_sends_over_one_connection(self):
+        batches = []
+        def send_messages(backend, messages):
+            batches.append((id(backend), len(messages)))
+            return self.send_messages(backend, messages)
+        with mock.patch.object(mail.get_connection().__class__,
+                               'send_messages', autospec=True,
+                               side_effect=send_messages):
+            output = self.call_command('--batch-size=3')
+        self.assertEqual(self.get_recipients(), self.emails)
+        self.assertEqual(len({backend for backend, _ in batches}), 1)
+        self.assertEqual([size for _, size in batches],
+                         [1] * len(self.emails))
+        self.assertIn('{} users'.format(len(self.emails)), output)
+        self.assertIn('messages/s', output)
+
+    def test_failed_batch_is_retried(self):
+        calls = []
+        def send_messages(backend, messages):
+            calls.append(len(messages))
+            if len(calls) == 2:
+                raise SMTPServerDisconnected('Connection lost')
+            return self.send_messages(backend, messages)
+        with mock.patch.object(mail.get_connection().__class__,
+                               'send_messages', autospec=True,
+                               side_effect=send_messages):
+            self.call_command('--batch-size=5')
+        self.assertEqual(self.get_recipients(), self.emails)
+
+    def test_failed_reopen_is_retried(self):
+        backend_class = mail.get_connection().__class__
+        calls = {'send_messages': 0, 'open': 0}
+        def fail_call(name, original, number):
+            def method(backend, *args):
+                calls[name] += 1
+                if calls[name] == number:
+                    raise SMTPServerDisconnected('Connection lost')
+                return original(backend, *args)
+            return method
+        # first send fails and so does the first reopen (second open)
+        with mock.patch.object(backend_class, 'send_messages', autospec=True,
+                               side_effect=fail_call(
+                                   'send_messages', self.send_messages, 1)), \
+                mock.patch.object(backend_class, 'open', autospec=True,
+                                  side_effect=fail_call(
+                                      'open', backend_class.open, 2)):
+            self.call_command('--retries=2')
+        self.assertEqual(calls['open'], 3)
+        self.assertEqual(self.get_recipients(), self.emails)
+
+    def test_interrupted_run_is_resumed(self):
+        def send_messages(backend, messages):
+            if messages[0].to[0] == self.emails[4]:
+                raise SMTPServerDisconnected('Connection lost')
+            return self.send_messages(backend, messages)
+        with mock.patch.object(mail.get_connection().__class__,
+                               'send_messages', autospec=True,
+                               side_effect=send_messages):
+            with self.assertRaisesMessage(CommandError, '--resume-from'):
+                self.call_command('--batch-size=4', '--retries=1')
+        self.assertEqual(self.get_recipients(), self.emails[:4])
+        # progress is stored in the database, not in the cache
+        get_menu_cache().clear()
+        self.assertEqual(EmailReportProgress.objects.count(), 1)
+        self.call_command('--batch-size=4')
+        self.assertEqual(self.get_recipients(), self.emails)
+        output = self.call_command()
+        self.assertEqual(output, 'No users to send report to\n')
+        self.assertEqual(len(mail.outbox), len(self.emails))
+        self.call_command('--restart')
+        self.assertEqual(len(mail.outbox), 2 * len(self.emails))
+
+
+class EmailReportTaskTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.emails = list(User.objects
+                .exclude(email='')
+                .order_by('pk')
+                .values_list('email', flat=True)
+        )
+        self.report_date = get_boundry_dates()[0].date().isoformat()
+        self.eager_settings = {
+            'CELERY_TASK_ALWAYS_EAGER': True,
+            'CELERY_TASK_EAGER_PROPAGATES': True,
+            'CELERY_BROKER_URL': 'memory://',
+            'CELERY_RESULT_BACKEND': 'cache+memory://',
+        }
+        self.old_settings = {
+            name: celery_app.conf[name] for name in self.eager_settings
+        }
+        celery_app.conf.update(self.eager_settings)
+
+    def tearDown(self):
+        celery_app.conf.update(self.old_settings)
+
+    def test_report_is_sent_in_chunks(self):
+        with mock.patch('card.reports.get_report_message',
+                        wraps=get_report_message) as message_mock:
+            with mock.patch('emenu.tasks.send_email_report_chunk.run',
+                            wraps=tasks.send_email_report_chunk.run) \
+                    as chunk_mock:
+                tasks.send_email_report.delay(batch_size=4)
+        self.assertEqual(message_mock.call_count, 1)
+        self.assertEqual(chunk_mock.call_count, -(-len(self.emails) // 4))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted(self.emails))
+        self.assertEqual(get_report_progress(self.report_date), {
+            'recipients': len(self.emails),
+            'sent': len(self.emails),
+            'skipped': 0,
+        })
+
+    def test_redelivered_tasks_do_not_send_twice(self):
+        tasks.send_email_report.delay(batch_size=4)
+        tasks.send_email_report.delay(batch_size=4)
+        pks = list(User.objects.values_list('pk', flat=True))
+        result = tasks.send_email_report_chunk.delay(self.report_date, pks)
+        self.assertEqual(result.get(), {'sent': 0, 'skipped': len(pks)})
+        self.assertEqual(len(mail.outbox), len(self.emails))
+        progress = get_report_progress(self.report_date)
+        self.assertEqual(progress['sent'], len(self.emails))
+
+    def test_failed_chunk_releases_unsent_recipients(self):
+        pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        send_messages = mail.get_connection().__class__.send_messages
+        def fail_second(backend, messages):
+            if len(mail.outbox) == 1:
+                raise SMTPServerDisconnected('Lost')
+            return send_messages(backend, messages)
+        with mock.patch.object(mail.get_connection().__class__,
+                               'send_messages', autospec=True,
+                               side_effect=fail_second):
+            with mock.patch.object(tasks.send_email_report_chunk, 'retry',
+                                   side_effect=Retry()):
+                with self.assertRaises(Retry):
+                    tasks.send_email_report_chunk.delay(
+                            self.report_date, pks[:3]
+                    )
+        self.assertEqual(len(mail.outbox), 1)
+        result = tasks.send_email_report_chunk.delay(self.report_date, pks[:3])
+        self.assertEqual(result.get(), {'sent': 2, 'skipped': 1})
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted(self.emails[:3]))
+        self.assertEqual(get_report_progress(self.report_date)['sent'], 3)
+
+    def test_pending_recipients_are_retried(self):
+        pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        batch = list(User.objects.filter(pk=pks[0]).values_list('pk', 'email'))
+        # claimed by a worker, which died before sending
+        self.assertEqual(claim_recipients(self.report_date, batch),
+                         (batch, []))
+        with mock.patch.object(tasks.send_email_report_chunk, 'retry',
+                               side_effect=Retry()) as retry_mock:
+            with self.assertRaises(Retry):
+                tasks.send_email_report_chunk.delay(self.report_date, pks[:3])
+        self.assertEqual(retry_mock.call_args[1],
+                         {'countdown': CLAIM_TIMEOUT})
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted(self.emails[1:3]))
+        release_recipients(self.report_date, batch)
+        result = tasks.send_email_report_chunk.delay(self.report_date, pks[:3])
+        self.assertEqual(result.get(), {'sent': 1, 'skipped': 2})
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_partial_result_after_last_retry(self):
+        pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        batch = list(User.objects.filter(pk=pks[0]).values_list('pk', 'email'))
+        claim_recipients(self.report_date, batch)
+        chunk_task = tasks.send_email_report_chunk
+        with self.assertLogs('emenu.tasks', 'ERROR') as logs:
+            result = chunk_task.apply(
+                    (self.report_date, pks[:3]), retries=chunk_task.max_retries
+            )
+        self.assertEqual(result.get(), {'sent': 2, 'skipped': 0})
+        self.assertIn(str(pks[0]), logs.output[0])
+        # summary of the chord gets the result
+        self.assertEqual(
+                tasks.email_report_summary([result.get()], self.report_date),
+                {'sent': 2, 'skipped': 0},
+        )
+
+
+class ChangeLogTest(TestCase):
+    def setUp(self):
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+        self.since = ChangeLogEntry.objects.latest('seq').seq
+
+    def get_changes(self, since=None, **params):
+        params['since'] = self.since if since is None else since
+        request = self.factory.get('/api/changes/', data=params)
+        request.user = self.logged_user
+        response = api_views.ChangeLogAPIView.as_view()(request)
+        return response, json.loads(response.rendered_content)
+
+    def get_actions(self, content):
+        return [
+            (change['model'], change['id'], change.get('card'),
+             change['action'])
+            for change in content['results']
+        ]
+
+    def test_migration_seeds_catalogue(self):
+        content = self.get_changes(since=0, limit=10000)[1]
+        actions = self.get_actions(content)
+        self.assertFalse(content['has_more'])
+        self.assertEqual(
+                len(actions),
+                Card.objects.count() + Dish.objects.count()
+                + Dish.cards.through.objects.count(),
+        )
+        self.assertIn(('card', self.card.pk, None, 'create'), actions)
+
+    def test_changes_are_logged(self):
+        dish = Dish.objects.create(
+                name='New dish', price=Decimal('1'), preparation_time=1
+        )
+        dish.cards.add(self.card)
+        dish.description = 'Changed'
+        dish.save()
+        other = Dish.objects.get(name='Dish 3')
+        other.name = 'Dish 3 renamed'
+        other.save()
+        self.card.dishes.remove(other)
+        deleted_pk = Dish.objects.get(name='Dish 4').pk
+        Dish.objects.get(pk=deleted_pk).delete()
+        content = self.get_changes()[1]
+        self.assertEqual(self.get_actions(content), [
+            ('dish', dish.pk, None, 'create'),
+            ('dish', dish.pk, self.card.pk, 'add'),
+            ('dish', other.pk, None, 'update'),
+            ('dish', other.pk, self.card.pk, 'remove'),
+            ('dish', deleted_pk, None, 'delete'),
+        ])
+        self.assertEqual(
+                content['next'], ChangeLogEntry.objects.latest('seq').seq
+        )
+
+    def test_created_and_deleted_objects_are_skipped(self):
+        dish = Dish.objects.create(
+                name='Short lived', price=Decimal('1'), preparation_time=1
+        )
+        dish.cards.add(self.card)
+        dish.delete()
+        content = self.get_changes()[1]
+        self.assertEqual(content['results'], [])
+        self.assertGreater(content['next'], self.since)
+
+    def test_limit_and_has_more(self):
+        for i in range(3):
+            Card.objects.create(name='Card {}'.format(i))
+        response, content = self.get_changes(limit=2)
+        self.assertTrue(content['has_more'])
+        self.assertEqual(len(content['results']), 2)
+        content = self.get_changes(since=content['next'], limit=2)[1]
+        self.assertFalse(content['has_more'])
+        self.assertEqual(len(content['results']), 1)
+        for params in [{'since': -1}, {'limit': 0}, {'since': 'x'}]:
+            response = self.get_changes(**params)[0]
+            self.assertEqual(response.status_code, 400)
+
+    def test_log_writers_are_serialized(self):
+        def has_lock():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' "
+                    "AND objid = %s AND pid = pg_backend_pid()",
+                    [CHANGE_LOG_LOCK_ID],
+                )
+                return cursor.fetchone() is not None
+        self.assertFalse(has_lock())
+        Card.objects.create(name='Locked card')
+        # held until the end of the (test case) transaction
+        self.assertTrue(has_lock())
+
+    def test_log_lock_is_taken_before_row_locks(self):
+        card = Card.objects.get(name='Menu 5')
+        dish = Dish.objects.get(name='Dish 19')
+        writes = [
+            lambda: dish.cards.add(card),
+            lambda: card.dishes.remove(dish),
+            lambda: Card.objects.filter(pk=card.pk).first().save(),
+            lambda: Dish.objects.get(pk=dish.pk).delete(),
+        ]
+        for write in writes:
+            with transaction.atomic(), \
+                    CaptureQueriesContext(connection) as queries:
+                write()
+            statements = [
+                query['sql'] for query in queries.captured_queries
+                if not query['sql'].startswith(('SELECT', 'SAVEPOINT'))
+                or 'FOR UPDATE' in query['sql']
+                or 'pg_advisory_xact_lock' in query['sql']
+            ]
+            self.assertIn('pg_advisory_xact_lock', statements[0])
+
+    def test_ids_fit_big_integers(self):
+        ChangeLogEntry.objects.create(
+                timestamp=datetime.now(timezone('UTC')),
+                model=ChangeLogEntry.DISH,
+                action=ChangeLogEntry.ADD, object_id=2**40, card_id=2**40,
+        )
+        content = self.get_changes()[1]
+        self.assertEqual(self.get_actions(content),
+                         [('dish', 2**40, 2**40, 'add')])
+
+    def test_bulk_changes_are_logged(self):
+        dish = Dish.objects.get(name='Dish 3')
+        card_ids = list(dish.cards.values_list('pk', flat=True))
+        data = [{
+            'id': dish.pk, 'name': 'Dish 3', 'price': '1.00',
+            'preparation_time': 1, 'cards': [],
+        }, {
+            'name': 'Bulk', 'price': '1.00', 'preparation_time': 1,
+            'cards': [],
+        }]
+        request = self.factory.post(
+                '/api/dishes/bulk/', data=json.dumps(data),
+                content_type='application/json',
+        )
+        request.user = self.logged_user
+        request._dont_enforce_csrf_checks = True
+        response = api_views.DishAPIBulk.as_view()(request)
+        self.assertEqual(response.status_code, 201)
+        created = Dish.objects.get(name='Bulk')
+        actions = self.get_actions(self.get_changes()[1])
+        self.assertEqual(actions, [
+            ('dish', created.pk, None, 'create'),
+            ('dish', dish.pk, None, 'update'),
+        ] + [('dish', dish.pk, pk, 'remove') for pk in sorted(card_ids)])
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+
+    def test_query_shape(self):
+        self.assertEqual(
+                get_query_shape('SELECT * FROM t WHERE id IN (%s, %s, %s)\n'
+                                'LIMIT 21'),
+                get_query_shape('SELECT * FROM t WHERE id IN (%s)  LIMIT 5'),
+        )
+
+    def test_views_within_budget(self):
+        self.client.force_login(self.logged_user)
+        for view_class, url in [
+                (views.CardListView, '/card/?order_by=alph_name'),
+                (views.CardDetailView, '/card/{}/'.format(self.card.pk)),
+                (views.DishListView, '/card/dish'),
+                (api_views.CardAPIList, '/api/cards/'),
+                (api_views.CardAPIDetail, '/api/cards/{}/'.format(
+                    self.card.pk
+                )),
+                (api_views.DishAPIList, '/api/dishes/'),
+                (api_views.DishAPIDetail, '/api/dishes/{}/'.format(
+                    self.card.dishes.first().pk
+                ))]:
+            with assert_query_budget(view_class) as recorder:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                    response['Server-Timing'].split('desc=')[1],
+                    '"{} queries"'.format(recorder.count),
+            )
+
+    def test_n_plus_one_is_detected(self):
+        with self.assertRaisesMessage(AssertionError, 'possible N+1'):
+            with assert_query_budget(views.CardListView):
+                for card in Card.objects.all():
+                    list(card.dishes.all())
+
+    def test_middleware_logs_or_raises(self):
+        with mock.patch.object(views.CardListView, 'query_budget', 0):
+            with self.assertLogs('emenu.query_budget', 'WARNING') as logs:
+                self.client.get('/card/')
+            self.assertIn('budget of CardListView is 0', logs.output[0])
+            with self.settings(QUERY_BUDGET_STRICT=True):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get('/card/?q=menu')
+
+    def test_budget_by_method(self):
+        self.client.force_login(self.logged_user)
+        with mock.patch('emenu.query_budget.logger') as logger_mock:
+            response = self.client.post('/api/cards/', {'name': 'New card'})
+        self.assertEqual(response.status_code, 201)
+        logger_mock.warning.assert_not_called()
+        with mock.patch.object(api_views.CardAPIList, 'query_budget',
+                               {'GET': 6, 'POST': 1}):
+            with self.assertLogs('emenu.query_budget', 'WARNING') as logs:
+                self.client.post('/api/cards/', {'name': 'Other card'})
+            self.assertIn('POST /api/cards/', logs.output[0])
+            with mock.patch('emenu.query_budget.logger') as logger_mock:
+                self.client.get('/api/cards/')
+            logger_mock.warning.assert_not_called()
+
+
+class BenchmarkTest(TestCase):
+    def test_generate_catalogue(self):
+        cards, dishes = Card.objects.count(), Dish.objects.count()
+        call_command(
+                'generate_catalogue', '--cards=20', '--dishes=100',
+                '--dishes-per-card=10', '--users=5', '--batch-size=7',
+                stdout=StringIO(),
+        )
+        generated = Card.objects.filter(name__startswith='Synthetic')
+        self.assertEqual(Card.objects.count(), cards + 20)
+        self.assertEqual(Dish.objects.count(), dishes + 100)
+        self.assertEqual(
+                User.objects.filter(username__startswith='synthetic').count(),
+                5,
+        )
+        for card in generated:
+            self.assertEqual(card.dishes_count, card.dishes.count())
+            self.assertLessEqual(card.dishes_count, 20)
+        self.assertEqual(
+                ChangeLogEntry.objects.filter(
+                        action=ChangeLogEntry.ADD,
+                        card_id__in=generated.values('pk'),
+                ).count(),
+                sum(card.dishes_count for card in generated),
+        )
+        with self.assertRaises(CommandError):
+            call_command('generate_catalogue', stdout=StringIO())
+
+    def test_benchmark_command(self):
+        get_init_data(dishes=False, cards=False)
+        out = StringIO()
+        call_command(
+                'benchmark', 'card_list_view', 'card_api_list', 'email_report',
+                '--repeat=2', stdout=out,
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['dataset']['cards'], Card.objects.count())
+        results = {result['name']: result for result in report['results']}
+        self.assertEqual(
+                set(results), {'card_list_view', 'card_api_list', 'email_report'}
+        )
+        for result in results.values():
+            self.assertEqual(len(result['runs']), 2)
+            self.assertGreater(result['queries']['min'], 0)
+            self.assertGreater(result['peak_memory']['max'], 0)
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'unknown', stdout=StringIO())
+
+    def test_memory_is_measured_separately(self):
+        tracing = []
+        def traced(context):
+            tracing.append(tracemalloc.is_tracing())
+            Card.objects.count()
+        run = measure(traced, BenchmarkContext())
+        self.assertEqual(tracing, [False, True])
+        self.assertEqual(run['queries'], 1)
+        self.assertGreater(run['peak_memory'], 0)
+
+    def test_query_plans(self):
+        out = StringIO()
+        call_command(
+                'benchmark', 'query_card_alph_name_ordering', '--explain',
+                '--repeat=1', stdout=out,
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(
+                [result['name'] for result in report['results']],
+                ['query_card_alph_name_ordering'],
+        )
+        self.assertIn('card_exclude_empty', report['plans'])
+        self.assertTrue(all(report['plans'].values()))
+
+    def test_indexes(self):
+        for table, index, columns in [
+                ('card_card', 'card_creation_date_idx', ['creation_date', 'id']),
+                ('card_card', 'card_last_change_date_idx',
+                 ['last_change_date', 'id']),
+                ('card_dish', 'dish_last_change_date_idx',
+                 ['last_change_date', 'id']),
+                ('card_dish_cards', 'card_dish_cards_card_dish_idx',
+                 ['card_id', 'dish_id'])]:
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                        cursor, table
+                )
+            self.assertEqual(constraints[index]['columns'], columns)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                    cursor, 'card_card'
+            )
+        self.assertIn('card_lower_name_idx', constraints)
+
+
+class PublicMenuTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False, users=False)
+        self.factory = RequestFactory()
+        self.empty_card = Card.objects.create(name='Empty card')
+
+    def get_response(self, headers=None):
+        request = self.factory.get('/api/public/menu/', **(headers or {}))
+        request.user = AnonymousUser()
+        return api_views.PublicMenuView.as_view()(request)
+
+    def test_public_menu(self):
+        with self.assertNumQueries(2):
+            response = self.get_response()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_response().content, response.content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        cards = json.loads(response.content)['results']
+        expected = Card.objects.exclude_empty().order_by('name')
+        self.assertEqual(
+                [card['name'] for card in cards],
+                list(expected.values_list('name', flat=True)),
+        )
+        self.assertNotIn('Empty card', [card['name'] for card in cards])
+        card = Card.objects.get(name=cards[0]['name'])
+        self.assertEqual(
+                [dish['id'] for dish in cards[0]['dishes']],
+                list(card.dishes.order_by('name').values_list('pk', flat=True)),
+        )
+        self.assertEqual(cards[0]['dishes_count'], card.dishes_count)
+
+    def test_same_fields_as_api(self):
+        request = self.factory.get('/api/cards/')
+        request.user = AnonymousUser()
+        response = api_views.CardAPIList.as_view()(request)
+        response.render()
+        api_cards = json.loads(response.content)['results']
+        api_card = next(card for card in api_cards if card['dishes'])
+        public_cards = json.loads(self.get_response().content)['results']
+        card = next(card for card in public_cards
+                    if card['id'] == api_card['id'])
+        for field in ['name', 'description', 'creation_date',
+                      'last_change_date', 'dishes_count']:
+            self.assertEqual(card[field], api_card[field])
+        dish = card['dishes'][0]
+        request = self.factory.get('/api/dishes/{}/'.format(dish['id']))
+        request.user = User.objects.create(username='public_menu_user')
+        response = api_views.DishAPIDetail.as_view()(request, pk=dish['id'])
+        response.render()
+        api_dish = json.loads(response.content)
+        for field in ['name', 'price', 'preparation_time', 'is_vegetarian',
+                      'creation_date']:
+            self.assertEqual(dish[field], api_dish[field])
+
+    def test_not_modified(self):
+        etag = self.get_response()['ETag']
+        with self.assertNumQueries(0):
+            response = self.get_response({'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.empty_card.dishes.add(Dish.objects.first())
+        response = self.get_response({'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 200)
+        cards = json.loads(response.content)['results']
+        self.assertIn('Empty card', [card['name'] for card in cards])
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command(
+                'benchmark', 'public_menu', 'public_menu_cached',
+                'card_api_list_anonymous_all', '--repeat=2', stdout=out,
+        )
+        results = {
+            result['name']: result
+            for result in json.loads(out.getvalue())['results']
+        }
+        self.assertEqual(results['public_menu']['queries']['max'], 2)
+        self.assertEqual(results['public_menu_cached']['queries']['max'], 0)
+        api_requests = -(-Card.objects.exclude_empty().count() // 50)
+        run = results['card_api_list_anonymous_all']['runs'][0]
+        self.assertAlmostEqual(run['requests_per_second'],
+                               api_requests / run['wall_time'])
+
+
+class MenuSnapshotTest(TestCase):
+    def setUp(self):
+        get_menu_cache().clear()
+        get_init_data(dishes=False, cards=False)
+        self.factory = RequestFactory()
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.card = Card.objects.get(name='Menu 5')
+        self.empty_card = Card.objects.create(name='Empty card')
+
+    def get_api_response(self, card, user=None, url=None):
+        request = self.factory.get(url or '/api/cards/{}/'.format(card.pk))
+        request.user = user or self.logged_user
+        response = api_views.CardAPIDetail.as_view()(request, pk=card.pk)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def test_snapshot_same_as_serialized(self):
+        live_response = self.get_api_response(self.card)
+        self.assertEqual(build_snapshots([self.card.pk]), 1)
+        snapshot = MenuSnapshot.objects.get(pk=self.card.pk)
+        self.assertFalse(snapshot.stale)
+        self.assertIn(SNAPSHOT_URL_PREFIX, snapshot.json)
+        with self.assertNumQueries(1):
+            response = self.get_api_response(self.card)
+        self.assertEqual(response.content, live_response.content)
+        self.assertEqual(response['ETag'], live_response['ETag'])
+        self.assertIn(b'http://testserver/api/dishes/', response.content)
+        response = self.get_api_response(
+                self.card, url='/api/cards/{}/?links=ids'.format(self.card.pk)
+        )
+        self.assertNotIn(b'/api/dishes/', response.content)
+
+    def test_empty_card_is_not_public(self):
+        build_snapshots([self.card.pk, self.empty_card.pk])
+        self.assertTrue(MenuSnapshot.objects.get(pk=self.empty_card.pk).is_empty)
+        response = self.get_api_response(self.empty_card, AnonymousUser())
+        self.assertEqual(response.status_code, 404)
+        response = self.get_api_response(self.empty_card)
+        self.assertEqual(response.status_code, 200)
+
+    def test_change_marks_snapshot_stale(self):
+        build_snapshots([self.card.pk])
+        dish = self.card.dishes.first()
+        dish.name = 'Renamed dish'
+        with mock.patch('emenu.tasks.rebuild_menu_snapshots.apply_async') \
+                as apply_mock:
+            with self.captureOnCommitCallbacks(execute=True):
+                dish.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.card.dishes.remove(dish)
+        snapshot = MenuSnapshot.objects.get(pk=self.card.pk)
+        self.assertTrue(snapshot.stale)
+        self.assertEqual(snapshot.version, 2)
+        # second change is coalesced with the pending rebuild
+        self.assertEqual(apply_mock.call_count, 1)
+        self.assertIn(self.card.pk, apply_mock.call_args[0][0][0])
+        response = self.get_api_response(self.card)
+        self.assertEqual(
+                len(json.loads(response.content)['dishes']),
+                self.card.dishes.count(),
+        )
+        build_snapshots([self.card.pk])
+        with mock.patch('emenu.tasks.rebuild_menu_snapshots.apply_async') \
+                as apply_mock:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.card.save()
+        self.assertEqual(apply_mock.call_count, 1)
+
+    def test_broker_errors_are_logged(self):
+        with mock.patch('emenu.tasks.rebuild_menu_snapshots.apply_async',
+                        side_effect=KombuOperationalError('No broker')):
+            with self.assertLogs('card.snapshots', 'WARNING') as logs:
+                schedule_snapshot_rebuild([self.card.pk])
+        self.assertIn('No broker', logs.output[0])
+        get_menu_cache().clear()
+        with mock.patch('emenu.tasks.rebuild_menu_snapshots.apply_async',
+                        side_effect=TypeError('Bug')):
+            with self.assertRaises(TypeError):
+                schedule_snapshot_rebuild([self.card.pk])
+
+    def test_snapshot_changed_during_build_is_not_saved(self):
+        def render_and_change(card):
+            MenuSnapshot.objects.mark_stale([card.pk])
+            return ''
+
+        with mock.patch('card.snapshots.render_card_html',
+                        side_effect=render_and_change):
+            self.assertEqual(build_snapshots([self.card.pk]), 0)
+        self.assertTrue(MenuSnapshot.objects.get(pk=self.card.pk).stale)
+
+    def test_rebuild_task(self):
+        eager_settings = {
+            'CELERY_TASK_ALWAYS_EAGER': True,
+            'CELERY_TASK_EAGER_PROPAGATES': True,
+            'CELERY_BROKER_URL': 'memory://',
+            'CELERY_RESULT_BACKEND': 'cache+memory://',
+        }
+        old_settings = {name: celery_app.conf[name] for name in eager_settings}
+        celery_app.conf.update(eager_settings)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.card.dishes.add(Dish.objects.get(name='Dish 19'))
+        finally:
+            celery_app.conf.update(old_settings)
+        snapshot = MenuSnapshot.objects.get(pk=self.card.pk)
+        self.assertFalse(snapshot.stale)
+        self.assertIn('Dish 19', snapshot.html)
+
+    def test_html_detail_view(self):
+        build_snapshots([self.card.pk])
+        request = self.factory.get('/card/{}/'.format(self.card.pk))
+        request.user = self.logged_user
+        with self.assertNumQueries(1):
+            response = views.CardDetailView.as_view()(
+                    request, pk=self.card.pk
+            ).render()
+        content = response.content.decode('utf-8')
+        self.assertIn('/card/{}/edit/'.format(self.card.pk), content)
+        for dish in self.card.dishes.all():
+            self.assertIn(dish.name, content)
+
+    def test_rebuild_command(self):
+        out = StringIO()
+        call_command('rebuild_menu_snapshots', stdout=out)
+        self.assertEqual(
+                out.getvalue().strip(),
+                'Rebuilt {0} of {0} snapshots'.format(Card.objects.count()),
+        )
+        call_command('rebuild_menu_snapshots', stdout=out)
+        self.assertIn('Rebuilt 0 of 0 snapshots', out.getvalue())
+
+
+class AsyncViewsTest(TransactionTestCase):
+    '''
+    Async views query the database from other threads (other connections),
+    so the data of the tests has to be committed
+    '''
+    # menu cards and dishes created by migrations
+    serialized_rollback = True
+
+    def setUp(self):
+        # connections of other threads are closed after every request
+        conn_max_age = mock.patch.dict(connection.settings_dict,
+                                       CONN_MAX_AGE=0)
+        conn_max_age.start()
+        self.addCleanup(conn_max_age.stop)
+        get_init_data(dishes=False, cards=False)
+        self.logged_user = User.objects.get(username='test_user_1')
+        self.empty_card = Card.objects.create(name='Empty card')
+
+    async def test_card_list(self):
+        response = await self.async_client.get('/api/async/cards/')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        expected = await sync_to_async(list)(Card.objects
+                .exclude_empty()
+                .order_by('pk')
+                .values_list('pk', flat=True)
+        )
+        self.assertEqual([card['id'] for card in data['results']], expected)
+        self.assertIsNone(data['next'])
+        card = data['results'][0]
+        dish_ids = await sync_to_async(list)(Dish.objects
+                .filter(cards=card['id'])
+                .order_by('pk')
+                .values_list('pk', flat=True)
+        )
+        self.assertEqual(card['dishes'], dish_ids)
+        response = await self.async_client.get(
+                '/api/async/cards/?limit=2&after={}'.format(expected[0])
+        )
+        data = json.loads(response.content)
+        self.assertEqual(
+                [card['id'] for card in data['results']], expected[1:3]
+        )
+        self.assertEqual(data['next'], expected[2])
+        response = await self.async_client.get('/api/async/cards/?limit=0')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_card_detail(self):
+        url = '/api/async/cards/{}/'.format(self.empty_card.pk)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 404)
+        await sync_to_async(self.async_client.force_login)(self.logged_user)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['dishes'], [])
+        response = await self.async_client.post(url)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_dishes(self):
+        dish = await sync_to_async(Dish.objects.order_by('pk').first)()
+        url = '/api/async/dishes/{}/'.format(dish.pk)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 403)
+        await sync_to_async(self.async_client.force_login)(self.logged_user)
+        response = await self.async_client.get(url)
+        data = json.loads(response.content)
+        self.assertEqual(data['price'], str(dish.price))
+        card_ids = await sync_to_async(list)(
+                dish.cards.order_by('pk').values_list('pk', flat=True)
+        )
+        self.assertEqual(data['cards'], card_ids)
+        response = await self.async_client.get('/api/async/dishes/?limit=3')
+        data = json.loads(response.content)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['results'][0]['id'], dish.pk)
+
+    def test_asgi_benchmark(self):
+        results = run_asgi_benchmarks(
+                ['card_list', 'dish_list'], clients=5, requests=10,
+                delay=0.001, user=self.logged_user,
+        )
+        self.assertEqual(
+                [result['name'] for result in results],
+                ['card_list', 'dish_list'],
+        )
+        for result in results:
+            for kind in ['sync', 'async']:
+                self.assertEqual(result[kind]['errors'], 0)
+                self.assertGreater(result[kind]['requests_per_second'], 0)
+
+    def test_async_requests_run_in_parallel(self):
+        # the await is inside of all middleware - sync only middleware
+        # would serialize the requests (concurrency 1)
+        result = run_pipeline_benchmark(clients=10, delay=0.2)
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['concurrency'], 5)
+
+    def test_queries_of_async_views_are_counted(self):
+        response = self.client.get('/api/async/cards/')
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'"[1-9]\d* queries"')
+
+
+class DatabasePoolTest(TestCase):
+    def setUp(self):
+        self.conn_params = connection.get_connection_params()
+
+    def get_wrapper(self, alias, **settings_dict):
+        settings_dict = dict(connection.settings_dict, **settings_dict)
+        wrapper = PooledDatabaseWrapper(settings_dict, alias)
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_pool_reuses_and_limits_connections(self):
+        pool = ConnectionPool(self.conn_params, max_size=2, timeout=0.1)
+        self.addCleanup(pool.closeall)
+        first, second = pool.getconn(), pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(), first)
+        pool.putconn(first)
+        pool.putconn(second)
+        stats = pool.get_stats()
+        self.assertEqual(stats['opened'], 2)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual((stats['in_use'], stats['idle']), (0, 2))
+
+    def test_pool_replaces_broken_connections(self):
+        pool = ConnectionPool(
+                self.conn_params, max_size=1, health_check_after=0,
+        )
+        self.addCleanup(pool.closeall)
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        # open transaction is rolled back
+        pool.putconn(conn)
+        self.assertEqual(
+                conn.info.transaction_status,
+                psycopg2_extensions.TRANSACTION_STATUS_IDLE,
+        )
+        conn.close()
+        new_conn = pool.getconn()
+        self.assertIsNot(new_conn, conn)
+        self.assertFalse(new_conn.closed)
+        pool.putconn(new_conn)
+        self.assertEqual(pool.get_stats()['health_check_failures'], 1)
+
+    def test_pooled_backend(self):
+        wrapper = self.get_wrapper(
+                'pool_test', CONN_MAX_AGE=0, POOL={'MAX_SIZE': 1},
+        )
+        self.addCleanup(db_pool_module._pools.pop, 'pool_test', None)
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        raw_connection = wrapper.connection
+        wrapper.close()
+        self.assertFalse(raw_connection.closed)
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertIs(wrapper.connection, raw_connection)
+        stats = get_pool_stats()['pool_test']
+        self.assertEqual((stats['opened'], stats['checkouts']), (1, 2))
+        wrapper.close()
+        db_pool_module._pools['pool_test'].closeall()
+
+    def test_health_checks(self):
+        wrapper = self.get_wrapper(
+                'health_check_test', CONN_MAX_AGE=None, CONN_HEALTH_CHECKS=True,
+        )
+        wrapper.ensure_connection()
+        raw_connection = wrapper.connection
+        # start of the next request, connection is broken while idle
+        wrapper.close_if_unusable_or_obsolete()
+        self.assertIs(wrapper.connection, raw_connection)
+        raw_connection.close()
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertIsNot(wrapper.connection, raw_connection)
+
+    def test_stats(self):
+        out = StringIO()
+        call_command('db_pool_stats', stdout=out)
+        stats = json.loads(out.getvalue())
+        self.assertIn('default', stats['settings'])
+        self.assertIn('health_checks', stats['settings']['default'])
+        self.assertTrue(stats['server']['default'])
+        response = self.client.get('/__db_pool__/')
+        self.assertEqual(response.status_code, 302)
+        staff = User.objects.create(username='staff_user', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get('/__db_pool__/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['pid'], stats['pid'])
+
+
+class ReplicaRoutingTest(TestCase):
+    '''
+    Replica is stood in by an in-memory SQLite database with its own
+    (replicated) data, the primary is the test database
+    '''
+    alias = 'replica_test'
+
+    def setUp(self):
+        connections.databases[self.alias] = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:',
+        }
+        connections.ensure_defaults(self.alias)
+        connections.prepare_test_settings(self.alias)
+        self.addCleanup(connections.databases.pop, self.alias)
+        self.addCleanup(connections.__delitem__, self.alias)
+        self.addCleanup(connections[self.alias].close)
+        with connections[self.alias].schema_editor() as editor:
+            editor.create_model(Card)
+            editor.create_model(Dish)
+        replica_card = Card.objects.using(self.alias).create(
+            name='Replica card', dishes_count=1,
+        )
+        replica_dish = Dish.objects.using(self.alias).create(
+            name='Replica dish', price=1, preparation_time=1,
+        )
+        # related managers write to the primary (see ReplicaRouter)
+        Dish.cards.through.objects.using(self.alias).create(
+            card_id=replica_card.pk, dish_id=replica_dish.pk,
+        )
+        Card.objects.create(name='Primary card', dishes_count=1)
+        self.router = ReplicaRouter()
+        self.user = User.objects.create(username='replica_user')
+        # replicas have all changes made before the sticky period
+        get_menu_cache().clear()
+        get_menu_cache().set(
+                get_version_key(), time_ns() - 60 * 10**9, timeout=None
+        )
+
+    def get_card_names(self):
+        response = self.client.get('/api/cards/')
+        self.assertEqual(response.status_code, 200)
+        return [card['name'] for card in response.json()['results']]
+
+    def test_router(self):
+        with self.settings(DATABASE_REPLICAS=[self.alias]):
+            self.assertEqual(self.router.db_for_read(Card), 'default')
+            with use_replicas() as state:
+                self.assertEqual(self.router.db_for_read(Card), self.alias)
+                self.assertEqual(self.router.db_for_write(Card), 'default')
+                self.assertTrue(state.wrote)
+                # reads after write see it
+                self.assertEqual(self.router.db_for_read(Card), 'default')
+            with use_replicas(enabled=False):
+                self.assertEqual(self.router.db_for_read(Card), 'default')
+            self.assertFalse(self.router.allow_migrate(self.alias, 'card'))
+            self.assertIsNone(self.router.allow_migrate('default', 'card'))
+        with use_replicas():
+            self.assertEqual(self.router.db_for_read(Card), 'default')
+
+    def test_sticky_after_write(self):
+        with self.settings(DATABASE_REPLICAS=[self.alias]):
+            self.assertEqual(self.get_card_names(), ['Replica card'])
+            self.assertNotIn(STICKY_COOKIE_NAME, self.client.cookies)
+
+            self.client.force_login(self.user)
+            response = self.client.post('/api/cards/', {'name': 'New card'})
+            self.assertEqual(response.status_code, 201)
+            self.assertIn(STICKY_COOKIE_NAME, response.cookies)
+            # authenticated request reads session and user from the primary
+            names = self.get_card_names()
+            self.assertIn('New card', names)
+            self.assertNotIn('Replica card', names)
+
+            self.client.logout()
+            self.client.cookies[STICKY_COOKIE_NAME] = '0'
+            self.assertEqual(self.get_card_names(), ['Replica card'])
+
+    def test_basic_authenticated_user_sticks(self):
+        self.user.set_password('pass')
+        self.user.save()
+        auth = 'Basic {}'.format(
+                base64.b64encode(b'replica_user:pass').decode('ascii')
+        )
+        with self.settings(DATABASE_REPLICAS=[self.alias]):
+            response = self.client.post(
+                    '/api/cards/', {'name': 'New card'},
+                    HTTP_AUTHORIZATION=auth,
+            )
+            self.assertEqual(response.status_code, 201)
+            self.client.cookies.clear()
+            response = self.client.get('/api/cards/',
+                                       HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.status_code, 200)
+            names = [card['name'] for card in response.json()['results']]
+            self.assertIn('New card', names)
+            self.assertNotIn('Replica card', names)
+            # other clients are not affected
+            self.assertEqual(self.get_card_names(), ['Replica card'])
+
+    def test_recently_changed_content_is_read_from_primary(self):
+        with self.settings(DATABASE_REPLICAS=[self.alias]):
+            bump_versions()
+            self.assertNotIn('Replica card', self.get_card_names())
+            response = self.client.get('/api/public/menu/')
+            self.assertNotIn(b'Replica card', response.content)
+            get_menu_cache().set(
+                    get_version_key(), time_ns() - 60 * 10**9, timeout=None
+            )
+            self.assertEqual(self.get_card_names(), ['Replica card'])
+
+    def test_report_reads_from_replica(self):
+        dish_names = []
+
+        def get_report_message(*args):
+            dish_names.extend(Dish.objects.values_list('name', flat=True))
+            return ''
+
+        command = 'card.management.commands.email_report.{}'
+        with self.settings(DATABASE_REPLICAS=[self.alias]), \
+                mock.patch(command.format('get_report_message'),
+                           get_report_message), \
+                mock.patch(command.format('iter_recipient_batches'),
+                           return_value=[]):
+            call_command('email_report', '--restart', stdout=StringIO())
+        self.assertEqual(dish_names, ['Replica dish'])
+
+
+class StartupTest(TestCase):
+    def test_parse_import_times(self):
+        output = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       120 |        120 |     celery.local',
+            'import time:       300 |        420 |   celery.five',
+            'import time:      1000 |       1420 | celery',
+            'Traceback of other output',
+        ])
+        imports = parse_import_times(output)
+        self.assertEqual(imports, [
+            ('celery.local', 0.00012, 0.00012, 2),
+            ('celery.five', 0.0003, 0.00042, 1),
+            ('celery', 0.001, 0.00142, 0),
+        ])
+        self.assertEqual(get_package_times(imports), {'celery': 0.00142})
+
+    def test_entry_points_do_not_import_unused_packages(self):
+        for entry_point in ['web', 'command']:
+            _, imports = run_entry_point(entry_point, importtime=True)
+            packages = get_package_times(imports)
+            self.assertIn('card', packages)
+            self.assertNotIn('celery', packages)
+            if not settings.DEBUG:
+                self.assertNotIn('debug_toolbar', packages)
+                self.assertNotIn('rest_framework_swagger', packages)
+
+    def test_profile_imports(self):
+        out = StringIO()
+        call_command('profile_imports', 'worker', '--limit=5', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(list(report), ['worker'])
+        self.assertGreater(report['worker']['modules'], 0)
+        self.assertEqual(len(report['worker']['slowest_self']), 5)
+        self.assertEqual(len(report['worker']['packages']), 5)
+        with self.assertRaises(CommandError):
+            call_command('profile_imports', 'unknown', stdout=StringIO())
+
+    def test_cold_start_benchmark(self):
+        out = StringIO()
+        call_command(
+                'benchmark', 'cold_start_command', '--repeat=1', stdout=out,
+        )
+        result = json.loads(out.getvalue())['results'][0]
+        self.assertEqual(result['name'], 'cold_start_command')
+        self.assertGreater(result['wall_time']['min'], 0)
+        self.assertEqual(result['queries']['max'], 0)
+
+
+class StaticFilesTest(TestCase):
+    css = 'body { background: url("../images/banner.jpg"); }\n' * 50 + \
+        '.video { background: url("missing.png"); }\n'
+
+    def setUp(self):
+        source = TemporaryDirectory()
+        root = TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        for path, content in [
+                ('css/menu.css', self.css.encode()),
+                ('images/banner.jpg', b'\xff\xd8\xff' + b'\x00' * 100)]:
+            path = Path(source.name, path)
+            path.parent.mkdir()
+            path.write_bytes(content)
+        override = self.settings(
+                STATICFILES_STORAGE='emenu.storage.StaticFilesStorage',
+                STATICFILES_DIRS=[source.name],
+                STATICFILES_FINDERS=[
+                    'django.contrib.staticfiles.finders.FileSystemFinder',
+                ],
+                STATIC_ROOT=root.name,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        with self.assertLogs('emenu.storage', 'WARNING'):
+            call_command('collectstatic', '--noinput', verbosity=0)
+        self.url = static('css/menu.css')
+
+    def get(self, url, accept_encoding=''):
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_collectstatic(self):
+        self.assertRegex(self.url, r'^/static/css/menu\.[0-9a-f]{12}\.css$')
+        css = (self.root / self.url[len('/static/'):]).read_text()
+        self.assertRegex(css, r'\.\./images/banner\.[0-9a-f]{12}\.jpg')
+        # missing file does not fail collectstatic
+        self.assertIn('url("missing.png")', css)
+        for suffix in ['.gz', '.br']:
+            self.assertTrue(
+                    (self.root / (self.url[len('/static/'):] + suffix)).exists()
+            )
+        # already compressed formats are not compressed again
+        self.assertEqual(list((self.root / 'images').glob('*.gz')), [])
+
+    def test_serving(self):
+        response, content = self.get(self.url, 'gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertIn('immutable', response['Cache-Control'])
+        css = brotli.decompress(content).decode()
+        response, content = self.get(self.url, 'gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(content).decode(), css)
+        response, content = self.get(self.url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(content.decode(), css)
+        # file without hash in the name can change
+        response, _ = self.get('/static/css/menu.css', 'br')
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    async def test_serving_async(self):
+        # headers of the async client have no HTTP_ prefix
+        response = await self.async_client.get(
+                self.url, **{'accept-encoding': 'br'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_missing_manifest(self):
+        with TemporaryDirectory() as root, self.settings(STATIC_ROOT=root):
+            storage = StaticFilesStorage()
+            with self.assertLogs('emenu.storage', 'ERROR') as logs:
+                self.assertEqual(storage.url('css/menu.css'),
+                        '/static/css/menu.css')
+                storage.url('images/banner.jpg')
+            # logged only once
+            self.assertEqual(len(logs.records), 1)
+            storage = StaticFilesStorage()
+            with self.settings(DEBUG=True):
+                storage.hashed_name('css/menu.css')
+            self.assertFalse(storage.manifest_missing_logged)
+
+
+class TemplateFragmentTest(TestCase):
+    def setUp(self):
+        self.card = Card.objects.create(name='Fragment card')
+        self.dish = Dish.objects.create(
+                name='Fragment dish', price=10, preparation_time=5,
+        )
+        self.dish.cards.add(self.card)
+        self.user = User.objects.create(username='fragment_user')
+        self.client.force_login(self.user)
+
+    def test_cached_loader(self):
+        loaders = engines['django'].engine.template_loaders
+        self.assertEqual(
+                [type(loader) for loader in loaders], [CachedLoader],
+        )
+
+    def test_dish_rows(self):
+        self.assertIn('Fragment dish', render_card_html(self.card))
+        # rows are cached with the time of the last change
+        Dish.objects.filter(pk=self.dish.pk).update(name='Renamed dish')
+        self.assertIn('Fragment dish', render_card_html(self.card))
+        self.dish.name = 'Renamed dish'
+        self.dish.save()
+        html = render_card_html(self.card)
+        self.assertIn('Renamed dish', html)
+        self.assertNotIn('Fragment dish', html)
+        response = self.client.get('/card/dish')
+        self.assertContains(response, 'Renamed dish')
+
+    def test_card_rows(self):
+        self.assertContains(self.client.get('/card/'), 'Fragment dish')
+        # name of the dish is in the row of the card, which did not change;
+        # rows do not depend on cache versions (bumped after commit)
+        self.dish.name = 'Renamed dish'
+        self.dish.save()
+        response = self.client.get('/card/')
+        self.assertContains(response, 'Renamed dish')
+        self.assertNotContains(response, 'Fragment dish')
+        Dish.cards.through.objects.filter(dish=self.dish).delete()
+        response = self.client.get('/card/')
+        self.assertNotContains(response, 'Renamed dish')
+
+    def test_large_card_benchmark(self):
+        out = StringIO()
+        call_command(
+                'benchmark', 'card_detail_large', 'card_detail_large_uncached',
+                '--repeat=2', stdout=out,
+        )
+        results = json.loads(out.getvalue())['results']
+        self.assertEqual(
+                [result['name'] for result in results],
+                ['card_detail_large', 'card_detail_large_uncached'],
+        )
+        self.assertTrue(
+                Card.objects.filter(name__startswith='Benchmark card').exists()
+        )
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        get_init_data(users=False)
+        get_menu_cache().clear()
+
+    def get_value(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_metrics(self):
+        labels = {'view': 'card-ui-list', 'method': 'GET', 'status': '200'}
+        requests = self.get_value(
+                'emenu_request_duration_seconds_count', **labels
+        )
+        queries = self.get_value(
+                'emenu_request_queries_sum', view='card-ui-list'
+        )
+        hits = self.get_value(
+                'emenu_cache_requests_total', cache='page', result='hit'
+        )
+        misses = self.get_value(
+                'emenu_cache_requests_total', cache='page', result='miss'
+        )
+        self.client.get('/card/')
+        self.client.get('/card/')
+        self.assertEqual(
+                self.get_value('emenu_request_duration_seconds_count',
+                               **labels),
+                requests + 2,
+        )
+        self.assertGreater(
+                self.get_value('emenu_request_queries_sum',
+                               view='card-ui-list'),
+                queries,
+        )
+        # second page is served from the cache
+        self.assertEqual(
+                self.get_value('emenu_cache_requests_total', cache='page',
+                               result='miss'),
+                misses + 1,
+        )
+        self.assertEqual(
+                self.get_value('emenu_cache_requests_total', cache='page',
+                               result='hit'),
+                hits + 1,
+        )
+        with self.settings(METRICS_TOKEN='secret'):
+            response = self.client.get(
+                    '/metrics', HTTP_AUTHORIZATION='Bearer secret',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(
+                response,
+                'emenu_request_duration_seconds_count{method="GET",'
+                'status="200",view="card-ui-list"}',
+        )
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get(
+                    '/metrics', HTTP_AUTHORIZATION='Bearer secret',
+            )
+            self.assertEqual(response.status_code, 200)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+        user = User.objects.create(username='metrics_user')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_worker_server_requires_multiprocess_dir(self):
+        with self.settings(METRICS_WORKER_PORT=9100), \
+                mock.patch('emenu.metrics.start_http_server') as server_mock:
+            with mock.patch.dict(os.environ):
+                os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+                with self.assertLogs('emenu.metrics', 'ERROR'):
+                    start_worker_server()
+            server_mock.assert_not_called()
+            directory = TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            with mock.patch.dict(
+                    os.environ, PROMETHEUS_MULTIPROC_DIR=directory.name):
+                start_worker_server()
+            self.assertEqual(server_mock.call_args[0], (9100,))
+
+    def test_task_metrics(self):
+        task = tasks.rebuild_menu_snapshots
+        runs = self.get_value(
+                'emenu_task_duration_seconds_count', task=task.name,
+                state='SUCCESS',
+        )
+        failures = self.get_value(
+                'emenu_task_failures_total', task=task.name,
+        )
+        eager_settings = {
+            'CELERY_BROKER_URL': 'memory://',
+            'CELERY_RESULT_BACKEND': 'cache+memory://',
+        }
+        old_settings = {name: celery_app.conf[name] for name in eager_settings}
+        celery_app.conf.update(eager_settings)
+        self.addCleanup(celery_app.conf.update, old_settings)
+        task.apply(args=([],))
+        task.apply(args=(None,))
+        self.assertEqual(
+                self.get_value('emenu_task_duration_seconds_count',
+                               task=task.name, state='SUCCESS'),
+                runs + 1,
+        )
+        self.assertEqual(
+                self.get_value('emenu_task_failures_total', task=task.name),
+                failures + 1,
+        )
+
+    def test_multiprocess(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        code = ('from emenu.metrics import TASK_FAILURES\n'
+                'TASK_FAILURES.labels("emenu.tasks.test").inc()')
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory.name)
+        for _ in range(2):
+            subprocess.run([sys.executable, '-c', code], env=env, check=True)
+        with mock.patch.dict(os.environ, env):
+            registry = get_metrics_registry()
+        self.assertEqual(
+                registry.get_sample_value(
+                        'emenu_task_failures_total',
+                        {'task': 'emenu.tasks.test'},
+                ),
+                2,
+        )
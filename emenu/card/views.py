@@ -1,19 +1,26 @@
 from datetime import datetime
 from re import match
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ValidationError
-from django.db.models import Count
 from django.db.models.functions import Lower
 from django.forms import CharField
+from django.http import HttpResponse
 from django.urls import reverse_lazy
 from django.views.generic import (CreateView, DeleteView, DetailView,
         ListView, UpdateView)
 from django.views.generic.edit import FormMixin
 
+from emenu.metrics import record_cache_lookup
+
+from .cache import (get_menu_cache, get_menu_version, get_object_version,
+        get_page_cache_key, use_primary_if_recent)
 from .forms import CardListForm
 from .models import Card, Dish
+from .pagination import InvalidCursor, KeysetPaginator
+from .snapshots import get_fresh_snapshot
 
 
 def fmt_str_to_date(date_as_str):
@@ -60,6 +67,17 @@ def filter_qs_by_str_date(queryset, request, field_name):
     date = fmt_str_to_date(date_as_str)
     return queryset.filter(**{field_name: date})
 
+def get_dishes_key(dishes):
+    '''
+    Returns part of the cache key of a table row listing given dishes -
+    their ids and times of the last change, so the cached row changes
+    whenever any of its dishes is changed, added or removed
+    '''
+    return '|'.join(
+        '{}:{}'.format(dish.pk, dish.last_change_date.isoformat())
+        for dish in dishes
+    )
+
 
 class EmenuLoginRequiredMixin(LoginRequiredMixin):
     '''
@@ -84,10 +102,91 @@ class NoStripMixin(EmenuLoginRequiredMixin):
         return form
 
 
-class CardListView(FormMixin, ListView):
+class MenuCacheMixin():
+    '''
+    Custom mixin that caches pages rendered for anonymous users;
+    cache key contains path, get parameters and version of the content
+    (see card.cache), which is moved forward by every change of cards
+    and dishes, so stale page is never served; pages of recently changed
+    content are read from the primary database, not from replicas
+    '''
+    def get_cache_version(self):
+        return get_menu_version()
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated:
+            return super().dispatch(request, *args, **kwargs)
+
+        cache = get_menu_cache()
+        timeout = getattr(settings, 'MENU_CACHE_TIMEOUT', 60 * 60)
+        version = self.get_cache_version()
+        key = get_page_cache_key(request, version)
+        content = cache.get(key)
+        record_cache_lookup('page', content is not None)
+        if content is not None:
+            return HttpResponse(content)
+
+        use_primary_if_recent(version)
+
+        response = super().dispatch(request, *args, **kwargs)
+
+        def cache_response(response):
+            # pages with messages (e.g. invalid filter) are not cached
+            if not len(messages.get_messages(request)):
+                cache.set(key, response.content, timeout)
+
+        if response.status_code == 200:
+            response.add_post_render_callback(cache_response)
+        return response
+
+
+class KeysetPaginationMixin():
+    '''
+    Custom mixin that replaces default (offset based) pagination of
+    ListView with KeysetPaginator; page is selected by 'cursor' get
+    parameter and its ordering is taken from the queryset
+    '''
+    paginate_by = 50
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size)
+        cursor = self.request.GET.get(self.cursor_query_param, None)
+        try:
+            page = paginator.page(cursor)
+        except InvalidCursor as e:
+            messages.error(self.request, e)
+            page = paginator.page()
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_page_query(self, cursor):
+        '''
+        Returns query string of current request with cursor replaced,
+        so links to other pages keep filters and ordering
+        '''
+        query_dict = self.request.GET.copy()
+        query_dict[self.cursor_query_param] = cursor
+        return query_dict.urlencode()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context.get('page_obj', None)
+        if page is not None and page.has_next():
+            context['next_page_query'] = self.get_page_query(page.next_cursor)
+        if page is not None and page.has_previous():
+            context['previous_page_query'] = self.get_page_query(
+                    page.previous_cursor
+            )
+        return context
+
+
+class CardListView(MenuCacheMixin, KeysetPaginationMixin, FormMixin,
+        ListView):
     '''
     List all menu cards using django generic view; 
     accepts following get parameters:
+    'q' - equal to Card.objects.search(value), results are ordered by rank
+      unless 'order_by' is given
     'name' - equal to Card.objects.filter(name__icontains=value)
     'creation_date__gte' - Card.objects.filter(creation_date__gte=value)
     'creation_date__lte' - Card.objects.filter(creation_date__gte=value)
@@ -98,10 +197,22 @@ class CardListView(FormMixin, ListView):
       '-alph_name' - alphabetically by name (descending
       'dishes_count' - by number of dishes (ascending)
       '-dishes_count' - by number of dishes (descending),
+      'creation_date', 'last_change_date' - by date (ascending)
+      '-creation_date', '-last_change_date' - by date (descending)
+    'cursor' - page of the results, as returned in links to next/previous page
     '''
     form_class = CardListForm
     model = Card
     template_name = 'card_list.html'
+    # session, user, cards, prefetched dishes
+    query_budget = 4
+    ordering_annotations = {
+        'alph_name': Lower('name'),
+        'dishes_count': None,
+        'name': None,
+        'creation_date': None,
+        'last_change_date': None,
+    }
 
     def order_queryset(self, queryset, query_dict):
         '''
@@ -110,19 +221,26 @@ class CardListView(FormMixin, ListView):
         '-alph_name' - alphabetically by name (descending
         'dishes_count' - by number of dishes (ascending)
         '-dishes_count' - by number of dishes (descending),
+        'creation_date', 'last_change_date' - by date (ascending)
+        '-creation_date', '-last_change_date' - by date (descending)
+        Unknown values are ignored and queryset is ordered by search rank
+        (if 'q' was given) or id (cursor pagination needs deterministic order)
         '''
-        order_by = query_dict.get('order_by', None)
-        if not order_by:
-            return queryset
-        if 'dishes' in order_by:
-            queryset = queryset.annotate(dishes_count=Count('dishes'))
-        if 'alph_name' in order_by:
-            queryset = queryset.annotate(alph_name=Lower('name'))
+        order_by = query_dict.get('order_by', None) or ''
+        field_name = order_by.lstrip('-')
+        if field_name not in self.ordering_annotations:
+            if query_dict.get('q', None):
+                return queryset.order_by('-search_rank')
+            return queryset.order_by('pk')
+        annotation = self.ordering_annotations[field_name]
+        if annotation is not None:
+            queryset = queryset.annotate(**{field_name: annotation})
         return queryset.order_by(order_by)
 
     def filter_queryset(self, queryset):
         '''
         Filters the queryset depending on get parameter and it's value
+         'q' - equal to Card.objects.search(value)
          'name' - equal to Card.objects.filter(name__icontains=value)
          'creation_date__gte' - Card.objects.filter(creation_date__gte=value)
          'creation_date__lte' - Card.objects.filter(creation_date__gte=value)
@@ -131,6 +249,10 @@ class CardListView(FormMixin, ListView):
         '''
         query_dict = self.request.GET
 
+        query = query_dict.get('q', None)
+        if query:
+            queryset = queryset.search(query)
+
         name = query_dict.get('name', None)
         if name:
             queryset = queryset.filter(name__icontains=name)
@@ -158,17 +280,43 @@ class CardListView(FormMixin, ListView):
         '''
         queryset = super().get_queryset()
         if not self.request.user.is_authenticated:
-            queryset = queryset.filter(dishes__isnull=False)
+            queryset = queryset.exclude_empty()
         queryset = queryset.prefetch_related('dishes')
-        return self.filter_queryset(queryset).distinct()
+        return self.filter_queryset(queryset)
+
+    def get_context_data(self, **kwargs):
+        '''
+        Rows of the cards are cached (see card_list.html) with keys of
+        their (prefetched) dishes, see get_dishes_key
+        '''
+        context = super().get_context_data(**kwargs)
+        for card in context['object_list']:
+            card.dishes_key = get_dishes_key(card.dishes.all())
+        return context
 
 
-class CardDetailView(DetailView):
+class CardDetailView(MenuCacheMixin, DetailView):
     '''
-    View specific card using django generic view
+    View specific card using django generic view; card and its dishes
+    are rendered from the snapshot (see card.snapshots) if it is fresh
     '''
     model = Card
     template_name = 'card_detail.html'
+    # session, user, snapshot (if it is not fresh: card, dishes)
+    query_budget = 5
+
+    def get_cache_version(self):
+        return get_object_version('card', self.kwargs['pk'])
+
+    def get(self, request, *args, **kwargs):
+        snapshot = get_fresh_snapshot(self.kwargs['pk'], ['html'])
+        if snapshot is None:
+            return super().get(request, *args, **kwargs)
+        self.object = snapshot
+        context = self.get_context_data(
+            object=snapshot, snapshot_html=snapshot.html,
+        )
+        return self.render_to_response(context)
 
 
 class CardCreateView(NoStripMixin, CreateView):
@@ -198,13 +346,26 @@ class CardDeleteView(EmenuLoginRequiredMixin, DeleteView):
     template_name = 'confirm_delete.html'
 
 
-class DishListView(NoStripMixin, ListView):
+class DishListView(NoStripMixin, KeysetPaginationMixin, ListView):
     '''
-    List all dishes using django generic view
+    List all dishes using django generic view;
+    accepts following get parameters:
+    'q' - equal to Dish.objects.search(value), results are ordered by rank
+    'cursor' - page of the results, as returned in links to next/previous page
     '''
     model = Dish
+    ordering = ['name']
+    # session, user, dishes
+    query_budget = 3
     template_name = 'dish_list.html'
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        query = self.request.GET.get('q', None)
+        if query:
+            queryset = queryset.search(query).order_by('-search_rank')
+        return queryset
+
 
 class DishDetailView(EmenuLoginRequiredMixin, DetailView):
     '''
@@ -1,3 +1,3 @@
-from .celery import app as celery_app
-
-__all__ = ("celery_app",)
+# Celery app (emenu.celery) is not imported here, so web processes and
+# management commands do not import Celery until they send a task
+# (emenu.tasks imports the app); workers load it with 'celery -A emenu'
@@ -1,7 +1,12 @@
 """
 ASGI config for eMenu project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``,
+served e.g. by uvicorn (see emenu-asgi service of docker-compose.yml):
+
+    uvicorn emenu.asgi:application
+
+Async read views of cards and dishes are in card.async_views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -1,10 +1,26 @@
 import os
 
 from celery import Celery
+from celery.schedules import crontab
+from celery.signals import task_failure, task_postrun, task_prerun, worker_ready
+
+from emenu import metrics
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "emenu.settings")
 
-app = Celery("emenu")
+app = Celery("emenu", include=["emenu.tasks"])
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+app.conf.beat_schedule = {
+    'send_email_report' : {
+        'task': 'emenu.tasks.send_email_report',
+        'schedule': crontab(hour=10, minute=0),
+    },
+}
+
+# durations and failures of tasks (see emenu.metrics)
+task_prerun.connect(metrics.record_task_start)
+task_postrun.connect(metrics.record_task_end)
+task_failure.connect(metrics.record_task_failure)
+worker_ready.connect(metrics.start_worker_server)
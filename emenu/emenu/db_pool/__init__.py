@@ -0,0 +1,3 @@
+from .pool import ConnectionPool, PoolTimeout, get_pool_stats
+
+__all__ = ('ConnectionPool', 'PoolTimeout', 'get_pool_stats')
@@ -0,0 +1,76 @@
+from django.db.backends.postgresql import base
+import psycopg2.extras
+
+from .pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    '''
+    PostgreSQL backend with connection management missing in Django 3.2:
+    'CONN_HEALTH_CHECKS' - persistent connection is checked (SELECT 1)
+      before its first use in every request, so a connection broken
+      while idle (e.g. database restart) is replaced instead of failing
+      the request
+    'POOL' - dict of options of the in-process pool (see ConnectionPool:
+      MAX_SIZE, TIMEOUT, MAX_LIFETIME, HEALTH_CHECK_AFTER); connections
+      closed by Django are returned to the pool instead, so CONN_MAX_AGE
+      should be 0
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+
+    @property
+    def pool_options(self):
+        return self.settings_dict.get('POOL') or None
+
+    def get_pool(self):
+        return get_pool(
+            self.alias, self.get_connection_params(), self.pool_options,
+        )
+
+    def get_new_connection(self, conn_params):
+        if self.pool_options is None:
+            return super().get_new_connection(conn_params)
+        connection = self.get_pool().getconn()
+        # same as in django.db.backends.postgresql
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        psycopg2.extras.register_default_jsonb(
+            conn_or_curs=connection, loads=lambda x: x,
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is None or self.pool_options is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            self.get_pool().putconn(self.connection)
+
+    def connect(self):
+        # new connection does not need the check (set before connecting,
+        # because setting autocommit ensures the connection)
+        self.health_check_done = True
+        super().connect()
+
+    def close_if_unusable_or_obsolete(self):
+        '''
+        Called at the start and end of every request
+        '''
+        super().close_if_unusable_or_obsolete()
+        self.health_check_done = False
+
+    def ensure_connection(self):
+        if self.connection is not None and not self.health_check_done \
+                and self.settings_dict.get('CONN_HEALTH_CHECKS') \
+                and not self.in_atomic_block:
+            self.health_check_done = True
+            if not self.is_usable():
+                self.close()
+        super().ensure_connection()
@@ -0,0 +1,209 @@
+from collections import Counter
+import os
+import threading
+from time import monotonic
+
+import psycopg2
+from psycopg2 import extensions
+
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_LIFETIME = 60 * 60
+DEFAULT_HEALTH_CHECK_AFTER = 30
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool():
+    '''
+    Thread-safe pool of psycopg2 connections of a single process.
+    At most max_size connections are open - getconn waits (up to timeout
+    seconds) for a connection to be returned. Connections older than
+    max_lifetime are closed when returned; connections idle for longer
+    than health_check_after are checked (SELECT 1) before reuse and
+    broken ones are replaced with new connections.
+    '''
+    def __init__(self, conn_params, max_size=DEFAULT_MAX_SIZE,
+                 timeout=DEFAULT_TIMEOUT, max_lifetime=DEFAULT_MAX_LIFETIME,
+                 health_check_after=DEFAULT_HEALTH_CHECK_AFTER):
+        self.conn_params = conn_params
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.pid = os.getpid()
+        self.counters = Counter()
+        self._condition = threading.Condition()
+        # list of (connection, time it was returned)
+        self._idle = []
+        # id of connection: time it was opened
+        self._opened = {}
+        self._in_use = 0
+
+    @property
+    def size(self):
+        return self._in_use + len(self._idle)
+
+    def is_usable(self, connection, returned_at):
+        if connection.closed:
+            return False
+        if monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    def get_idle(self):
+        '''
+        Returns idle connection (reserved for the caller), None if a new
+        connection can be opened (slot is reserved) or waits until one
+        of them is possible; PoolTimeout is raised after timeout
+        '''
+        deadline = monotonic() + self.timeout
+        waited = False
+        with self._condition:
+            while not self._idle and self.size >= self.max_size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout(
+                        'No database connection available in {}s '
+                        '(pool size {})'.format(self.timeout, self.max_size)
+                    )
+                if not waited:
+                    self.counters['waits'] += 1
+                    waited = True
+                self._condition.wait(remaining)
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            return None
+
+    def getconn(self):
+        while True:
+            idle = self.get_idle()
+            if idle is None:
+                break
+            connection, returned_at = idle
+            if self.is_usable(connection, returned_at):
+                self.counters['checkouts'] += 1
+                return connection
+            self.counters['health_check_failures'] += 1
+            self.discard(connection)
+        try:
+            connection = psycopg2.connect(**self.conn_params)
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._opened[id(connection)] = monotonic()
+            self.counters['opened'] += 1
+            self.counters['checkouts'] += 1
+        return connection
+
+    def putconn(self, connection):
+        '''
+        Returns connection to the pool; open transaction is rolled back,
+        expired and broken connections are closed
+        '''
+        opened_at = self._opened.get(id(connection))
+        reuse = opened_at is not None and not connection.closed \
+            and monotonic() - opened_at < self.max_lifetime
+        if reuse:
+            status = connection.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                reuse = False
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    reuse = False
+        if not reuse:
+            self.discard(connection)
+            return
+        with self._condition:
+            self._in_use -= 1
+            self._idle.append((connection, monotonic()))
+            self._condition.notify()
+
+    def discard(self, connection):
+        '''
+        Closes connection taken from the pool and frees its slot
+        '''
+        with self._condition:
+            self._in_use -= 1
+            self._opened.pop(id(connection), None)
+            self.counters['closed'] += 1
+            self._condition.notify()
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            for connection, _ in idle:
+                self._opened.pop(id(connection), None)
+                self.counters['closed'] += 1
+        for connection, _ in idle:
+            connection.close()
+
+    def get_stats(self):
+        with self._condition:
+            stats = {
+                'max_size': self.max_size,
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            }
+        for name in ['opened', 'closed', 'checkouts', 'waits', 'timeouts',
+                     'health_check_failures']:
+            stats[name] = self.counters[name]
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(alias, conn_params, options):
+    '''
+    Returns pool of connections of the database alias in the current
+    process (pools inherited from the parent process - e.g. by forked
+    workers - are dropped without closing the shared sockets)
+    '''
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(
+                conn_params,
+                max_size=options.get('MAX_SIZE', DEFAULT_MAX_SIZE),
+                timeout=options.get('TIMEOUT', DEFAULT_TIMEOUT),
+                max_lifetime=options.get(
+                    'MAX_LIFETIME', DEFAULT_MAX_LIFETIME
+                ),
+                health_check_after=options.get(
+                    'HEALTH_CHECK_AFTER', DEFAULT_HEALTH_CHECK_AFTER
+                ),
+            )
+            _pools[alias] = pool
+        return pool
+
+def get_pool_stats():
+    '''
+    Returns dict of stats of pools of the current process (by alias)
+    '''
+    with _pools_lock:
+        pools = [
+            (alias, pool) for alias, pool in _pools.items()
+            if pool.pid == os.getpid()
+        ]
+    return {alias: pool.get_stats() for alias, pool in pools}
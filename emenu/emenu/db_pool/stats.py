@@ -0,0 +1,57 @@
+import os
+
+from django.conf import settings
+from django.db import connections
+
+from .pool import get_pool_stats
+
+
+def get_connection_settings():
+    '''
+    Returns connection management settings of every database alias
+    '''
+    return {
+        alias: {
+            'engine': connections[alias].settings_dict['ENGINE'],
+            'conn_max_age': connections[alias].settings_dict['CONN_MAX_AGE'],
+            'health_checks': bool(
+                connections[alias].settings_dict.get('CONN_HEALTH_CHECKS')
+            ),
+            'pool': connections[alias].settings_dict.get('POOL'),
+        }
+        for alias in connections
+    }
+
+def get_server_connections(alias='default'):
+    '''
+    Returns list of connections to the database (all processes) grouped
+    by application_name (role of the process) and state
+    '''
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            'SELECT application_name, state, COUNT(*) FROM pg_stat_activity '
+            'WHERE datname = current_database() '
+            'GROUP BY application_name, state ORDER BY 1, 2'
+        )
+        return [
+            {'application_name': name, 'state': state, 'count': count}
+            for name, state, count in cursor.fetchall()
+        ]
+
+def get_stats(server=False):
+    '''
+    Returns settings and pool stats of the current process and, with
+    server, connections seen by the database server (PostgreSQL only)
+    '''
+    stats = {
+        'pid': os.getpid(),
+        'role': getattr(settings, 'EMENU_PROCESS_ROLE', None),
+        'settings': get_connection_settings(),
+        'pools': get_pool_stats(),
+    }
+    if server:
+        stats['server'] = {
+            alias: get_server_connections(alias) for alias in connections
+            if connections[alias].vendor == 'postgresql'
+        }
+    return stats
@@ -0,0 +1,13 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+
+from .stats import get_stats
+
+
+@staff_member_required
+def pool_stats(request):
+    '''
+    Connection pool stats of the process serving the request and
+    connections seen by the database server (staff only)
+    '''
+    return JsonResponse(get_stats(server=True))
@@ -0,0 +1,183 @@
+import asyncio
+import base64
+from contextlib import contextmanager
+from hashlib import md5
+import random
+from time import time
+
+from asgiref.local import Local
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+
+
+STICKY_COOKIE_NAME = 'emenu_primary'
+STICKY_USER_KEY = 'emenu:primary:{}'
+DEFAULT_STICKY_SECONDS = 10
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# reads go to replicas only inside of use_replicas() - safe requests
+# (see ReplicaMiddleware) and reports; everything else (e.g. Celery tasks
+# building snapshots) reads from the primary database
+_state = Local()
+
+
+class ReadState():
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.wrote = False
+
+
+def get_replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+def get_sticky_seconds():
+    return getattr(
+        settings, 'DATABASE_REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS
+    )
+
+def get_read_state():
+    return getattr(_state, 'current', None)
+
+@contextmanager
+def use_replicas(enabled=True):
+    '''
+    Sends reads inside of the context to replicas (DATABASE_REPLICAS
+    setting) until the first write, after which they go to the primary,
+    so the context always reads its own writes; yields ReadState
+    '''
+    previous = get_read_state()
+    _state.current = ReadState(enabled)
+    try:
+        yield _state.current
+    finally:
+        _state.current = previous
+
+def use_primary():
+    '''
+    Sends remaining reads of the current use_replicas() context (e.g.
+    request) to the primary database
+    '''
+    state = get_read_state()
+    if state is not None:
+        state.enabled = False
+
+
+class ReplicaRouter():
+    '''
+    Database router sending writes to the primary (default) database and
+    reads inside of use_replicas() to a random replica
+    '''
+    def db_for_read(self, model, **hints):
+        state = get_read_state()
+        replicas = get_replicas()
+        if state is None or not state.enabled or state.wrote or not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = get_read_state()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if {obj1._state.db, obj2._state.db} <= aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema by replication
+        if db in get_replicas():
+            return False
+        return None
+
+
+def get_sticky_user_key(username):
+    return STICKY_USER_KEY.format(md5(username.encode('utf-8')).hexdigest())
+
+def get_basic_auth_username(request):
+    '''
+    Returns username from Basic Authorization header (not verified)
+    or None
+    '''
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'basic':
+        return None
+    try:
+        credentials = base64.b64decode(auth[1]).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return credentials.partition(':')[0]
+
+def is_sticky(request):
+    '''
+    Returns True if the client (by cookie) or the user of Basic
+    authenticated request (by cache) wrote less than
+    DATABASE_REPLICA_STICKY_SECONDS ago (see ReplicaMiddleware)
+    '''
+    try:
+        if float(request.COOKIES.get(STICKY_COOKIE_NAME, 0)) > time():
+            return True
+    except ValueError:
+        pass
+    username = get_basic_auth_username(request)
+    if username is None:
+        return False
+    return cache.get(get_sticky_user_key(username), 0) > time()
+
+
+class ReplicaMiddleware(MiddlewareMixin):
+    '''
+    Sends reads of safe requests to replicas; requests which wrote to the
+    database set a cookie, so the following requests of the same client
+    read from the primary (and see the write despite replication lag)
+    for DATABASE_REPLICA_STICKY_SECONDS. The time is also stored in the
+    cache for the authenticated user, so API clients without cookies
+    (Basic authentication) stick as well. Unsafe requests always use
+    the primary.
+    '''
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        enabled = request.method in SAFE_METHODS and not is_sticky(request)
+        with use_replicas(enabled) as state:
+            response = self.get_response(request)
+        if state.wrote and get_replicas():
+            self.stick(request, response)
+        return response
+
+    async def __acall__(self, request):
+        # the cache is read (and written) in another thread, so the event
+        # loop is not blocked
+        enabled = request.method in SAFE_METHODS and not await sync_to_async(
+            is_sticky, thread_sensitive=False
+        )(request)
+        with use_replicas(enabled) as state:
+            response = await self.get_response(request)
+        if state.wrote and get_replicas():
+            await sync_to_async(self.stick, thread_sensitive=False)(
+                request, response
+            )
+        return response
+
+    def stick(self, request, response):
+        sticky_seconds = get_sticky_seconds()
+        sticky_until = int(time() + sticky_seconds)
+        response.set_cookie(
+            STICKY_COOKIE_NAME,
+            str(sticky_until),
+            max_age=sticky_seconds,
+            httponly=True,
+            samesite='Lax',
+        )
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            cache.set(
+                get_sticky_user_key(user.get_username()),
+                sticky_until,
+                timeout=sticky_seconds,
+            )
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from time import perf_counter
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.deprecation import MiddlewareMixin
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+        CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+        start_http_server)
+
+
+logger = logging.getLogger(__name__)
+
+# With PROMETHEUS_MULTIPROC_DIR environment variable (it has to be set
+# before the process starts and the directory emptied on every deploy),
+# every process (e.g. gunicorn or Celery worker) writes its metrics to
+# files in the directory and /metrics of any process aggregates all of them;
+# there are only counters and histograms, so files of dead processes
+# are summed up as well and need no cleanup
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+UNRESOLVED_VIEW = '<unresolved>'
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100)
+
+REQUEST_DURATION = Histogram(
+    'emenu_request_duration_seconds',
+    'Time of handling requests by URL name',
+    ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'emenu_request_queries',
+    'Number of database queries executed by requests',
+    ['view'],
+    buckets=QUERY_BUCKETS,
+)
+REQUEST_DB_DURATION = Histogram(
+    'emenu_request_db_duration_seconds',
+    'Time of database queries executed by requests',
+    ['view'],
+)
+CACHE_REQUESTS = Counter(
+    'emenu_cache_requests_total',
+    'Lookups of cached content (menu pages, public menu, card snapshots) '
+    'by result',
+    ['cache', 'result'],
+)
+TASK_DURATION = Histogram(
+    'emenu_task_duration_seconds',
+    'Time of running Celery tasks',
+    ['task', 'state'],
+)
+TASK_FAILURES = Counter(
+    'emenu_task_failures_total',
+    'Failed Celery tasks',
+    ['task'],
+)
+
+# start times of running tasks by task id
+_task_started = {}
+
+
+def get_registry():
+    '''
+    Returns registry with metrics of all processes (see MULTIPROC_DIR_ENV)
+    or of the current one
+    '''
+    if not os.environ.get(MULTIPROC_DIR_ENV):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def record_cache_lookup(cache_name, hit):
+    CACHE_REQUESTS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+def get_view_name(request):
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return UNRESOLVED_VIEW
+    return resolver_match.view_name
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    '''
+    Records duration of every request and number and time of its queries
+    (counted by emenu.query_budget.QueryBudgetMiddleware, which has to
+    come after this one) labeled with URL name of the view; queries of
+    streaming responses executed after the view returned are not counted
+    '''
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        started = perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, perf_counter() - started)
+        return response
+
+    def record(self, request, response, duration):
+        view = get_view_name(request)
+        REQUEST_DURATION.labels(
+            view, request.method, response.status_code,
+        ).observe(duration)
+        recorder = getattr(request, 'query_recorder', None)
+        if recorder is not None:
+            REQUEST_QUERIES.labels(view).observe(recorder.count)
+            REQUEST_DB_DURATION.labels(view).observe(recorder.duration)
+
+
+def can_read_metrics(request):
+    '''
+    Checks if the request has METRICS_TOKEN setting in the Authorization
+    header (Bearer) or comes from a staff user; everyone can read metrics
+    only with DEBUG
+    '''
+    if settings.DEBUG:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization') == 'Bearer {}'.format(
+            token):
+        return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_staff
+
+def metrics(request):
+    '''
+    Metrics in Prometheus text exposition format, for requests allowed
+    by can_read_metrics
+    '''
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST,
+    )
+
+
+def record_task_start(task_id, task, **kwargs):
+    _task_started[task_id] = perf_counter()
+
+def record_task_end(task_id, task, state, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state).observe(
+            perf_counter() - started
+        )
+
+def record_task_failure(sender, **kwargs):
+    TASK_FAILURES.labels(sender.name).inc()
+
+def start_worker_server(**kwargs):
+    '''
+    Serves metrics of Celery workers on METRICS_WORKER_PORT (if set);
+    tasks run in child processes of the worker, so their metrics can
+    only be served with PROMETHEUS_MULTIPROC_DIR
+    '''
+    port = getattr(settings, 'METRICS_WORKER_PORT', 0)
+    if not port:
+        return
+    if not os.environ.get(MULTIPROC_DIR_ENV):
+        logger.error(
+            'Metrics of the worker are not served on port {}: {} '
+            'environment variable is not set'.format(port, MULTIPROC_DIR_ENV)
+        )
+        return
+    start_http_server(port, registry=get_registry())
@@ -0,0 +1,224 @@
+import asyncio
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+import logging
+import re
+from time import perf_counter
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT_LIMIT = 5
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+WHITESPACE_RE = re.compile(r'\s+')
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+# recorder of the current request (see QueryBudgetMiddleware), shared
+# with functions the request runs in other threads (see record_queries)
+_state = Local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_query_shape(sql):
+    '''
+    Returns sql with parameters (and numbers) replaced by placeholders, so
+    queries which differ only in parameters (e.g. N+1) have the same shape
+    '''
+    shape = WHITESPACE_RE.sub(' ', sql).strip()
+    shape = PLACEHOLDER_LIST_RE.sub('(%s, ...)', shape)
+    return NUMBER_RE.sub('?', shape)
+
+
+class QueryRecorder():
+    '''
+    Records shape and duration of every query executed (on all databases)
+    inside of record() context
+    '''
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                (get_query_shape(sql), perf_counter() - started)
+            )
+
+    @contextmanager
+    def record(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def get_repeated(self, limit):
+        '''
+        Returns dict of shapes of queries executed more than limit times
+        '''
+        counter = Counter(shape for shape, _ in self.queries)
+        return {shape: count for shape, count in counter.items()
+                if count > limit}
+
+
+def record_queries(func):
+    '''
+    Wraps function which an async view runs in another thread (with
+    sync_to_async(thread_sensitive=False)), so its queries are recorded
+    by the recorder of the current request
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = getattr(_state, 'recorder', None)
+        if recorder is None:
+            return func(*args, **kwargs)
+        with recorder.record():
+            return func(*args, **kwargs)
+    return wrapper
+
+def get_view_budget(view_class, method='GET'):
+    '''
+    Returns tuple of max number of queries of requests with given method
+    and max number of repetitions of the same query shape declared on
+    the view class (query_budget and query_repeat_limit attributes), None
+    means no limit. query_budget is either a dict of budgets by method
+    (e.g. {'GET': 6, 'POST': 12}) or a number, which is the budget of safe
+    methods (reads) only.
+    '''
+    repeat_limit = getattr(
+        settings, 'QUERY_BUDGET_REPEAT_LIMIT', DEFAULT_REPEAT_LIMIT
+    )
+    max_queries = getattr(view_class, 'query_budget', None)
+    if isinstance(max_queries, dict):
+        max_queries = max_queries.get(method)
+    elif method not in SAFE_METHODS:
+        max_queries = None
+    return (
+        max_queries,
+        getattr(view_class, 'query_repeat_limit', repeat_limit),
+    )
+
+def get_budget_violations(recorder, view_class, method='GET'):
+    '''
+    Returns list of messages describing how recorded queries exceed
+    the budget of the view for requests with given method
+    '''
+    max_queries, repeat_limit = get_view_budget(view_class, method)
+    violations = []
+    if max_queries is not None and recorder.count > max_queries:
+        violations.append('{} queries executed, budget of {} is {}'.format(
+            recorder.count, view_class.__name__, max_queries,
+        ))
+    if repeat_limit is None:
+        return violations
+    for shape, count in recorder.get_repeated(repeat_limit).items():
+        violations.append('Query repeated {} times (possible N+1): {}'.format(
+            count, shape,
+        ))
+    return violations
+
+def get_server_timing(recorder):
+    return 'db;dur={:.1f};desc="{} queries"'.format(
+        recorder.duration * 1000, recorder.count,
+    )
+
+
+@contextmanager
+def assert_query_budget(view_class, method='GET'):
+    '''
+    Test helper - fails (AssertionError) if queries executed inside
+    the context exceed the budget declared on the view class for requests
+    with given method
+    '''
+    recorder = QueryRecorder()
+    with recorder.record():
+        yield recorder
+    violations = get_budget_violations(recorder, view_class, method)
+    if violations:
+        raise AssertionError('\n'.join(violations))
+
+
+class QueryBudgetMiddleware(MiddlewareMixin):
+    '''
+    Counts queries and database time of every request and adds them to
+    the Server-Timing header; if budget declared on the view class
+    (see get_view_budget) is exceeded, a warning is logged or, with
+    QUERY_BUDGET_STRICT setting, QueryBudgetExceeded is raised.
+    Queries of streaming responses executed after the view returned
+    are not counted. Async requests (ASGI) stay in the event loop, only
+    queries of functions wrapped by record_queries are counted there.
+    '''
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        recorder = self.start(request)
+        try:
+            with recorder.record():
+                response = self.get_response(request)
+        finally:
+            _state.recorder = None
+        return self.finish(request, recorder, response)
+
+    async def __acall__(self, request):
+        recorder = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.recorder = None
+        return self.finish(request, recorder, response)
+
+    def start(self, request):
+        recorder = QueryRecorder()
+        # also read by emenu.metrics.MetricsMiddleware
+        request.query_recorder = recorder
+        _state.recorder = recorder
+        return recorder
+
+    def finish(self, request, recorder, response):
+        view_class = getattr(request, 'query_budget_view_class', None)
+        if view_class is not None:
+            self.check_budget(request, recorder, view_class)
+        server_timing = get_server_timing(recorder)
+        if response.has_header('Server-Timing'):
+            server_timing = '{}, {}'.format(
+                response['Server-Timing'], server_timing
+            )
+        response['Server-Timing'] = server_timing
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget_view_class = getattr(
+            view_func, 'view_class', None
+        )
+
+    def check_budget(self, request, recorder, view_class):
+        violations = get_budget_violations(
+            recorder, view_class, request.method
+        )
+        if not violations:
+            return
+        message = '{} {}: {}'.format(
+            request.method, request.path, '; '.join(violations)
+        )
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
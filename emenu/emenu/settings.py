@@ -1,10 +1,6 @@
 import os
 from pathlib import Path
 
-from celery.schedules import crontab
-
-import emenu.tasks
-
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -21,33 +17,58 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'debug_toolbar',
     'django_filters',
-    'django_nose',
     'rest_framework',
-    'rest_framework_swagger',
     'card',
 ]
+# development only apps are not imported by production processes
+# (see profile_imports command)
+if DEBUG:
+    INSTALLED_APPS += [
+        'debug_toolbar',
+        'django_nose',
+        'rest_framework_swagger',
+    ]
 
+# all middleware has to be async capable, otherwise Django runs every
+# request of the ASGI handler (including async views) in a single thread
+# (debug toolbar is sync only)
 MIDDLEWARE = [
+    'emenu.metrics.MetricsMiddleware',
+    'emenu.query_budget.QueryBudgetMiddleware',
+    'emenu.db_router.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'emenu.storage.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
+if DEBUG:
+    MIDDLEWARE.insert(
+        MIDDLEWARE.index('django.middleware.csrf.CsrfViewMiddleware') + 1,
+        'debug_toolbar.middleware.DebugToolbarMiddleware',
+    )
 
 ROOT_URLCONF = 'emenu.urls'
 
+# templates are parsed once per process (cached loader), except in
+# development, where changes of templates are picked up without restart
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': TEMPLATE_LOADERS if DEBUG else [
+                ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -61,17 +82,114 @@ TEMPLATES = [
 WSGI_APPLICATION = 'emenu.wsgi.application'
 
 
+# Role of the process ('web' or 'worker' for Celery), used for sizing
+# of the connection pool and as a part of application_name of connections
+EMENU_PROCESS_ROLE = os.environ.get("EMENU_PROCESS_ROLE", default="web")
+
+# Connections are persistent (DB_CONN_MAX_AGE seconds) and checked before
+# the first use in every request (see emenu.db_pool.base); with DB_POOL
+# they are kept in an in-process pool instead (DB_POOL_MAX_SIZE_WEB
+# connections shared by threads of every web process, DB_POOL_MAX_SIZE_WORKER
+# for every Celery worker process)
+DB_POOL = bool(int(os.environ.get("DB_POOL", default=0)))
+DB_POOL_MAX_SIZE = {
+    'web': int(os.environ.get("DB_POOL_MAX_SIZE_WEB", default=10)),
+    'worker': int(os.environ.get("DB_POOL_MAX_SIZE_WORKER", default=2)),
+}
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'emenu.db_pool',
         'NAME': 'emenu',
         'USER': 'emenu',
         'PASSWORD': 'pass',
         'HOST': 'db',
         'PORT': '5432',
+        'CONN_MAX_AGE': 0 if DB_POOL else int(
+            os.environ.get("DB_CONN_MAX_AGE", default=60)
+        ),
+        'CONN_HEALTH_CHECKS': bool(
+            int(os.environ.get("DB_CONN_HEALTH_CHECKS", default=1))
+        ),
+        'OPTIONS': {
+            'application_name': 'emenu-{}'.format(EMENU_PROCESS_ROLE),
+        },
+        'POOL': {
+            'MAX_SIZE': DB_POOL_MAX_SIZE.get(EMENU_PROCESS_ROLE, 10),
+            'TIMEOUT': int(os.environ.get("DB_POOL_TIMEOUT", default=10)),
+            'MAX_LIFETIME': int(
+                os.environ.get("DB_POOL_MAX_LIFETIME", default=3600)
+            ),
+        } if DB_POOL else None,
+    }
+}
+
+# Read replicas (space separated hosts) are added as replica_1, replica_2...
+# aliases; reads of safe requests and reports are sent to them, clients
+# which wrote stick to the primary for DATABASE_REPLICA_STICKY_SECONDS
+# (see emenu.db_router)
+DB_REPLICA_HOSTS = os.environ.get("DB_REPLICA_HOSTS", default="").split()
+DATABASE_REPLICAS = []
+for number, host in enumerate(DB_REPLICA_HOSTS, 1):
+    alias = 'replica_{}'.format(number)
+    DATABASES[alias] = dict(
+        DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['emenu.db_router.ReplicaRouter']
+DATABASE_REPLICA_STICKY_SECONDS = int(
+    os.environ.get("DB_REPLICA_STICKY_SECONDS", default=10)
+)
+
+# Redis is used in production (REDIS_CACHE_URL), local memory cache otherwise
+REDIS_CACHE_URL = os.environ.get("REDIS_CACHE_URL", default="")
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+        }
     }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Rendered rows of menu tables (see card templates) - their keys contain
+# time of the last change of the row (and of its dishes), so they are never
+# stale and can be kept in memory of every process (a large card would need
+# a round trip to Redis for every row)
+CACHES['template_fragments'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'template-fragments',
+    'OPTIONS': {
+        'MAX_ENTRIES': int(
+            os.environ.get("TEMPLATE_FRAGMENTS_MAX_ENTRIES", default=20000)
+        ),
+    },
 }
 
+# Cache used for menu pages of anonymous users (see card.cache)
+MENU_CACHE_ALIAS = 'default'
+MENU_CACHE_TIMEOUT = int(os.environ.get("MENU_CACHE_TIMEOUT", default=3600))
+# rebuild of card snapshots is delayed (in seconds), so bursts of edits
+# are rebuilt once (see card.snapshots)
+MENU_SNAPSHOT_DELAY = int(os.environ.get("MENU_SNAPSHOT_DELAY", default=5))
+
+# Metrics (see emenu.metrics) are served on /metrics to staff users and
+# requests with the token in Authorization header (Bearer), and by Celery
+# workers on METRICS_WORKER_PORT (if set, requires PROMETHEUS_MULTIPROC_DIR
+# environment variable, which aggregates metrics of all processes)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", default="")
+METRICS_WORKER_PORT = int(os.environ.get("METRICS_WORKER_PORT", default=0))
+
+# per-view query budgets (see emenu.query_budget) - exceeding them is logged,
+# with QUERY_BUDGET_STRICT an exception is raised instead
+QUERY_BUDGET_STRICT = bool(int(os.environ.get("QUERY_BUDGET_STRICT", default=0)))
+QUERY_BUDGET_REPEAT_LIMIT = 5
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -104,6 +222,11 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
+# collectstatic saves files with content hash in the name, precompressed
+# (gzip, brotli) - they are served by the app itself (StaticFilesMiddleware)
+# with far-future caching, so no CDN or nginx is needed (see emenu.storage)
+STATIC_ROOT = os.environ.get("STATIC_ROOT", default=BASE_DIR / 'staticfiles')
+STATICFILES_STORAGE = 'emenu.storage.StaticFilesStorage'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -118,27 +241,31 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 CELERY_ENABLE_UTC = False
 CELERY_TIMEZONE = TIME_ZONE
 
-CELERY_BROKER_URL = "redis://redis:6379"
-CELERY_RESULT_BACKEND = "redis://redis:6379"
-
-CELERY_BEAT_SCHEDULE = {
-    'send_email_report' : {
-        'task': 'emenu.tasks.send_email_report',
-        'schedule': crontab(hour=10, minute=0),
-    },
-}
+CELERY_BROKER_URL = os.environ.get(
+        "CELERY_BROKER_URL", default="redis://redis:6379"
+)
+CELERY_RESULT_BACKEND = os.environ.get(
+        "CELERY_RESULT_BACKEND", default="redis://redis:6379"
+)
+# with eager tasks (e.g. CELERY_BROKER_URL=memory://) no Redis is needed
+CELERY_TASK_ALWAYS_EAGER = bool(
+        int(os.environ.get("CELERY_TASK_ALWAYS_EAGER", default=0))
+)
+CELERY_TASK_EAGER_PROPAGATES = CELERY_TASK_ALWAYS_EAGER
+# beat schedule is set in emenu.celery, so settings do not import Celery
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'card.pagination.EmenuAPIPagination',
     'PAGE_SIZE': 50,
     'DEFAULT_FILTER_BACKEND': [
         'django_filters.rest_framework.DjangoFilterBackend',
     ]
 }
 
-TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
+if DEBUG:
+    TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
-NOSE_ARGS = [
-    '--with-coverage',
-    '--cover-package=card',
-]
+    NOSE_ARGS = [
+        '--with-coverage',
+        '--cover-package=card',
+    ]
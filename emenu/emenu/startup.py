@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+
+# name: code run by a fresh interpreter - imports what the entry point
+# imports before it handles the first request, task or command
+ENTRY_POINTS = {
+    'web': (
+        'from emenu.wsgi import application\n'
+        'from django.urls import get_resolver\n'
+        'get_resolver().url_patterns'
+    ),
+    'asgi': (
+        'from emenu.asgi import application\n'
+        'from django.urls import get_resolver\n'
+        'get_resolver().url_patterns'
+    ),
+    'worker': (
+        'from emenu.celery import app\n'
+        'app.loader.import_default_modules()'
+    ),
+    'command': (
+        'import django\n'
+        'django.setup()\n'
+        'from django.core.management import load_command_class\n'
+        'load_command_class("card", "email_report")'
+    ),
+}
+IMPORT_TIME_PREFIX = 'import time:'
+
+
+def parse_import_times(output):
+    '''
+    Returns list of (module, self time, cumulative time, depth) tuples
+    (times in seconds) read from output of python -X importtime; depth 0
+    means the module was imported by the entry point itself
+    '''
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX):
+            continue
+        self_time, cumulative, name = line[len(IMPORT_TIME_PREFIX):].split('|')
+        try:
+            self_time, cumulative = int(self_time), int(cumulative)
+        except ValueError:
+            # header line
+            continue
+        # nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(
+            (name.strip(), self_time / 10**6, cumulative / 10**6, depth)
+        )
+    return imports
+
+def get_package_times(imports):
+    '''
+    Returns dict of time spent importing modules (self time) of every top
+    level package, e.g. time of 'celery' includes all celery.* modules
+    '''
+    packages = {}
+    for name, self_time, _, _ in imports:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_time
+    return packages
+
+def run_entry_point(name, importtime=False):
+    '''
+    Starts an entry point (see ENTRY_POINTS) in a fresh interpreter with
+    current settings module, returns wall time of the process in seconds
+    and (with importtime) list of its imports (see parse_import_times)
+    '''
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', ENTRY_POINTS[name]]
+    started = perf_counter()
+    process = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, env=dict(os.environ),
+    )
+    wall_time = perf_counter() - started
+    if process.returncode:
+        raise RuntimeError('Entry point {} failed:\n{}'.format(
+            name, process.stderr,
+        ))
+    return wall_time, parse_import_times(process.stderr)
+
+def profile_entry_point(name, limit=20):
+    '''
+    Returns import profile of the entry point - wall time, number of
+    imported modules, total import time and the slowest modules (by self
+    and cumulative time) and top level packages (see get_package_times)
+    '''
+    wall_time, imports = run_entry_point(name, importtime=True)
+    packages = get_package_times(imports)
+    return {
+        'wall_time': wall_time,
+        'modules': len(imports),
+        'import_time': sum(packages.values()),
+        'slowest_self': [
+            {'module': module, 'self': self_time}
+            for module, self_time, _, _ in
+            sorted(imports, key=lambda row: row[1], reverse=True)[:limit]
+        ],
+        'slowest_cumulative': [
+            {'module': module, 'cumulative': cumulative}
+            for module, _, cumulative, _ in
+            sorted(imports, key=lambda row: row[2], reverse=True)[:limit]
+        ],
+        'packages': [
+            {'package': package, 'self': self_time}
+            for package, self_time in
+            sorted(packages.items(), key=lambda row: row[1], reverse=True)
+        ][:limit],
+    }
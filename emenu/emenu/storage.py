@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    '''
+    Storage of collected static files - collectstatic saves them with
+    content hash in the name (listed in the manifest) and compressed with
+    gzip and brotli (if Brotli is installed); WhiteNoiseMiddleware serves
+    the compressed variant the client accepts and files with hash in the
+    name are cached forever.
+
+    Missing files (e.g. referenced by third party css) keep their
+    original names, instead of failing collectstatic or rendering of the
+    page. Without the manifest (collectstatic was not run) nothing is
+    hashed, which is expected only with DEBUG (or in tests outside of
+    the image) - otherwise it is logged as an error.
+    '''
+    manifest_strict = False
+    collecting = False
+    manifest_missing_logged = False
+
+    def post_process(self, *args, **kwargs):
+        self.collecting = True
+        try:
+            yield from super().post_process(*args, **kwargs)
+        finally:
+            self.collecting = False
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            if content is not None:
+                raise
+            if self.collecting or self.hashed_files:
+                logger.warning(
+                    'Static file {} not found, it is not hashed'.format(
+                        filename or name
+                    )
+                )
+            elif not settings.DEBUG and not self.manifest_missing_logged:
+                # served files would be cached forever under their
+                # original names
+                self.manifest_missing_logged = True
+                logger.error(
+                    'Manifest of static files {} not found, static files '
+                    'are not hashed - run collectstatic'.format(
+                        self.manifest_name
+                    )
+                )
+            return name
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    '''
+    WhiteNoiseMiddleware which also runs in the async handler (ASGI) -
+    sync only middleware would run every request (and its async view)
+    through a single thread; static files are served from another
+    thread, other requests are passed on without leaving the event loop
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if asyncio.iscoroutinefunction(get_response):
+            # same as in django.utils.deprecation.MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if request.path_info.startswith(self.static_prefix):
+            response = await sync_to_async(
+                self.process_request, thread_sensitive=False
+            )(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
@@ -1,11 +1,131 @@
-from celery import shared_task
+from smtplib import SMTPException
+
+from celery import chord, shared_task
 from celery.utils.log import get_task_logger
-from django.core.management import call_command
+
+# configured app has to be the current one, when tasks are sent by processes
+# which import this module (only) to send them, e.g. web (see emenu/__init__)
+from emenu.celery import app as celery_app  # noqa
 
 
 logger = get_task_logger(__name__)
 
+REPORT_BATCH_SIZE = 100
+
+# this module is imported by the Celery app, possibly before Django is set up,
+# so models (and modules importing them) can only be imported inside of the tasks
+
 
 @shared_task
-def send_email_report():
-    call_command("email_report", )
+def send_email_report(batch_size=REPORT_BATCH_SIZE):
+    '''
+    Coordinator of the daily report - builds and caches the report body
+    and splits recipients into chunks delivered by send_email_report_chunk
+    subtasks (on all workers), totals are summed by email_report_summary
+    '''
+    from card.cache import get_menu_cache
+    from card.reports import (REPORT_KEY, REPORT_TIMEOUT, get_boundry_dates,
+            get_report_message_cached, iter_recipient_batches)
+    from emenu.db_router import use_replicas
+
+    report_date = get_boundry_dates()[0].date().isoformat()
+    with use_replicas():
+        get_report_message_cached(report_date)
+        chunks = [
+            [pk for pk, _ in batch]
+            for batch in iter_recipient_batches(batch_size=batch_size)
+        ]
+    get_menu_cache().set(
+        REPORT_KEY.format(report_date, 'recipients'),
+        sum(len(chunk) for chunk in chunks),
+        timeout=REPORT_TIMEOUT,
+    )
+    if not chunks:
+        logger.info('No users to send report to')
+        return report_date
+    chord(
+        send_email_report_chunk.s(report_date, chunk) for chunk in chunks
+    )(email_report_summary.s(report_date))
+    return report_date
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def send_email_report_chunk(self, report_date, user_pks):
+    '''
+    Sends the report to given users over one connection; users who already
+    got the report for that day (e.g. task was redelivered) are skipped.
+    After an error only users who did not get the message are released
+    and retried; users claimed by another (possibly dead) delivery are
+    retried after their claim expires. When retries are exhausted, users
+    left unsent are logged and the partial result is returned, so the
+    chord still runs email_report_summary.
+    '''
+    from django.contrib.auth.models import User
+    from django.core.mail import get_connection
+    from card.reports import (CLAIM_TIMEOUT, add_report_progress,
+            claim_recipients, get_report_message_cached, mark_recipient_sent,
+            release_recipients, send_batch)
+
+    batch = list(User.objects
+        .filter(pk__in=user_pks)
+        .exclude(email='')
+        .order_by('pk')
+        .values_list('pk', 'email')
+    )
+    claimed, pending = claim_recipients(report_date, batch)
+    # users sent by previous attempts of this task are not skipped again
+    skipped = len(batch) - len(claimed) - len(pending)
+    if not self.request.retries:
+        add_report_progress(report_date, skipped=skipped)
+    sent = set()
+
+    def on_sent(pk, email):
+        mark_recipient_sent(report_date, pk)
+        add_report_progress(report_date, sent=1)
+        sent.add(pk)
+
+    if claimed:
+        message = get_report_message_cached(report_date)
+        try:
+            with get_connection(fail_silently=False) as connection:
+                send_batch(connection, claimed, message, retries=0,
+                           on_sent=on_sent)
+        except (SMTPException, OSError) as exc:
+            unsent = [(pk, email) for pk, email in claimed if pk not in sent]
+            release_recipients(report_date, unsent)
+            if self.request.retries < self.max_retries:
+                raise self.retry(exc=exc)
+            logger.error('Email report for {} not sent to {} users ({}): '
+                         '{}'.format(report_date, len(unsent), exc,
+                                     [pk for pk, _ in unsent]))
+    if pending:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=CLAIM_TIMEOUT)
+        logger.error('Email report for {} not sent to {} users claimed by '
+                     'another delivery: {}'.format(
+                         report_date, len(pending), [pk for pk, _ in pending]
+                     ))
+    return {'sent': len(sent), 'skipped': skipped}
+
+
+@shared_task
+def email_report_summary(results, report_date):
+    totals = {
+        name: sum(result[name] for result in results)
+        for name in ['sent', 'skipped']
+    }
+    logger.info('Email report for {} send: {}'.format(report_date, totals))
+    return totals
+
+
+@shared_task
+def rebuild_menu_snapshots(card_ids):
+    '''
+    Rebuilds snapshots of given cards (see card.snapshots), scheduled
+    after changes of cards, dishes and Dish.cards
+    '''
+    from card.snapshots import build_snapshots
+
+    built = build_snapshots(card_ids)
+    logger.info('Rebuilt {} of {} menu snapshots'.format(built, len(card_ids)))
+    return built
@@ -1,11 +1,13 @@
-import debug_toolbar
-
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.views import LoginView, LogoutView
 from django.urls import include, path
 from django.views.generic import TemplateView
 from django.views.generic.base import RedirectView
 
+from emenu.db_pool.views import pool_stats
+from emenu.metrics import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('card/', include('card.urls'), name='card'),
@@ -14,9 +16,16 @@ urlpatterns = [
     path('login/', LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('', RedirectView.as_view(pattern_name='card-list'), name='home'),
-    path('__debug__', include(debug_toolbar.urls)),
+    path('__db_pool__/', pool_stats, name='db-pool-stats'),
+    path('metrics', metrics, name='metrics'),
     path('swagger-ui/', TemplateView.as_view(
         template_name='swagger-ui.html',
         extra_context={'schema_url':'openapi-schema'}
     ), name='swagger-ui'),
 ]
+
+# debug toolbar is installed only with DEBUG (see settings)
+if 'debug_toolbar' in settings.INSTALLED_APPS:
+    import debug_toolbar
+
+    urlpatterns.append(path('__debug__', include(debug_toolbar.urls)))